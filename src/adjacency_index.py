@@ -0,0 +1,1024 @@
+import multiprocessing
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Tuple
+from metrics import Metrics, measure
+
+RECORD_COLUMNS = ["question", "question_entity", "answer_entity", "passage"]
+
+
+@dataclass
+class EncodedRecords:
+    """
+    records of entities with every column dictionary-encoded to integers.
+    missing values (NaN/None) are encoded as -1.
+    """
+
+    question: np.ndarray
+    question_entity: np.ndarray
+    answer_entity: np.ndarray
+    passage: np.ndarray
+    n_questions: int
+    n_entities: int
+    question_ids: np.ndarray
+    entity_ids: np.ndarray
+    passage_ids: np.ndarray = None
+
+
+@dataclass
+class CSR:
+    """
+    compressed adjacency list: the rows that have key k are order[offsets[k] : offsets[k + 1]],
+    kept in their original order, or sorted by `values` within each key when they are given.
+    """
+
+    offsets: np.ndarray
+    order: np.ndarray
+    values: np.ndarray = None
+
+    def degree(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+def encode_records(df: pd.DataFrame) -> EncodedRecords:
+    # sorted so that question codes compare like the question ids
+    question, question_uniques = pd.factorize(df["question"], sort=True)
+    # question and answer entities share one dictionary so they can be joined on codes
+    entities, entity_uniques = pd.factorize(
+        pd.concat([df["question_entity"], df["answer_entity"]], ignore_index=True)
+    )
+    passage, passage_uniques = pd.factorize(df["passage"])
+    return EncodedRecords(
+        question=question.astype(np.int32),
+        question_entity=entities[: len(df)].astype(np.int32),
+        answer_entity=entities[len(df) :].astype(np.int32),
+        passage=passage.astype(np.int32),
+        n_questions=len(question_uniques),
+        n_entities=len(entity_uniques),
+        question_ids=np.asarray(question_uniques),
+        entity_ids=np.asarray(entity_uniques),
+        passage_ids=np.asarray(passage_uniques),
+    )
+
+
+def build_csr(keys: np.ndarray, n_keys: int) -> CSR:
+    valid = np.flatnonzero(keys >= 0)
+    order = valid[np.argsort(keys[valid], kind="stable")]
+    counts = np.bincount(keys[valid], minlength=n_keys)
+    offsets = np.zeros(n_keys + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return CSR(offsets=offsets, order=order.astype(np.int64))
+
+
+def sort_csr_by(csr: CSR, values: np.ndarray) -> CSR:
+    """
+    sort the rows within each key by their value.
+    """
+    keys = np.repeat(np.arange(len(csr.offsets) - 1), csr.degree())
+    order = np.lexsort((values[csr.order], keys))
+    return CSR(csr.offsets, csr.order[order], values[csr.order][order])
+
+
+def expand(
+    left_keys: np.ndarray, csr: CSR, left_values: np.ndarray = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    inner join of the left rows with the rows of the csr that share their key.
+    returns (left_idx, right_idx) ordered by left row and then by right row,
+    which is the same order `pd.DataFrame.merge(how="inner")` produces.
+    with `left_values` only the right rows with a greater value are joined, the csr must be
+    sorted by values (see `sort_csr_by`).
+    """
+    valid = left_keys >= 0
+    keys = np.where(valid, left_keys, 0)
+    starts = csr.offsets[keys]
+    ends = csr.offsets[keys + 1]
+    if left_values is not None:
+        # keys and values sorted together make one sorted composite, the rows after a left
+        # row start where its own composite would be inserted
+        scale = np.int64(max(csr.values.max(initial=0), left_values.max(initial=0)) + 1)
+        right_keys = np.repeat(np.arange(len(csr.offsets) - 1), csr.degree())
+        starts = np.searchsorted(
+            right_keys * scale + csr.values,
+            keys * scale + left_values.astype(np.int64),
+            side="right",
+        )
+    counts = np.where(valid, np.maximum(ends - starts, 0), 0)
+    total = int(counts.sum())
+    left_idx = np.repeat(np.arange(len(left_keys), dtype=np.int64), counts)
+    group_starts = np.cumsum(counts) - counts
+    positions = np.arange(total, dtype=np.int64) - np.repeat(group_starts, counts)
+    right_idx = csr.order[np.repeat(starts, counts) + positions]
+    if left_values is not None:
+        order = np.lexsort((right_idx, left_idx))
+        left_idx, right_idx = left_idx[order], right_idx[order]
+    return left_idx, right_idx
+
+
+def neq(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # mirrors pandas semantics where a missing value is never equal to anything
+    return (a != b) | (a < 0)
+
+
+Predicate = Callable[[EncodedRecords, np.ndarray], np.ndarray]
+
+
+def different_questions(a: int, b: int) -> Predicate:
+    return lambda enc, rows: enc.question[rows[:, a]] != enc.question[rows[:, b]]
+
+
+def different_passages(a: int, b: int) -> Predicate:
+    return lambda enc, rows: neq(enc.passage[rows[:, a]], enc.passage[rows[:, b]])
+
+
+def different_question_entities(a: int, b: int) -> Predicate:
+    return lambda enc, rows: neq(
+        enc.question_entity[rows[:, a]], enc.question_entity[rows[:, b]]
+    )
+
+
+def answer_not_question_entity_of(tail: int, node: int) -> Predicate:
+    return lambda enc, rows: neq(
+        enc.answer_entity[rows[:, tail]], enc.question_entity[rows[:, node]]
+    )
+
+
+def questions_in_order(a: int, b: int) -> Predicate:
+    return lambda enc, rows: enc.question[rows[:, a]] < enc.question[rows[:, b]]
+
+
+def cycle_filters(
+    head: int, tail: int, head_name: str = "head", tail_name: str = "tail"
+) -> List[Tuple[str, Predicate]]:
+    # see filter_questions_where_head_and_tail_form_cycle
+    nodes = f"({head_name}, {tail_name})"
+    return [
+        ("same_question" + nodes, different_questions(head, tail)),
+        ("answer_loops_to_entity" + nodes, answer_not_question_entity_of(tail, head)),
+        ("same_passage" + nodes, different_passages(head, tail)),
+    ]
+
+
+@dataclass
+class JoinSpec:
+    """
+    how a shape is built from two smaller ones.
+    rows of a shape are 2d arrays of record indexes with one column per node,
+    the joined rows are the left columns followed by the right columns.
+    keys are (record column, node) pairs.
+    - filters: named predicates a joined row must pass, checked in order on the candidate pairs
+      before their rows are gathered
+    - canonical_key: for a self join whose filters only keep right rows with a greater value on
+      this key than the left row, so that every unordered pair comes out once. the join then skips
+      the other rows instead of building and rejecting them
+    - right_permutation: the right rows are joined as they are and once more with their nodes
+      permuted, so that an unordered pair can be joined on either of its nodes
+    """
+
+    left: str
+    left_key: Tuple[str, int]
+    right: str
+    right_key: Tuple[str, int]
+    filters: List[Tuple[str, Predicate]]
+    canonical_key: Tuple[str, int] = None
+    right_permutation: List[int] = None
+
+
+# in dependency order, "records" holds every record as a single node
+SHAPE_JOINS = {
+    # 0--->0
+    "2hop": JoinSpec(
+        "records",
+        ("answer_entity", 0),
+        "records",
+        ("question_entity", 0),
+        cycle_filters(0, 1),
+    ),
+    # 0--->0<---0 with the heads in question order
+    "2hop_with_adjacent_head": JoinSpec(
+        "2hop",
+        ("question", 1),
+        "2hop",
+        ("question", 1),
+        [
+            # see filter_identical_heads
+            ("same_question(head1, head2)", different_questions(0, 2)),
+            ("same_entity(head1, head2)", different_question_entities(0, 2)),
+            ("same_passage(head1, head2)", different_passages(0, 2)),
+            ("unordered_duplicate(head1, head2)", questions_in_order(0, 2)),
+        ],
+        canonical_key=("question", 0),
+    ),
+    # 0--->0--->0
+    "3hop": JoinSpec(
+        "2hop",
+        ("question", 1),
+        "2hop",
+        ("question", 0),
+        cycle_filters(0, 3),
+    ),
+    # 0--->0--->0<---0
+    "3hop_with_adjacent_head": JoinSpec(
+        "2hop_with_adjacent_head",
+        ("question", 1),
+        "2hop",
+        ("question", 0),
+        cycle_filters(0, 5, "head1") + cycle_filters(2, 5, "head2"),
+    ),
+    # 0--->
+    #       0--->0
+    # 0--->
+    "3hop_with_adjacent_head2": JoinSpec(
+        "2hop",
+        ("question", 1),
+        "2hop_with_adjacent_head",
+        ("question", 0),
+        cycle_filters(0, 3),
+        right_permutation=[2, 3, 0, 1],
+    ),
+    # 0--->0--->0--->0
+    "4hop": JoinSpec(
+        "3hop",
+        ("question", 3),
+        "2hop",
+        ("question", 0),
+        cycle_filters(0, 5)
+        # the tail must not loop back to the first mid node, see
+        # filter_questions_where_head_and_tail_form_cycle_loop_v
+        + [
+            ("same_question(mid0, tail)", different_questions(1, 5)),
+            ("answer_loops_to_entity(mid0, tail)", answer_not_question_entity_of(5, 1)),
+            ("same_passage(mid0, tail)", different_passages(1, 5)),
+            (
+                "answer_loops_to_entity(mid0_2, tail)",
+                answer_not_question_entity_of(5, 2),
+            ),
+            ("same_passage(mid0_2, tail)", different_passages(2, 5)),
+        ],
+    ),
+}
+
+
+class PairedRows:
+    """
+    the rows left[left_idx] next to right[right_idx], a column is only gathered when asked for.
+    """
+
+    def __init__(
+        self,
+        left: np.ndarray,
+        right: np.ndarray,
+        left_idx: np.ndarray,
+        right_idx: np.ndarray,
+    ) -> None:
+        self.left, self.right = left, right
+        self.left_idx, self.right_idx = left_idx, right_idx
+
+    def __len__(self) -> int:
+        return len(self.left_idx)
+
+    def __getitem__(self, key) -> np.ndarray:
+        _, col = key
+        if col < self.left.shape[1]:
+            return self.left[self.left_idx, col]
+        return self.right[self.right_idx, col - self.left.shape[1]]
+
+
+def filter_pairs(
+    enc: EncodedRecords,
+    spec: JoinSpec,
+    left: np.ndarray,
+    right: np.ndarray,
+    left_idx: np.ndarray,
+    right_idx: np.ndarray,
+    rejected: Dict[str, int] = None,
+    seconds: Dict[str, float] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    apply the filters of spec to candidate pairs, each one only sees the pairs that passed the
+    ones before it. the pairs rejected by each filter are added to `rejected` and the time it
+    took to `seconds`.
+    """
+    for name, predicate in spec.filters:
+        start = time.perf_counter()
+        keep = predicate(enc, PairedRows(left, right, left_idx, right_idx))
+        if rejected is not None:
+            rejected[name] = rejected.get(name, 0) + int(len(keep) - keep.sum())
+        if seconds is not None:
+            seconds[name] = seconds.get(name, 0.0) + time.perf_counter() - start
+        left_idx, right_idx = left_idx[keep], right_idx[keep]
+    return left_idx, right_idx
+
+
+def node_keys(
+    enc: EncodedRecords, rows: np.ndarray, key: Tuple[str, int]
+) -> np.ndarray:
+    col, node = key
+    return getattr(enc, col)[rows[:, node]]
+
+
+def n_keys(enc: EncodedRecords, key: Tuple[str, int]) -> int:
+    return enc.n_questions if key[0] == "question" else enc.n_entities
+
+
+def right_rows(shapes: Dict[str, np.ndarray], spec: JoinSpec) -> np.ndarray:
+    right = shapes[spec.right]
+    if spec.right_permutation is None:
+        return right
+    return np.concatenate([right, right[:, spec.right_permutation]])
+
+
+def right_csr(enc: EncodedRecords, right: np.ndarray, spec: JoinSpec) -> CSR:
+    csr = build_csr(node_keys(enc, right, spec.right_key), n_keys(enc, spec.right_key))
+    if spec.canonical_key is not None:
+        csr = sort_csr_by(csr, node_keys(enc, right, spec.canonical_key))
+    return csr
+
+
+@dataclass
+class Sampling:
+    """
+    caps applied while the shapes are enumerated, so hub entities never expand to their full
+    cross product.
+    - max_fanout: at most this many candidate rows per bridge key of a join, sampled uniformly
+    - max_rows: at most this many rows per shape, kept with a seeded reservoir
+    - seed: seed of both samples, the output does not depend on the number of processes
+    after enumeration `skipped` holds {shape: {bridge: skipped candidates}} for the capped bridges
+    and `dropped` holds {shape: rows dropped by max_rows}.
+    """
+
+    max_fanout: int = None
+    max_rows: int = None
+    seed: int = 0
+    skipped: Dict[str, Dict] = field(default_factory=dict)
+    dropped: Dict[str, int] = field(default_factory=dict)
+
+
+@dataclass
+class HubSample:
+    """
+    candidate pairs sampled for the bridge keys whose candidates exceed the fan-out cap.
+    is_hub has one extra False slot at the end so that a missing key (-1) can index it.
+    """
+
+    is_hub: np.ndarray
+    left_idx: np.ndarray
+    right_idx: np.ndarray
+    skipped: np.ndarray
+
+
+def sample_hubs(
+    left_keys: np.ndarray, csr: CSR, max_fanout: int, seed: List[int]
+) -> HubSample:
+    n = len(csr.offsets) - 1
+    left_csr = build_csr(left_keys, n)
+    candidates = left_csr.degree() * csr.degree()
+    hubs = np.flatnonzero(candidates > max_fanout)
+    left_idx, right_idx = [], []
+    for key in hubs.tolist():
+        # pairs are drawn by index from the cross product of the hub without building it
+        rng = np.random.default_rng(seed + [key])
+        picked = np.sort(
+            rng.choice(int(candidates[key]), size=max_fanout, replace=False)
+        )
+        left_rank, right_rank = np.divmod(picked, csr.degree()[key])
+        left_idx.append(left_csr.order[left_csr.offsets[key] + left_rank])
+        right_idx.append(csr.order[csr.offsets[key] + right_rank])
+    is_hub = np.zeros(n + 1, dtype=bool)
+    is_hub[hubs] = True
+    skipped = np.zeros(n, dtype=np.int64)
+    skipped[hubs] = candidates[hubs] - max_fanout
+    empty = np.empty(0, dtype=np.int64)
+    return HubSample(
+        is_hub=is_hub,
+        left_idx=np.concatenate(left_idx or [empty]),
+        right_idx=np.concatenate(right_idx or [empty]),
+        skipped=skipped,
+    )
+
+
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def reservoir(rows: np.ndarray, max_rows: int, seed: int) -> np.ndarray:
+    """
+    keep the max_rows rows with the smallest seeded hash, in their original order.
+    the hash only depends on the row itself, so reservoirs of consecutive chunks can be merged
+    and give the same sample as one pass over all rows.
+    """
+    if len(rows) <= max_rows:
+        return rows
+    priority = np.full(len(rows), seed, dtype=np.uint64)
+    for col in range(rows.shape[1]):
+        priority = _splitmix64(priority ^ rows[:, col].astype(np.uint64))
+    keep = np.argpartition(priority, max_rows)[:max_rows]
+    return rows[np.sort(keep)]
+
+
+def join(
+    enc: EncodedRecords,
+    left: np.ndarray,
+    right: np.ndarray,
+    spec: JoinSpec,
+    csr: CSR = None,
+    hubs: HubSample = None,
+    offset: int = 0,
+    rejected: Dict[str, int] = None,
+    seconds: Dict[str, float] = None,
+) -> np.ndarray:
+    """
+    join left and right on the keys of spec, `offset` is the position of left within the rows
+    the hub sample was drawn from. see `filter_pairs` for `rejected` and `seconds`.
+    """
+    if csr is None:
+        csr = right_csr(enc, right, spec)
+    left_keys = node_keys(enc, left, spec.left_key)
+    left_values = None
+    if spec.canonical_key is not None:
+        left_values = node_keys(enc, left, spec.canonical_key)
+    if hubs is None:
+        left_idx, right_idx = expand(left_keys, csr, left_values)
+    else:
+        # rows on a hub key only get the pairs sampled for it
+        left_idx, right_idx = expand(
+            np.where(hubs.is_hub[left_keys], -1, left_keys), csr, left_values
+        )
+        in_range = (hubs.left_idx >= offset) & (hubs.left_idx < offset + len(left))
+        left_idx = np.concatenate([left_idx, hubs.left_idx[in_range] - offset])
+        right_idx = np.concatenate([right_idx, hubs.right_idx[in_range]])
+        order = np.lexsort((right_idx, left_idx))
+        left_idx, right_idx = left_idx[order], right_idx[order]
+    left_idx, right_idx = filter_pairs(
+        enc, spec, left, right, left_idx, right_idx, rejected, seconds
+    )
+    return np.hstack([left[left_idx], right[right_idx]])
+
+
+# candidate rows expanded at once when a join has to be chunked for the reservoir
+JOIN_CHUNK_CANDIDATES = 2**22
+
+
+def split_left_rows(
+    enc: EncodedRecords, left: np.ndarray, spec: JoinSpec, csr: CSR, n_ranges: int
+) -> List[Tuple[int, int]]:
+    """
+    split the left rows into contiguous ranges that expand to about the same number of candidates,
+    so a hub entity does not end up in one oversized range.
+    """
+    keys = node_keys(enc, left, spec.left_key)
+    cumulative = np.cumsum(np.append(csr.degree(), 0)[keys])
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    if n_ranges is None:
+        n_ranges = max(1, -(-total // JOIN_CHUNK_CANDIDATES))
+    bounds = np.searchsorted(
+        cumulative, np.linspace(0, total, n_ranges + 1)[1:-1], side="right"
+    )
+    bounds = np.unique(np.r_[0, bounds, len(left)])
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+@dataclass
+class JoinPlan:
+    """
+    what every range of left rows of a join shares.
+    """
+
+    right: np.ndarray
+    csr: CSR
+    hubs: HubSample = None
+
+
+def plan_join(
+    enc: EncodedRecords,
+    shapes: Dict[str, np.ndarray],
+    shape: str,
+    sampling: Sampling = None,
+) -> JoinPlan:
+    spec = SHAPE_JOINS[shape]
+    right = right_rows(shapes, spec)
+    csr = right_csr(enc, right, spec)
+    if sampling is None or sampling.max_fanout is None:
+        return JoinPlan(right, csr)
+    hubs = sample_hubs(
+        node_keys(enc, shapes[spec.left], spec.left_key),
+        csr,
+        sampling.max_fanout,
+        [sampling.seed, list(SHAPE_JOINS).index(shape)],
+    )
+    bridges = enc.question_ids if spec.left_key[0] == "question" else enc.entity_ids
+    capped = np.flatnonzero(hubs.skipped)
+    sampling.skipped[shape] = dict(
+        zip(bridges[capped].tolist(), hubs.skipped[capped].tolist())
+    )
+    return JoinPlan(right, csr, hubs)
+
+
+def _shape_seed(sampling: Sampling, shape: str) -> int:
+    return sampling.seed * len(SHAPE_JOINS) + list(SHAPE_JOINS).index(shape)
+
+
+# shapes other shapes are joined from, their rows are kept until every shape is enumerated
+JOINED_SHAPES = {
+    name for spec in SHAPE_JOINS.values() for name in (spec.left, spec.right)
+}
+
+
+def range_outputs(
+    shape: str, sampling: Sampling, question_codes: Dict = None
+) -> Tuple[bool, bool]:
+    """
+    whether the ranges of a shape return their rows and their question codes. the codes of a
+    sampled shape are only known once the reservoirs of its ranges are merged.
+    """
+    if question_codes is None or (
+        sampling is not None and sampling.max_rows is not None
+    ):
+        return True, False
+    return shape in JOINED_SHAPES, True
+
+
+def join_range(
+    enc: EncodedRecords,
+    shapes: Dict[str, np.ndarray],
+    shape: str,
+    plan: JoinPlan,
+    sampling: Sampling,
+    start: int,
+    end: int,
+    keep_rows: bool = True,
+    with_codes: bool = False,
+) -> Tuple[np.ndarray, np.ndarray, int, Dict[str, int], Dict[str, float]]:
+    """
+    join a range of left rows, returns the (sampled) rows or None unless keep_rows, the distinct
+    question codes of the rows when with_codes (see `shape_question_codes`), the number of rows
+    before sampling, the rows rejected by each filter and the seconds spent in each filter.
+    """
+    spec = SHAPE_JOINS[shape]
+    left = shapes[spec.left][start:end]
+    rejected, seconds = {}, {}
+    rows = join(
+        enc, left, plan.right, spec, plan.csr, plan.hubs, start, rejected, seconds
+    )
+    n_rows = len(rows)
+    if sampling is not None and sampling.max_rows is not None:
+        rows = reservoir(rows, sampling.max_rows, _shape_seed(sampling, shape))
+    codes = None
+    if with_codes:
+        codes = shape_question_codes(enc.question, shape, rows, enc.n_questions)
+    return rows if keep_rows else None, codes, n_rows, rejected, seconds
+
+
+def collect_ranges(
+    parts: Iterator[
+        Tuple[np.ndarray, np.ndarray, int, Dict[str, int], Dict[str, float]]
+    ],
+    shape: str,
+    width: int,
+    sampling: Sampling,
+    rejected: Dict[str, Dict[str, int]] = None,
+    metrics: Metrics = None,
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    concatenate the joined ranges of a shape in order, merging their reservoirs on the way, and
+    the question codes of the ranges without their duplicates. returns the rows and the codes,
+    each None when the ranges did not return them, and the number of rows.
+    the rows rejected by each filter are summed into rejected[shape]. the candidate pairs of the
+    shape and the input rows, output rows and time of each filter are added to `metrics`.
+    """
+    kept, codes, seen = [], [], 0
+    sampled = sampling is not None and sampling.max_rows is not None
+    filters = [name for name, _ in SHAPE_JOINS[shape].filters]
+    shape_rejected = {name: 0 for name in filters}
+    shape_seconds = {name: 0.0 for name in filters}
+    n_parts = 0
+    for rows, range_codes, n_rows, range_rejected, range_seconds in parts:
+        seen += n_rows
+        if rows is not None:
+            kept.append(rows)
+            if sampled:
+                kept = [
+                    reservoir(
+                        np.concatenate(kept),
+                        sampling.max_rows,
+                        _shape_seed(sampling, shape),
+                    )
+                ]
+        if range_codes is not None:
+            codes.append(range_codes)
+        for name, n in range_rejected.items():
+            shape_rejected[name] += n
+        for name, elapsed in range_seconds.items():
+            shape_seconds[name] += elapsed
+        n_parts += 1
+    rows = np.concatenate(kept) if kept else None
+    if rows is None and not codes:
+        rows = np.empty((0, width), dtype=np.int64)
+    n_output = seen if rows is None else len(rows)
+    if codes:
+        # the first occurrences within the ranges, in order, keep the first overall
+        codes = np.concatenate(codes)
+        codes = codes[first_unique_rows(codes, int(codes.max(initial=-1)) + 1)]
+    else:
+        codes = None
+    if sampling is not None:
+        sampling.dropped[shape] = seen - n_output
+    if rejected is not None:
+        rejected[shape] = shape_rejected
+    if metrics is not None:
+        n_input = seen + sum(shape_rejected.values())
+        metrics.add(f"task2/{shape}", calls=0, candidates=n_input)
+        for name in filters:
+            metrics.add(
+                f"task2/{shape}/{name}",
+                shape_seconds[name],
+                n_parts,
+                input_rows=n_input,
+                output_rows=n_input - shape_rejected[name],
+            )
+            n_input -= shape_rejected[name]
+    return rows, codes, n_output
+
+
+def _width(shapes: Dict[str, np.ndarray], shape: str) -> int:
+    spec = SHAPE_JOINS[shape]
+    return shapes[spec.left].shape[1] + shapes[spec.right].shape[1]
+
+
+def store_shape(
+    enc: EncodedRecords,
+    shapes: Dict[str, np.ndarray],
+    question_codes: Dict[str, np.ndarray],
+    shape: str,
+    rows: np.ndarray,
+    codes: np.ndarray,
+):
+    if question_codes is not None:
+        if codes is None:
+            codes = shape_question_codes(enc.question, shape, rows, enc.n_questions)
+        question_codes[shape] = codes
+        if shape not in JOINED_SHAPES:
+            return
+    shapes[shape] = rows
+
+
+def find_shapes(
+    enc: EncodedRecords,
+    sampling: Sampling = None,
+    rejected: Dict[str, Dict[str, int]] = None,
+    metrics: Metrics = None,
+    question_codes: Dict[str, np.ndarray] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    enumerate every composition shape as rows of record indexes, one column per node,
+    ordered as the nodes are in `composable_questions`.
+    when `rejected` is given it is filled with {shape: {filter: rejected candidate rows}}.
+    `metrics` gets a `task2/<shape>` stage per shape and a `task2/<shape>/<filter>` per filter.
+    when `question_codes` is given it is filled with {shape: `shape_question_codes`} and the shapes
+    no other shape is joined from are not returned, their rows are only built a range of left
+    rows at a time.
+    """
+    shapes = {"records": np.arange(len(enc.question), dtype=np.int64)[:, None]}
+    for shape, spec in SHAPE_JOINS.items():
+        with measure(metrics, f"task2/{shape}") as counters:
+            plan = plan_join(enc, shapes, shape, sampling)
+            keep_rows, with_codes = range_outputs(shape, sampling, question_codes)
+            if keep_rows and (sampling is None or sampling.max_rows is None):
+                ranges = [(0, len(shapes[spec.left]))]
+            else:
+                ranges = split_left_rows(enc, shapes[spec.left], spec, plan.csr, None)
+            rows, codes, n_rows = collect_ranges(
+                (
+                    join_range(
+                        enc,
+                        shapes,
+                        shape,
+                        plan,
+                        sampling,
+                        start,
+                        end,
+                        keep_rows,
+                        with_codes,
+                    )
+                    for start, end in ranges
+                ),
+                shape,
+                _width(shapes, shape),
+                sampling,
+                rejected,
+                metrics,
+            )
+            store_shape(enc, shapes, question_codes, shape, rows, codes)
+            counters.update(_shape_counters(shapes, plan, shape, n_rows))
+    del shapes["records"]
+    return shapes
+
+
+def _shape_counters(
+    shapes: Dict[str, np.ndarray], plan: JoinPlan, shape: str, n_rows: int
+) -> Dict[str, int]:
+    return {
+        "left_rows": len(shapes[SHAPE_JOINS[shape].left]),
+        "right_rows": len(plan.right),
+        "output_rows": n_rows,
+    }
+
+
+def join_levels() -> List[List[str]]:
+    """
+    group the shapes so that each one only depends on shapes of earlier groups.
+    """
+    levels, done = [], {"records"}
+    while len(done) <= len(SHAPE_JOINS):
+        level = [
+            shape
+            for shape, spec in SHAPE_JOINS.items()
+            if shape not in done and {spec.left, spec.right} <= done
+        ]
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+# state inherited by forked workers, so the arrays are shared copy-on-write instead of pickled
+_shared = {}
+
+
+def _join_task(
+    shape: str, start: int, end: int
+) -> Tuple[np.ndarray, np.ndarray, int, Dict[str, int], Dict[str, float]]:
+    keep_rows, with_codes = _shared["outputs"][shape]
+    return join_range(
+        _shared["enc"],
+        _shared["shapes"],
+        shape,
+        _shared["plans"][shape],
+        _shared["sampling"],
+        start,
+        end,
+        keep_rows,
+        with_codes,
+    )
+
+
+def find_shapes_parallel(
+    enc: EncodedRecords,
+    n_processes: int,
+    sampling: Sampling = None,
+    rejected: Dict[str, Dict[str, int]] = None,
+    tasks_per_process: int = 4,
+    metrics: Metrics = None,
+    question_codes: Dict[str, np.ndarray] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    same as `find_shapes` but spread over a pool of forked processes.
+    the shapes of a level of `join_levels` are independent of each other and each join is split
+    into ranges of left rows, the ranges are concatenated back in order so the output is
+    identical to the sequential one. the shapes of a level run at the same time, so the time of
+    a shape in `metrics` is how long it was waited for and its filters add up the worker times.
+    with `question_codes` the workers also gather and deduplicate the question codes of their
+    ranges, and only send back the rows of the shapes that are joined from.
+    """
+    shapes = {"records": np.arange(len(enc.question), dtype=np.int64)[:, None]}
+    for level in join_levels():
+        plans = {shape: plan_join(enc, shapes, shape, sampling) for shape in level}
+        outputs = {
+            shape: range_outputs(shape, sampling, question_codes) for shape in level
+        }
+        _shared.update(
+            enc=enc, shapes=shapes, plans=plans, sampling=sampling, outputs=outputs
+        )
+        with ProcessPoolExecutor(
+            max_workers=n_processes, mp_context=multiprocessing.get_context("fork")
+        ) as pool:
+            futures = {
+                shape: [
+                    pool.submit(_join_task, shape, start, end)
+                    for start, end in split_left_rows(
+                        enc,
+                        shapes[SHAPE_JOINS[shape].left],
+                        SHAPE_JOINS[shape],
+                        plans[shape].csr,
+                        n_processes * tasks_per_process,
+                    )
+                ]
+                for shape in level
+            }
+            for shape in level:
+                with measure(metrics, f"task2/{shape}") as counters:
+                    rows, codes, n_rows = collect_ranges(
+                        (future.result() for future in futures[shape]),
+                        shape,
+                        _width(shapes, shape),
+                        sampling,
+                        rejected,
+                        metrics,
+                    )
+                    store_shape(enc, shapes, question_codes, shape, rows, codes)
+                    counters.update(
+                        _shape_counters(shapes, plans[shape], shape, n_rows)
+                    )
+        _shared.clear()
+    del shapes["records"]
+    return shapes
+
+
+def _node(suffix: str, index: str = "", with_question: bool = True) -> List[str]:
+    return [
+        f"question{suffix}" if with_question else None,
+        f"question_entity{index}{suffix}",
+        f"answer_entity{index}{suffix}",
+        f"passage{index}{suffix}",
+    ]
+
+
+# column names given to each record of a shape, the question column of a record that was used
+# as a join key is dropped exactly as pandas drops it
+SHAPE_COLUMNS = {
+    "2hop": [_node("_head"), _node("_tail")],
+    "2hop_with_adjacent_head": [
+        _node("_head1"),
+        _node("_tail"),
+        _node("_head2"),
+        _node("_tail", "2", with_question=False),
+    ],
+    "3hop": [
+        _node("_head"),
+        _node("_mid"),
+        _node("_mid", "2", with_question=False),
+        _node("_tail"),
+    ],
+    "3hop_with_adjacent_head": [
+        _node("_head1"),
+        _node("_mid"),
+        _node("_head2"),
+        _node("_mid", "2", with_question=False),
+        _node("_mid", "3", with_question=False),
+        _node("_tail"),
+    ],
+    "3hop_with_adjacent_head2": [
+        _node("_head"),
+        _node("_mid"),
+        _node("_mid1"),
+        _node("_tail"),
+        _node("_mid2"),
+        _node("_tail", "2", with_question=False),
+    ],
+    "4hop": [
+        _node("_head"),
+        _node("_mid0"),
+        _node("_mid0", "2", with_question=False),
+        _node("_mid"),
+        _node("_mid", "3", with_question=False),
+        _node("_tail"),
+    ],
+}
+
+
+def shape_to_frame(df: pd.DataFrame, shape: str, rows: np.ndarray) -> pd.DataFrame:
+    """
+    gather the records of a shape into a frame with the same columns as the pandas engine.
+    categorical columns of df stay categorical, only their codes are gathered.
+    """
+    columns = {}
+    for node, names in enumerate(SHAPE_COLUMNS[shape]):
+        for record_col, name in zip(RECORD_COLUMNS, names):
+            if name is not None:
+                columns[name] = df[record_col].array.take(rows[:, node])
+    return pd.DataFrame(columns)
+
+
+def decoded_records(enc: EncodedRecords) -> pd.DataFrame:
+    """
+    the records of enc with the entities and passages as categoricals over their codes.
+    """
+    return pd.DataFrame(
+        {
+            "question": enc.question_ids[enc.question],
+            "question_entity": pd.Categorical.from_codes(
+                enc.question_entity, enc.entity_ids
+            ),
+            "answer_entity": pd.Categorical.from_codes(
+                enc.answer_entity, enc.entity_ids
+            ),
+            "passage": pd.Categorical.from_codes(enc.passage, enc.passage_ids),
+        }
+    )
+
+
+def first_unique_rows(codes: np.ndarray, n_codes: int) -> np.ndarray:
+    """
+    indexes of the first occurrence of every distinct row of codes, in order. codes are in
+    [0, n_codes), each row is packed into one integer key so the rows are sorted once.
+    """
+    key = np.zeros(len(codes), dtype=np.int64)
+    radix = 1
+    for col in range(codes.shape[1]):
+        if radix * n_codes >= 2**63:
+            # the packed key would overflow, replace it by its dense codes
+            key, uniques = pd.factorize(key)
+            radix = len(uniques)
+        key *= n_codes
+        key += codes[:, col]
+        radix *= n_codes
+    _, first = np.unique(key, return_index=True)
+    return np.sort(first)
+
+
+def shape_question_codes(
+    questions: np.ndarray, shape: str, rows: np.ndarray, n_questions: int = None
+) -> np.ndarray:
+    """
+    the distinct rows of the question codes of the nodes of a shape, in the order of their first
+    row, one column per `question_columns(shape)`. only the question codes of the rows are gathered.
+
+    Args:
+    - questions: question code of every record, non-negative integers
+    - shape: name of the shape
+    - rows: rows of record indexes of the shape
+    - n_questions: upper bound of the codes, default is the largest gathered code plus one
+    """
+    codes = np.stack(
+        [questions[rows[:, node]] for _, node in question_columns(shape)], axis=1
+    )
+    if n_questions is None:
+        n_questions = int(codes.max(initial=-1)) + 1
+    return codes[first_unique_rows(codes, n_questions)]
+
+
+def decode_question_codes(
+    enc: EncodedRecords, shape: str, codes: np.ndarray
+) -> pd.DataFrame:
+    """
+    the question sets of a shape as `composable_questions.question_ids` returns them for its
+    frame, from the output of `shape_question_codes`.
+    """
+    return pd.DataFrame(
+        {
+            name: enc.question_ids[codes[:, i]]
+            for i, (name, _) in enumerate(question_columns(shape))
+        }
+    )
+
+
+def find_composable_sets(
+    df: pd.DataFrame,
+    n_processes: int = 1,
+    sampling: Sampling = None,
+    rejected: Dict[str, Dict[str, int]] = None,
+    metrics: Metrics = None,
+    frames: Dict[str, pd.DataFrame] = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    integer-encoded alternative to the chained pandas merges in `composable_questions`, returns
+    the question ids of the sets of every shape, the same as the pandas engine unless sampling
+    caps are set. the shapes stay encoded row arrays, only their question columns are gathered.
+    when `frames` is given it is filled with the frames of the pandas engine for debugging, with
+    the entities and passages as categoricals.
+    """
+    df = df.reset_index(drop=True)
+    with measure(metrics, "task2/encode_records") as counters:
+        enc = encode_records(df)
+        counters["records"] = len(df)
+    # the frames need the rows of every shape, otherwise only their question codes are kept
+    codes = {} if frames is None else None
+    if n_processes > 1:
+        shapes = find_shapes_parallel(
+            enc, n_processes, sampling, rejected, metrics=metrics, question_codes=codes
+        )
+    else:
+        shapes = find_shapes(enc, sampling, rejected, metrics, question_codes=codes)
+    if frames is not None:
+        records = decoded_records(enc)
+        frames.update(
+            (shape, shape_to_frame(records, shape, rows))
+            for shape, rows in shapes.items()
+        )
+        codes = {
+            shape: shape_question_codes(enc.question, shape, rows, enc.n_questions)
+            for shape, rows in shapes.items()
+        }
+        shapes.clear()
+    sets = {}
+    for shape in list(codes):
+        with measure(metrics, "task2/question_ids") as counters:
+            sets[shape] = decode_question_codes(enc, shape, codes.pop(shape))
+            counters["output_rows"] = len(sets[shape])
+    return sets
+
+
+def question_columns(shape: str) -> List[Tuple[str, int]]:
+    """
+    (column name, node) of the question ids kept by `restore_questions_info` for a shape.
+    """
+    return [
+        (names[0], node)
+        for node, names in enumerate(SHAPE_COLUMNS[shape])
+        if names[0] is not None
+    ]
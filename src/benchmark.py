@@ -0,0 +1,402 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+from argparse import Namespace
+from dataclasses import asdict
+from typing import Callable, Dict, List, Tuple
+from composable_questions import composable_questions
+from entity_linking.nel import NEL
+from entity_linking.stub_models import StubNED, StubNER
+from incremental_composition import CompositionState
+from main import link_entities
+from partitioned_composition import composable_questions_partitioned
+from worker_pool import map_forked
+
+ENGINES = ["pandas", "numpy", "parallel", "partitioned", "incremental"]
+LINKING_MODES = ["sequential", "pipeline", "ned_group"]
+
+
+def synthetic_questions(
+    n_questions: int,
+    n_entities: int,
+    zipf_a: float = 0.6,
+    two_entity_rate: float = 0.2,
+    questions_per_passage: int = 4,
+    seed: int = 0,
+) -> Tuple[List[Dict], List[Dict]]:
+    """
+    generate single-hop questions about entities `E<rank>` whose degrees follow a Zipf law of
+    exponent zipf_a, so a few hub entities are in most questions and answers, like real data.
+    returns the qa records and the records of entities NEL links in them, which `StubNER` and
+    `StubNED` reproduce.
+
+    Args:
+    - n_questions: number of questions
+    - n_entities: number of distinct entities
+    - zipf_a: exponent of the entity degrees, larger values make bigger hubs
+    - two_entity_rate: share of the questions with two question entities
+    - questions_per_passage: consecutive questions share a passage
+    """
+    rng = np.random.default_rng(seed)
+    weights = np.arange(1, n_entities + 1, dtype=np.float64) ** -zipf_a
+    weights /= weights.sum()
+    n_question_entities = 1 + (rng.random(n_questions) < two_entity_rate)
+    question_entities = rng.choice(
+        n_entities, int(n_question_entities.sum()), p=weights
+    )
+    answer_entities = rng.choice(n_entities, n_questions, p=weights)
+    qa_data, records = [], []
+    starts = np.cumsum(n_question_entities) - n_question_entities
+    for question, (start, n) in enumerate(zip(starts, n_question_entities)):
+        entities = [f"E{entity}" for entity in question_entities[start : start + n]]
+        answer = f"E{answer_entities[question]}"
+        passage = question // questions_per_passage
+        qa_data.append(
+            {
+                "question": f"what is question {question} about {' and '.join(entities)} ?",
+                "answers": [answer],
+                "passage_id": passage,
+            }
+        )
+        records.extend(
+            {
+                "question": question,
+                "question_entity": entity,
+                "answer_entity": answer,
+                "passage": passage,
+            }
+            for entity in entities
+        )
+    return qa_data, records
+
+
+def cpu_seconds(who: int) -> float:
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_stage(name: str, fn: Callable[[], Dict]) -> Dict:
+    """
+    run fn in a forked process, so the peak memory of each stage is measured on its own.
+    fn returns the metrics of the stage, e.g. the rows of each shape. the CPU time of the stage
+    is split between its process and the worker processes it waited for, the part that does not
+    shrink with more processes.
+    """
+
+    def measured():
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_start = cpu_seconds(resource.RUSAGE_SELF)
+        start = time.perf_counter()
+        metrics = fn()
+        wall = time.perf_counter() - start
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            "stage": name,
+            "wall_s": wall,
+            "cpu_s": cpu_seconds(resource.RUSAGE_SELF) - cpu_start,
+            "workers_cpu_s": cpu_seconds(resource.RUSAGE_CHILDREN),
+            "peak_rss_mb": rss_peak / 2**10,
+            "peak_rss_increase_mb": (rss_peak - rss_start) / 2**10,
+            **metrics,
+        }
+
+    result = next(map_forked(measured, [()], 1))
+    workers = ""
+    if result["workers_cpu_s"] > 0:
+        workers = (
+            f", CPU {result['cpu_s']:.2f}s + {result['workers_cpu_s']:.2f}s in workers"
+        )
+    print(
+        f"{name:>28}: {result['wall_s']:8.2f}s, peak RSS {result['peak_rss_mb']:8.0f} MB "
+        f"(+{result['peak_rss_increase_mb']:.0f} MB){workers}"
+    )
+    return result
+
+
+def composition_stages(
+    qa_data: List[Dict], records: List[Dict], engines: List[str], args
+) -> List[Dict]:
+    def sizes(shapes: Dict) -> Dict:
+        return {"rows": {shape: len(rows) for shape, rows in shapes.items()}}
+
+    def compose(engine: str, n_processes: int = 1) -> Callable[[], Dict]:
+        return lambda: sizes(
+            composable_questions(
+                records,
+                qa_data,
+                debug=False,
+                engine=engine,
+                n_processes=n_processes,
+                ids_only=True,
+            )
+        )
+
+    def partitioned() -> Dict:
+        work_dir = tempfile.mkdtemp()
+        try:
+            paths = composable_questions_partitioned(
+                records,
+                qa_data,
+                os.path.join(work_dir, "{shape}.csv"),
+                args.memory_budget * 2**20,
+                work_dir=work_dir,
+                ids_only=True,
+            )
+            # minus the csv header
+            return sizes(
+                {
+                    shape: range(sum(1 for _ in open(path)) - 1)
+                    for shape, path in paths.items()
+                }
+            )
+        finally:
+            shutil.rmtree(work_dir)
+
+    stages = []
+    for engine in engines:
+        if engine in ("pandas", "numpy"):
+            stages.append(run_stage(f"compose:{engine}", compose(engine)))
+        elif engine == "parallel":
+            stages.append(
+                run_stage(
+                    f"compose:numpy_parallel_{args.processes}",
+                    compose("numpy", args.processes),
+                )
+            )
+        elif engine == "partitioned":
+            stages.append(run_stage("compose:partitioned", partitioned))
+        elif engine == "incremental":
+            stages.extend(incremental_stages(records, args.delta_questions))
+        else:
+            raise ValueError(f"unknown engine: {engine}")
+    return stages
+
+
+def incremental_stages(records: List[Dict], delta_questions: int) -> List[Dict]:
+    """
+    build a composition state from all but the last delta_questions questions, then add them.
+    the sets of the two stages add up to the sets of the other engines.
+    """
+    n_questions = records[-1]["question"] + 1 if records else 0
+    first_new = n_questions - delta_questions
+    state_path = tempfile.mkdtemp()
+
+    def add(records: List[Dict]) -> Callable[[], Dict]:
+        def run() -> Dict:
+            state = CompositionState(state_path)
+            sets = state.question_ids(state.add(records))
+            # question sets, as the other engines count them
+            return {"rows": {shape: len(ids) for shape, ids in sets.items()}}
+
+        return run
+
+    try:
+        return [
+            run_stage(
+                "compose:incremental_build",
+                add([r for r in records if r["question"] < first_new]),
+            ),
+            run_stage(
+                f"compose:incremental_add_{delta_questions}",
+                add([r for r in records if r["question"] >= first_new]),
+            ),
+        ]
+    finally:
+        shutil.rmtree(state_path)
+
+
+def linking_stages(qa_data: List[Dict], modes: List[str], args) -> List[Dict]:
+    def nel() -> NEL:
+        return NEL(
+            ner_model=StubNER(args.ner_latency),
+            ned_model=StubNED(
+                latency_per_call=args.ned_call_latency,
+                latency_per_mention=args.ned_mention_latency,
+            ),
+        )
+
+    def link_docs() -> Dict:
+        linker = nel()
+        questions = [qa["question"] for qa in qa_data]
+        mentions = 0
+        for start in range(0, len(questions), args.gpu_batch_size):
+            linked = linker.link_entities_in_docs(
+                questions[start : start + args.gpu_batch_size]
+            )
+            mentions += sum(len(entities) for entities in linked)
+        return {"docs": len(questions), "mentions": mentions, **asdict(linker.stats)}
+
+    def task1(mode: str) -> Callable[[], Dict]:
+        def run() -> Dict:
+            linker = nel()
+            records = link_entities(
+                qa_data,
+                "synthetic",
+                None,
+                Namespace(
+                    gpu_batch_size=args.gpu_batch_size,
+                    checkpoint_every=0,
+                    resume=False,
+                    pipeline=mode == "pipeline",
+                    prefetch=2,
+                    ned_group=args.ned_group if mode == "ned_group" else 1,
+                    context_insensitive_answers=False,
+                    answer_gazetteer=False,
+                ),
+                linker,
+            )
+            return {
+                "docs": 2 * len(qa_data),
+                "records": len(records),
+                **asdict(linker.stats),
+            }
+
+        return run
+
+    stages = [run_stage("nel:link_entities_in_docs", link_docs)]
+    for mode in modes:
+        stages.append(run_stage(f"task1:{mode}", task1(mode)))
+    for stage in stages:
+        stage["docs_per_s"] = stage["docs"] / max(stage["wall_s"], 1e-9)
+    return stages
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(previous: Dict, current: Dict):
+    """
+    print the wall time and peak memory of each stage against a previous report.
+    """
+    before = {stage["stage"]: stage for stage in previous["stages"]}
+    print(f"against {previous.get('commit')}:")
+    for stage in current["stages"]:
+        old = before.get(stage["stage"])
+        if old is None:
+            continue
+        print(
+            f"{stage['stage']:>28}: wall x{stage['wall_s'] / max(old['wall_s'], 1e-9):.2f}, "
+            f"peak RSS x{stage['peak_rss_mb'] / max(old['peak_rss_mb'], 1e-9):.2f}"
+        )
+        if stage.get("rows") != old.get("rows"):
+            print(f"{'':>28}  rows differ: {old.get('rows')} -> {stage.get('rows')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="wall time, rows per shape and peak memory of composition and linking on synthetic data"
+    )
+    parser.add_argument("--n_questions", type=int, default=20000)
+    parser.add_argument("--n_entities", type=int, default=100000)
+    parser.add_argument(
+        "--zipf_a",
+        help="exponent of the entity degrees, the sets grow much faster than the hubs so keep it below 1 unless the pool is small",
+        type=float,
+        default=0.6,
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--engines",
+        help=f", delimited composition engines out of {ENGINES}",
+        type=lambda s: [str(item) for item in s.split(",") if item],
+        default=ENGINES,
+    )
+    parser.add_argument(
+        "--processes", help="processes of the parallel engine", type=int, default=4
+    )
+    parser.add_argument(
+        "--memory_budget", help="MB of the partitioned engine", type=int, default=256
+    )
+    parser.add_argument(
+        "--delta_questions",
+        help="questions added to the state by the incremental engine",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--linking",
+        help=f", delimited task 1 modes out of {LINKING_MODES}, empty to skip linking",
+        type=lambda s: [str(item) for item in s.split(",") if item],
+        default=LINKING_MODES,
+    )
+    parser.add_argument(
+        "--linking_questions",
+        help="questions linked by the linking stages",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument("--gpu_batch_size", type=int, default=8)
+    parser.add_argument("--ned_group", type=int, default=4)
+    parser.add_argument(
+        "--ner_latency", help="seconds per doc of the stub NER", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--ned_call_latency",
+        help="seconds per call of the stub NED",
+        type=float,
+        default=0.002,
+    )
+    parser.add_argument(
+        "--ned_mention_latency",
+        help="seconds per mention of the stub NED",
+        type=float,
+        default=0.0001,
+    )
+    parser.add_argument(
+        "--questions_out",
+        help="also save the synthetic questions as jsonl, e.g. for main.py --ner stub --ned stub",
+        default=None,
+    )
+    parser.add_argument("--out", help="json report", default=None)
+    parser.add_argument(
+        "--compare", help="json report of an earlier run to compare with", default=None
+    )
+    args = parser.parse_args()
+    if "parallel" in args.engines and args.processes > len(os.sched_getaffinity(0)):
+        print(
+            f"the parallel engine runs {args.processes} processes on {len(os.sched_getaffinity(0))} CPUs"
+        )
+
+    qa_data, records = synthetic_questions(
+        args.n_questions, args.n_entities, args.zipf_a, seed=args.seed
+    )
+    print(f"{len(qa_data)} questions, {len(records)} records")
+    if args.questions_out:
+        with open(args.questions_out, mode="w", encoding="utf-8") as file:
+            for line in qa_data:
+                json.dump(line, file, ensure_ascii=False)
+                file.write("\n")
+    stages = composition_stages(qa_data, records, args.engines, args)
+    if args.linking:
+        stages += linking_stages(qa_data[: args.linking_questions], args.linking, args)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpus": len(os.sched_getaffinity(0)),
+        "config": vars(args),
+        "stages": stages,
+    }
+    if args.out:
+        with open(args.out, mode="w", encoding="utf-8") as file:
+            json.dump(report, file, indent=1)
+    else:
+        print(json.dumps(report))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            compare(json.load(file), report)
@@ -0,0 +1,89 @@
+import argparse
+import json
+import time
+import numpy as np
+from typing import Dict, List
+from entity_linking.entity_index import EntityIndex, exact_search
+
+
+def benchmark_entity_index(
+    encodings: np.ndarray,
+    index: EntityIndex,
+    queries: np.ndarray,
+    top_k: int = 10,
+    n_probes: List[int] = (1, 4, 16, 64),
+) -> List[Dict]:
+    """
+    recall@top_k and latency of the approximate search for each n_probe, against exact search
+    over the original float encodings.
+    """
+    start = time.perf_counter()
+    _, truth = exact_search(encodings, queries, top_k)
+    rows = [
+        {
+            "search": "exact",
+            "recall": 1.0,
+            "ms_per_query": 1000 * (time.perf_counter() - start) / len(queries),
+        }
+    ]
+    for n_probe in n_probes:
+        index.n_probe = n_probe
+        start = time.perf_counter()
+        _, found = index.search_knn(queries, top_k)
+        elapsed = time.perf_counter() - start
+        hits = sum(len(np.intersect1d(t, f)) for t, f in zip(truth, found))
+        rows.append(
+            {
+                "search": f"ivf n_probe={n_probe}",
+                "recall": hits / truth.size,
+                "ms_per_query": 1000 * elapsed / len(queries),
+            }
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="recall vs latency of the approximate entity index against exact search"
+    )
+    parser.add_argument(
+        "--encodings", required=True, help=".npy matrix of the original encodings"
+    )
+    parser.add_argument(
+        "--index", required=True, help="directory written by build_entity_index"
+    )
+    parser.add_argument(
+        "--queries",
+        help=".npy matrix of query (mention context) encodings. default is perturbed entity encodings",
+        default=None,
+    )
+    parser.add_argument("--n_queries", type=int, default=200)
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument(
+        "--n_probes",
+        type=lambda s: [int(item) for item in s.split(",")],
+        default=[1, 4, 16, 64],
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    encodings = np.load(args.encodings, mmap_mode="r")
+    if args.queries:
+        queries = np.load(args.queries)[: args.n_queries]
+    else:
+        rng = np.random.default_rng(args.seed)
+        queries = np.asarray(
+            encodings[
+                np.sort(rng.choice(len(encodings), args.n_queries, replace=False))
+            ],
+            dtype=np.float32,
+        )
+        queries += rng.normal(0, queries.std(), queries.shape).astype(np.float32)
+    rows = benchmark_entity_index(
+        encodings, EntityIndex(args.index), queries, args.top_k, args.n_probes
+    )
+    for row in rows:
+        print(
+            f"{row['search']:>18}: recall@{args.top_k} {row['recall']:.3f}, {row['ms_per_query']:.2f} ms/query"
+        )
+    print(json.dumps(rows))
@@ -0,0 +1,93 @@
+import pandas as pd
+from typing import Dict, List, Union
+
+
+def to_arrow_table(data: Union[pd.DataFrame, List[Dict]], schema=None):
+    """
+    convert a frame or a list of dictionaries to an arrow table, entity columns are dictionary
+    encoded since a few frequent entities fill most of their rows.
+    """
+    import pyarrow as pa
+
+    if isinstance(data, pd.DataFrame):
+        table = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+    else:
+        table = pa.Table.from_pylist(data, schema=schema)
+    if schema is not None:
+        return table
+    for i, name in enumerate(table.column_names):
+        column = table.column(i)
+        if "entity" in name and not pa.types.is_dictionary(column.type):
+            table = table.set_column(i, name, column.dictionary_encode())
+    return table
+
+
+class TableWriter:
+    """
+    write a table to a parquet file or an arrow ipc stream one batch at a time,
+    every batch must have the columns of the first one. the stream format is used for arrow
+    because ipc files cannot replace the dictionaries of entity columns between batches.
+
+    Args:
+    - file_path: output file
+    - output_format: "parquet" or "arrow"
+    """
+
+    def __init__(self, file_path: str, output_format: str) -> None:
+        if output_format not in ("parquet", "arrow"):
+            raise ValueError(f"unknown columnar format: {output_format}")
+        self.file_path = file_path
+        self.output_format = output_format
+        self.schema = None
+        self._writer = None
+
+    def write(self, data: Union[pd.DataFrame, List[Dict]]):
+        if not len(data):
+            return
+        table = to_arrow_table(data, self.schema)
+        if self._writer is None:
+            self._open(table.schema)
+        self._writer.write_table(table)
+
+    def _open(self, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.schema = schema
+        if self.output_format == "parquet":
+            self._writer = pq.ParquetWriter(self.file_path, schema)
+        else:
+            self._writer = pa.ipc.new_stream(self.file_path, schema)
+
+    def close(self, empty: Union[pd.DataFrame, List[Dict]] = None):
+        """
+        close the file, when nothing was written the schema is taken from `empty` if it is given.
+        """
+        if self._writer is None:
+            self._open(to_arrow_table(empty if empty is not None else []).schema)
+        self._writer.close()
+
+
+def write_table(
+    data: Union[pd.DataFrame, List[Dict]], file_path: str, output_format: str
+):
+    writer = TableWriter(file_path, output_format)
+    writer.write(data)
+    writer.close(data)
+
+
+def read_table(file_path: str, output_format: str) -> List[Dict]:
+    """
+    read a table written by `write_table` or `TableWriter` back as a list of dictionaries.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if output_format == "parquet":
+        table = pq.read_table(file_path)
+    elif output_format == "arrow":
+        with pa.ipc.open_stream(file_path) as reader:
+            table = reader.read_all()
+    else:
+        raise ValueError(f"unknown columnar format: {output_format}")
+    return table.to_pylist()
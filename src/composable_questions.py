@@ -1,6 +1,8 @@
 import json
 import pandas as pd
 from typing import Dict, List
+from adjacency_index import Sampling, find_composable_sets
+from metrics import Metrics, measure
 
 
 def to_jsonl(data: List[Dict], file_path: str):
@@ -165,6 +167,38 @@ def filter_identical_heads(df: pd.DataFrame) -> pd.DataFrame:
     ]
 
 
+def keep_canonical_head_pairs(df: pd.DataFrame) -> pd.DataFrame:
+    # (head1, head2) and (head2, head1) are the same set, keep the one with the heads in question order
+    return df[df["question_head1"] < df["question_head2"]]
+
+
+def measured_filter(
+    df: pd.DataFrame, metrics: Metrics, stage: str, filter_fn, **kwargs
+) -> pd.DataFrame:
+    """
+    `filter_fn(df, **kwargs)` with its input rows, output rows and time measured as `stage`.
+    """
+    with measure(metrics, stage) as counters:
+        filtered = filter_fn(df, **kwargs)
+        counters.update(input_rows=len(df), output_rows=len(filtered))
+    return filtered
+
+
+def swap_adjacent_heads(df: pd.DataFrame) -> pd.DataFrame:
+    swapped = {}
+    for col in df.columns:
+        if col.endswith("_head1"):
+            swapped[col] = col[: -len("1")] + "2"
+        elif col.endswith("_head2"):
+            swapped[col] = col[: -len("2")] + "1"
+        elif col != "question_tail" and col.endswith("_tail"):
+            prefix = col[: -len("_tail")]
+            swapped[col] = (
+                prefix[:-1] + "_tail" if prefix.endswith("2") else prefix + "2_tail"
+            )
+    return df.rename(swapped, axis=1)[df.columns]
+
+
 def rename_mid_node(df: pd.DataFrame, suffix: str) -> pd.DataFrame:
     return df.rename(
         {
@@ -180,13 +214,23 @@ def rename_mid_node(df: pd.DataFrame, suffix: str) -> pd.DataFrame:
     )
 
 
-def restore_questions_info(df: pd.DataFrame, data: List[Dict]) -> List[Dict]:
+def question_ids(df: pd.DataFrame) -> pd.DataFrame:
     question_ids_cols = [
         col for col in df.columns if col.startswith("question") and "entity" not in col
     ]
-    df = df[question_ids_cols].drop_duplicates()
+    return df[question_ids_cols].drop_duplicates().reset_index(drop=True)
+
+
+def restore_questions_info(df: pd.DataFrame, data: List[Dict]) -> List[Dict]:
+    return questions_info(question_ids(df), data)
+
+
+def questions_info(df: pd.DataFrame, data: List[Dict]) -> List[Dict]:
+    """
+    replace the question ids of sets returned by `question_ids` with the questions.
+    """
     df_questions_with_info = pd.DataFrame()
-    for col in question_ids_cols:
+    for col in df.columns:
         df_questions_with_info[col] = df[col].map(lambda x: data[x])
 
     return df_questions_with_info.to_dict(orient="records")
@@ -198,7 +242,15 @@ def save_debugging_info(df_dict: Dict):
 
 
 def composable_questions(
-    records_of_entities: List[Dict], qa_data: List[Dict], debug: bool = True
+    records_of_entities: List[Dict],
+    qa_data: List[Dict],
+    debug: bool = True,
+    engine: str = "pandas",
+    n_processes: int = 1,
+    sampling: Sampling = None,
+    rejected: Dict[str, Dict[str, int]] = None,
+    ids_only: bool = False,
+    metrics: Metrics = None,
 ) -> Dict:
     """
     find sets of composable questions from a large pool of single-hop questions.
@@ -218,62 +270,177 @@ def composable_questions(
     - records_of_entities: list of dictionaries for each per of question and answer entities [{"question":x,"question_entity": e1.id ,"answer_entity":e2.id, "passage":123},{"question":x,"question_entity": e3.id ,"answer_entity":e2.id, "passage":123}..]
     - qa_data: list of dictionaries, each contains a question, answer and passage
     - debug: if True will save additional info that is helpful for debugging
+    - engine: "pandas" chains DataFrame merges, "numpy" enumerates the shapes over integer-encoded adjacency arrays. both give the same output
+    - n_processes: number of processes the numpy engine spreads the joins over, the output does not depend on it
+    - sampling: fan-out and per-shape caps for the numpy engine, the skipped candidates of each hub are reported back in it
+    - rejected: optional dict the numpy engine fills with {shape: {filter: rejected candidate rows}}
+    - ids_only: if True each shape is returned as a frame of question indexes into qa_data instead of copies of the questions, see `question_sets.py`
+    - metrics: optional `metrics.Metrics` that gets the input rows, output rows and time of every shape (`task2/<shape>`), of every filter (`task2/<shape>/<filter>`, the pandas engine checks the conditions of a cycle as one filter), of deduplicating the question ids of the sets (`task2/question_ids`) and of restoring the questions
     """
     df = pd.DataFrame(records_of_entities)
+    shapes = {} if debug else None
+    if engine == "numpy":
+        ids = find_composable_sets(
+            df, n_processes, sampling, rejected, metrics, frames=shapes
+        )
+    elif engine == "pandas":
+        if n_processes > 1:
+            raise ValueError("the pandas engine runs on a single process")
+        if sampling is not None:
+            raise ValueError("sampling caps are only supported by the numpy engine")
+        if rejected is not None:
+            raise ValueError("filter counters are only supported by the numpy engine")
+        frames = find_composable_frames_with_merges(df, metrics)
+        if debug:
+            shapes.update(frames)
+        ids = {}
+        for shape, v in frames.items():
+            with measure(metrics, "task2/question_ids") as counters:
+                ids[shape] = question_ids(v)
+                counters.update(input_rows=len(v), output_rows=len(ids[shape]))
+        del frames
+    else:
+        raise ValueError(f"unknown engine: {engine}")
+
+    if debug:
+        save_debugging_info(shapes)
+        to_jsonl(qa_data, "debug_info.jsonl")
+
+    if ids_only:
+        return ids
+    sets = {}
+    for shape, v in ids.items():
+        with measure(metrics, "task2/restore_questions_info") as counters:
+            sets[shape] = questions_info(v, qa_data)
+            counters.update(input_rows=len(v), output_rows=len(sets[shape]))
+    return sets
+
+
+def find_composable_frames_with_merges(
+    df: pd.DataFrame, metrics: Metrics = None
+) -> Dict[str, pd.DataFrame]:
     # 0--->0
-    df_2hop = df.pipe(find_init_two_hop_questions).pipe(
-        filter_questions_where_head_and_tail_form_cycle
-    )
+    with measure(metrics, "task2/2hop") as counters:
+        df_2hop = df.pipe(find_init_two_hop_questions).pipe(
+            measured_filter,
+            metrics,
+            "task2/2hop/cycle(head, tail)",
+            filter_questions_where_head_and_tail_form_cycle,
+        )
+        counters.update(left_rows=len(df), right_rows=len(df), output_rows=len(df_2hop))
     # 0--->0<---0
-    df_2hop_with_adjacent_head = df_2hop.pipe(find_adjacent_head).pipe(
-        filter_identical_heads
-    )
+    with measure(metrics, "task2/2hop_with_adjacent_head") as counters:
+        df_2hop_with_adjacent_head = (
+            df_2hop.pipe(find_adjacent_head)
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/2hop_with_adjacent_head/identical_heads(head1, head2)",
+                filter_identical_heads,
+            )
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/2hop_with_adjacent_head/unordered_duplicate(head1, head2)",
+                keep_canonical_head_pairs,
+            )
+        )
+        counters.update(
+            left_rows=len(df_2hop),
+            right_rows=len(df_2hop),
+            output_rows=len(df_2hop_with_adjacent_head),
+        )
     # 0--->0--->0
-    df_3hop = df_2hop.pipe(find_multi_hop_questions).pipe(
-        filter_questions_where_head_and_tail_form_cycle
-    )
+    with measure(metrics, "task2/3hop") as counters:
+        df_3hop = df_2hop.pipe(find_multi_hop_questions).pipe(
+            measured_filter,
+            metrics,
+            "task2/3hop/cycle(head, tail)",
+            filter_questions_where_head_and_tail_form_cycle,
+        )
+        counters.update(
+            left_rows=len(df_2hop), right_rows=len(df_2hop), output_rows=len(df_3hop)
+        )
     # 0--->0--->0<---0
-    df_3hop_with_adjacent_head = (
-        df_2hop_with_adjacent_head.pipe(
-            find_multi_hop_questions, tails_df=df_2hop, hops=4
+    with measure(metrics, "task2/3hop_with_adjacent_head") as counters:
+        df_3hop_with_adjacent_head = (
+            df_2hop_with_adjacent_head.pipe(
+                find_multi_hop_questions, tails_df=df_2hop, hops=4
+            )
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/3hop_with_adjacent_head/cycle(head1, tail)",
+                filter_questions_where_head_and_tail_form_cycle,
+                head_suffix="_head1",
+            )
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/3hop_with_adjacent_head/cycle(head2, tail)",
+                filter_questions_where_head_and_tail_form_cycle,
+                head_suffix="_head2",
+            )
+        )
+        counters.update(
+            left_rows=len(df_2hop_with_adjacent_head),
+            right_rows=len(df_2hop),
+            output_rows=len(df_3hop_with_adjacent_head),
         )
-        .pipe(filter_questions_where_head_and_tail_form_cycle, head_suffix="_head1")
-        .pipe(filter_questions_where_head_and_tail_form_cycle, head_suffix="_head2")
-    )
     # 0--->
     #       0--->0
     # 0--->
-    df_3hop_with_adjacent_head2 = df_2hop_with_adjacent_head.pipe(
-        find_multi_hop_questions, tails_df=df_2hop, hops=4, switch=True
-    ).pipe(filter_questions_where_head_and_tail_form_cycle)
+    # either head of the canonical pair can continue the 2hop, so both orders are joined
+    with measure(metrics, "task2/3hop_with_adjacent_head2") as counters:
+        df_3hop_with_adjacent_head2 = (
+            pd.concat(
+                [
+                    df_2hop_with_adjacent_head,
+                    swap_adjacent_heads(df_2hop_with_adjacent_head),
+                ],
+                ignore_index=True,
+            )
+            .pipe(find_multi_hop_questions, tails_df=df_2hop, hops=4, switch=True)
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/3hop_with_adjacent_head2/cycle(head, tail)",
+                filter_questions_where_head_and_tail_form_cycle,
+            )
+        )
+        counters.update(
+            left_rows=len(df_2hop),
+            right_rows=2 * len(df_2hop_with_adjacent_head),
+            output_rows=len(df_3hop_with_adjacent_head2),
+        )
     # 0--->0--->0--->0
-    df_4hop = (
-        df_3hop.pipe(rename_mid_node, suffix="_mid0")
-        .pipe(find_multi_hop_questions, tails_df=df_2hop, hops=4)
-        .pipe(filter_questions_where_head_and_tail_form_cycle)
-        .pipe(
-            filter_questions_where_head_and_tail_form_cycle_loop_v, head_suffix="_mid0"
+    with measure(metrics, "task2/4hop") as counters:
+        df_4hop = (
+            df_3hop.pipe(rename_mid_node, suffix="_mid0")
+            .pipe(find_multi_hop_questions, tails_df=df_2hop, hops=4)
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/4hop/cycle(head, tail)",
+                filter_questions_where_head_and_tail_form_cycle,
+            )
+            .pipe(
+                measured_filter,
+                metrics,
+                "task2/4hop/cycle(mid0, tail)",
+                filter_questions_where_head_and_tail_form_cycle_loop_v,
+                head_suffix="_mid0",
+            )
         )
-    )
-
-    if debug:
-        save_debugging_info(
-            {
-                "2hop": df_2hop,
-                "2hop_with_adjacent_head": df_2hop_with_adjacent_head,
-                "3hop": df_3hop,
-                "3hop_with_adjacent_head": df_3hop_with_adjacent_head,
-                "3hop_with_adjacent_head2": df_3hop_with_adjacent_head2,
-                "4hop": df_4hop,
-            }
+        counters.update(
+            left_rows=len(df_3hop), right_rows=len(df_2hop), output_rows=len(df_4hop)
         )
-        to_jsonl(qa_data, "debug_info.jsonl")
 
     return {
-        "2hop": restore_questions_info(df_2hop, qa_data),
-        "2hop_with_adjacent_head": restore_questions_info(df_2hop_with_adjacent_head, qa_data),
-        "3hop": restore_questions_info(df_3hop, qa_data),
-        "3hop_with_adjacent_head": restore_questions_info(df_3hop_with_adjacent_head, qa_data),
-        "3hop_with_adjacent_head2": restore_questions_info(df_3hop_with_adjacent_head2, qa_data),
-        "4hop": restore_questions_info(df_4hop, qa_data),
+        "2hop": df_2hop,
+        "2hop_with_adjacent_head": df_2hop_with_adjacent_head,
+        "3hop": df_3hop,
+        "3hop_with_adjacent_head": df_3hop_with_adjacent_head,
+        "3hop_with_adjacent_head2": df_3hop_with_adjacent_head2,
+        "4hop": df_4hop,
     }
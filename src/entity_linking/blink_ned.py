@@ -0,0 +1,182 @@
+import blink.main_dense as main_dense
+import argparse
+import json
+import torch
+from .entity_catalogue import EntityCatalogue
+from .entity_index import EntityIndex
+from .model_skeletons import LinkedMention, NED
+
+
+class BlinkNED(NED):
+    """
+    Named Entity Disambiguation
+    """
+
+    def __init__(
+        self,
+        model_path="/home/bodor/models/BLINK/models/",
+        no_cuda=False,
+        entity_index: str = None,
+        n_probe: int = 16,
+        fast: bool = False,
+        entity_catalogue: str = None,
+    ) -> None:
+        """
+        Args:
+        - model_path: directory of the BLINK models and entity catalogue
+        - no_cuda: run the bi-encoder and cross-encoder on the CPU even when CUDA is available,
+            needed before the process is forked
+        - entity_index: directory written by `entity_index.build_entity_index`, candidates are then
+            retrieved from its memory-mapped quantized vectors instead of all_entities_large.t7
+        - n_probe: inverted lists scanned per mention with entity_index
+        - fast: skip the cross-encoder and keep the bi-encoder ranking
+        - entity_catalogue: directory written by `entity_catalogue.build_entity_catalogue`, titles,
+            texts and ids are then looked up in its memory-mapped tables instead of dictionaries
+        """
+        self.config = {
+            "test_entities": None,
+            "test_mentions": None,
+            "interactive": False,
+            "top_k": 1,
+            "biencoder_model": model_path + "biencoder_wiki_large.bin",
+            "biencoder_config": model_path + "biencoder_wiki_large.json",
+            "entity_catalogue": model_path + "entity.jsonl",
+            "entity_encoding": model_path + "all_entities_large.t7",
+            "crossencoder_model": model_path + "crossencoder_wiki_large.bin",
+            "crossencoder_config": model_path + "crossencoder_wiki_large.json",
+            "fast": fast,  # set this to be true if speed is a concern
+            "output_path": "logs/",  # logging directory
+        }
+        self.args = argparse.Namespace(**self.config)
+        self.entity_index = entity_index
+        self.entity_catalogue = entity_catalogue
+        self.no_cuda = no_cuda
+        catalogue = EntityCatalogue(entity_catalogue) if entity_catalogue else None
+        if entity_index is None and catalogue is None and not no_cuda:
+            self.models = main_dense.load_models(self.args, logger=None)
+        else:
+            self.models = self._load_models(
+                EntityIndex(entity_index, n_probe) if entity_index else None,
+                catalogue,
+            )
+        self.title2id = self.models[5]
+        # the gazetteer searches the aliases of a compact catalogue in place
+        self.alias2title = catalogue.alias2title if catalogue is not None else None
+
+    def _load_models(
+        self, index: EntityIndex = None, catalogue: EntityCatalogue = None
+    ) -> tuple:
+        """
+        `main_dense.load_models` with the dense entity encodings replaced by an index, which is
+        passed to BLINK in place of a faiss indexer, and/or the catalogue dictionaries replaced
+        by the mappings of a compact catalogue. BLINK's rankers read the device from no_cuda.
+        """
+        with open(self.args.biencoder_config) as json_file:
+            biencoder_params = json.load(json_file)
+            biencoder_params["path_to_model"] = self.args.biencoder_model
+            biencoder_params["no_cuda"] = self.no_cuda
+        biencoder = main_dense.load_biencoder(biencoder_params)
+        crossencoder, crossencoder_params = None, None
+        if not self.args.fast:
+            with open(self.args.crossencoder_config) as json_file:
+                crossencoder_params = json.load(json_file)
+                crossencoder_params["path_to_model"] = self.args.crossencoder_model
+                crossencoder_params["no_cuda"] = self.no_cuda
+            crossencoder = main_dense.load_crossencoder(crossencoder_params)
+
+        candidate_encoding = (
+            torch.load(self.args.entity_encoding) if index is None else None
+        )
+        if catalogue is not None:
+            return (
+                biencoder,
+                biencoder_params,
+                crossencoder,
+                crossencoder_params,
+                candidate_encoding,
+                catalogue.title2id,
+                catalogue.id2title,
+                catalogue.id2text,
+                catalogue.wikipedia_id2local_id,
+                index,
+            )
+
+        # same catalogue parsing as main_dense._load_candidates
+        title2id, id2title, id2text, wikipedia_id2local_id = {}, {}, {}, {}
+        with open(self.args.entity_catalogue, "r") as fin:
+            for local_idx, line in enumerate(fin):
+                entity = json.loads(line)
+                if "idx" in entity:
+                    split = entity["idx"].split("curid=")
+                    wikipedia_id = (
+                        int(split[-1].strip())
+                        if len(split) > 1
+                        else entity["idx"].strip()
+                    )
+                    wikipedia_id2local_id[wikipedia_id] = local_idx
+                title2id[entity["title"]] = local_idx
+                id2title[local_idx] = entity["title"]
+                id2text[local_idx] = entity["text"]
+        return (
+            biencoder,
+            biencoder_params,
+            crossencoder,
+            crossencoder_params,
+            candidate_encoding,
+            title2id,
+            id2title,
+            id2text,
+            wikipedia_id2local_id,
+            index,
+        )
+
+    def identity(self) -> str:
+        identity = f"BlinkNED:{self.config['biencoder_model']}:{self.config['crossencoder_model']}:fast={self.config['fast']}"
+        if self.entity_index is not None:
+            identity += f":index={self.entity_index}:n_probe={self.models[9].n_probe}"
+        # the links are titles of the catalogue, a rebuilt catalogue usually changes its size
+        catalogue = self.entity_catalogue or self.config["entity_catalogue"]
+        identity += f":catalogue={catalogue}:entities={len(self.models[6])}"
+        return identity
+
+    @staticmethod
+    def model_input_formatting(mention_surfaceform, context, other_info):
+        return {
+            "mention": mention_surfaceform,
+            "context_left": context[: other_info.start],
+            "context_right": context[other_info.end :],
+            "label": "unknown",
+            "label_id": -1,
+        }
+
+    def model_output_formatting(self, mention_ned_result, mention_ner_result):
+        e = LinkedMention(
+            id=self.title2id[mention_ned_result[0]],
+            title=mention_ned_result[0],
+            mention=mention_ner_result.text,
+            label=mention_ner_result.label,
+        )
+        return e
+
+    def mention_input_length(self, mention_input) -> int:
+        return len(
+            " ".join(
+                [
+                    mention_input["context_left"],
+                    mention_input["mention"],
+                    mention_input["context_right"],
+                ]
+            ).split()
+        )
+
+    def disambiguate_mentions_in_docs(self, mentions_batch):
+        (
+            _,
+            _,
+            _,
+            _,
+            _,
+            predictions,
+            scores,
+        ) = main_dense.run(self.args, None, *self.models, test_data=mentions_batch)
+        return predictions
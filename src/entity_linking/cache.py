@@ -0,0 +1,128 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Dict, List, Optional
+from .model_skeletons import LinkedMention
+
+
+class EntityLinkCache:
+    """
+    persistent cache of the entities linked in a doc, keyed by the normalized text of the doc and
+    the identity of the NER/NED models. an in-memory LRU sits in front of the sqlite file.
+
+    Args:
+    - path: sqlite file, created if it does not exist
+    - model_identity: identifies the NER/NED models, see `NEL.identity`
+    - lru_size: number of docs kept in memory
+    """
+
+    # sqlite limits the number of variables of a statement
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, path: str, model_identity: str, lru_size: int = 100000) -> None:
+        self.path = path
+        self.model_identity = model_identity
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # NER and NED stages of a pipeline use the cache from different threads
+        self.lock = threading.Lock()
+        # the workers of main.py --workers write to the same file
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS links (key TEXT PRIMARY KEY, entities TEXT)"
+        )
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def key(self, doc: str, mode: str = "") -> str:
+        text = self.model_identity + mode + "\0" + self.normalize(doc)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, entities: List[LinkedMention]):
+        self.lru[key] = entities
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get_many(
+        self, docs: List[str], mode: str = ""
+    ) -> List[Optional[List[LinkedMention]]]:
+        """
+        the cached entities of each doc, None for the docs that were never linked.
+        docs linked in different modes of the same models are cached under different `mode`s.
+        """
+        with self.lock:
+            return self._get_many(docs, mode)
+
+    def _get_many(
+        self, docs: List[str], mode: str = ""
+    ) -> List[Optional[List[LinkedMention]]]:
+        keys = [self.key(doc, mode) for doc in docs]
+        found = {}
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+        on_disk = list({key for key in keys if key not in found})
+        read_from_disk = set()
+        for start in range(0, len(on_disk), self.QUERY_BATCH_SIZE):
+            batch = on_disk[start : start + self.QUERY_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT key, entities FROM links WHERE key IN ({','.join('?' * len(batch))})",
+                batch,
+            )
+            for key, entities in rows:
+                found[key] = [LinkedMention(**e) for e in json.loads(entities)]
+                read_from_disk.add(key)
+                self._remember(key, found[key])
+
+        results = []
+        for key in keys:
+            if key not in found:
+                self.misses += 1
+            elif key in read_from_disk:
+                self.disk_hits += 1
+            else:
+                self.memory_hits += 1
+            results.append(found.get(key))
+        return results
+
+    def put_many(
+        self, docs: List[str], results: List[List[LinkedMention]], mode: str = ""
+    ):
+        with self.lock:
+            self._put_many(docs, results, mode)
+
+    def _put_many(
+        self, docs: List[str], results: List[List[LinkedMention]], mode: str = ""
+    ):
+        rows = []
+        for doc, entities in zip(docs, results):
+            key = self.key(doc, mode)
+            self._remember(key, entities)
+            rows.append((key, json.dumps([asdict(e) for e in entities])))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO links (key, entities) VALUES (?, ?)", rows
+        )
+        self.connection.commit()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "lookups": lookups,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import numpy as np
+import string
+from collections.abc import Mapping
+from typing import Iterator, List, Optional
+
+
+def _write_strings(strings: List[str], path: str, name: str):
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    with open(os.path.join(path, name + ".bin"), mode="wb") as file:
+        for i, string in enumerate(strings):
+            encoded = string.encode("utf-8")
+            file.write(encoded)
+            offsets[i + 1] = offsets[i] + len(encoded)
+    np.save(os.path.join(path, name + "_offsets.npy"), offsets)
+
+
+def normalize_alias(title: str) -> str:
+    """
+    alias of a title: its casefolded form without surrounding punctuation.
+    """
+    return " ".join(title.split()).strip(string.punctuation + " ").casefold()
+
+
+def _write_aliases(titles: List[str], path: str):
+    # aliases shared by different titles are dropped, they cannot be resolved without the models
+    aliases, ambiguous = {}, set()
+    for local_idx, title in enumerate(titles):
+        alias = normalize_alias(title)
+        if titles[aliases.setdefault(alias, local_idx)] != title:
+            ambiguous.add(alias)
+    encoded = sorted(
+        (alias.encode("utf-8"), local_idx)
+        for alias, local_idx in aliases.items()
+        if alias not in ambiguous
+    )
+    _write_strings([alias.decode("utf-8") for alias, _ in encoded], path, "aliases")
+    np.save(
+        os.path.join(path, "alias_ids.npy"),
+        np.array([local_idx for _, local_idx in encoded], dtype=np.int64),
+    )
+
+
+def build_entity_catalogue(entity_catalogue: str, path: str):
+    """
+    convert BLINK's entity.jsonl once into read-only string tables: the utf-8 titles and texts
+    concatenated in local id order with their offsets, the local id of every distinct title sorted
+    by title for binary search, the wikipedia ids sorted with their local ids, and the sorted unambiguous aliases
+    of the titles with the local id of their title.
+    """
+    os.makedirs(path, exist_ok=True)
+    titles, texts, wikipedia_ids, local_ids = [], [], [], []
+    # same parsing as main_dense._load_candidates
+    with open(entity_catalogue, "r") as fin:
+        for local_idx, line in enumerate(fin):
+            entity = json.loads(line)
+            split = entity.get("idx", "").split("curid=")
+            if len(split) > 1:
+                wikipedia_ids.append(int(split[-1].strip()))
+                local_ids.append(local_idx)
+            titles.append(entity["title"])
+            texts.append(entity["text"])
+    _write_strings(titles, path, "titles")
+    _write_strings(texts, path, "texts")
+    del texts
+    _write_aliases(titles, path)
+
+    encoded = np.array([title.encode("utf-8") for title in titles], dtype=object)
+    # stable, so the last of duplicate titles is kept, as in BLINK's title2id
+    order = np.argsort(encoded, kind="stable")
+    sorted_titles = encoded[order]
+    last = np.r_[sorted_titles[1:] != sorted_titles[:-1], True]
+    np.save(os.path.join(path, "title_order.npy"), order[last].astype(np.int64))
+    wikipedia_ids = np.array(wikipedia_ids, dtype=np.int64)
+    order = np.argsort(wikipedia_ids, kind="stable")
+    np.save(os.path.join(path, "wikipedia_ids.npy"), wikipedia_ids[order])
+    np.save(
+        os.path.join(path, "wikipedia_local_ids.npy"),
+        np.array(local_ids, dtype=np.int64)[order],
+    )
+
+
+class StringTable:
+    """
+    memory-mapped strings written by `_write_strings`, indexed by local id.
+    """
+
+    def __init__(self, path: str, name: str) -> None:
+        self.data = np.memmap(
+            os.path.join(path, name + ".bin"), dtype=np.uint8, mode="r"
+        )
+        self.offsets = np.load(os.path.join(path, name + "_offsets.npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def raw(self, i: int) -> bytes:
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < len(self):
+            raise KeyError(i)
+        return self.raw(i).decode("utf-8")
+
+
+def _rightmost(table: StringTable, order: np.ndarray, key: bytes) -> Optional[int]:
+    # position of the last string equal to key, order lists the rows of table in sorted order
+    low, high = 0, len(order)
+    # rightmost position whose string is <= key
+    while low < high:
+        middle = (low + high) // 2
+        if table.raw(int(order[middle])) <= key:
+            low = middle + 1
+        else:
+            high = middle
+    if low == 0 or table.raw(int(order[low - 1])) != key:
+        return None
+    return low - 1
+
+
+class _ById(Mapping):
+    def __init__(self, table: StringTable) -> None:
+        self.table = table
+
+    def __getitem__(self, i: int) -> str:
+        return self.table[int(i)]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(len(self.table)))
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+
+class _TitleToId(Mapping):
+    def __init__(self, catalogue: "EntityCatalogue") -> None:
+        self.catalogue = catalogue
+
+    def __getitem__(self, title: str) -> int:
+        i = self.catalogue.id_of(title)
+        if i is None:
+            raise KeyError(title)
+        return i
+
+    def __iter__(self) -> Iterator[str]:
+        titles = self.catalogue.titles
+        return (titles[int(i)] for i in self.catalogue.title_order)
+
+    def __len__(self) -> int:
+        return len(self.catalogue.title_order)
+
+
+class _WikipediaToLocal(Mapping):
+    def __init__(self, catalogue: "EntityCatalogue") -> None:
+        self.catalogue = catalogue
+
+    def __getitem__(self, wikipedia_id: int) -> int:
+        ids = self.catalogue.wikipedia_ids
+        i = np.searchsorted(ids, wikipedia_id, side="right") - 1
+        if i < 0 or ids[i] != wikipedia_id:
+            raise KeyError(wikipedia_id)
+        return int(self.catalogue.wikipedia_local_ids[i])
+
+    def __iter__(self) -> Iterator[int]:
+        return (int(i) for i in self.catalogue.wikipedia_ids)
+
+    def __len__(self) -> int:
+        return len(self.catalogue.wikipedia_ids)
+
+
+class _AliasToTitle(Mapping):
+    def __init__(self, catalogue: "EntityCatalogue") -> None:
+        self.catalogue = catalogue
+
+    def __getitem__(self, alias: str) -> str:
+        catalogue = self.catalogue
+        i = _rightmost(
+            catalogue.aliases, range(len(catalogue.aliases)), alias.encode("utf-8")
+        )
+        if i is None:
+            raise KeyError(alias)
+        return catalogue.titles[int(catalogue.alias_ids[i])]
+
+    def __iter__(self) -> Iterator[str]:
+        aliases = self.catalogue.aliases
+        return (aliases[i] for i in range(len(aliases)))
+
+    def __len__(self) -> int:
+        return len(self.catalogue.aliases)
+
+
+class EntityCatalogue:
+    """
+    read-only entity catalogue written by `build_entity_catalogue`. every table is memory mapped,
+    so all processes share the same pages, and titles are found by binary search.
+    `title2id`, `id2title`, `id2text` and `wikipedia_id2local_id` are mappings that can replace
+    the dictionaries of BLINK's `main_dense.load_models`, `alias2title` is the alias index of
+    `gazetteer.Gazetteer`.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.titles = StringTable(path, "titles")
+        self.texts = StringTable(path, "texts")
+        self.title_order = np.load(os.path.join(path, "title_order.npy"), mmap_mode="r")
+        self.wikipedia_ids = np.load(
+            os.path.join(path, "wikipedia_ids.npy"), mmap_mode="r"
+        )
+        self.wikipedia_local_ids = np.load(
+            os.path.join(path, "wikipedia_local_ids.npy"), mmap_mode="r"
+        )
+        self.aliases = StringTable(path, "aliases")
+        self.alias_ids = np.load(os.path.join(path, "alias_ids.npy"), mmap_mode="r")
+        self.title2id = _TitleToId(self)
+        self.id2title = _ById(self.titles)
+        self.id2text = _ById(self.texts)
+        self.wikipedia_id2local_id = _WikipediaToLocal(self)
+        self.alias2title = _AliasToTitle(self)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def id_of(self, title: str) -> Optional[int]:
+        """
+        local id of a title, the last one for duplicate titles. O(log n) comparisons.
+        """
+        i = _rightmost(self.titles, self.title_order, title.encode("utf-8"))
+        return None if i is None else int(self.title_order[i])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="convert BLINK's entity.jsonl to a compact memory-mapped catalogue"
+    )
+    parser.add_argument("--entity_catalogue", required=True, help="entity.jsonl")
+    parser.add_argument("--out", required=True, help="catalogue directory")
+    args = parser.parse_args()
+    build_entity_catalogue(args.entity_catalogue, args.out)
@@ -0,0 +1,295 @@
+import argparse
+import json
+import os
+import numpy as np
+from typing import Tuple
+
+# rows of the encoding matrix processed at a time when building or scanning an index
+CHUNK_ROWS = 2**16
+# bytes of scores and gathered rows k-means holds at a time, per block of rows
+KMEANS_MEMORY_BUDGET = 2**28
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    returns the quantized rows and the scale of each row, int8 rows are scaled symmetrically
+    by their largest absolute value.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        quantized = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+    if dtype in ("float16", "float32"):
+        return vectors.astype(dtype), np.ones(len(vectors), dtype=np.float32)
+    raise ValueError(f"unknown dtype: {dtype}")
+
+
+def _block_rows(n_lists: int, dim: int, memory_budget: int) -> int:
+    # a block holds its float32 scores against every centroid and a sorted copy of its rows
+    return max(1, memory_budget // (4 * (n_lists + dim)))
+
+
+def nearest_centroids(
+    vectors: np.ndarray,
+    centroids: np.ndarray,
+    memory_budget: int = KMEANS_MEMORY_BUDGET,
+) -> np.ndarray:
+    """
+    the centroid with the largest dot product of every row, `vectors @ centroids.T` is computed
+    a block of rows at a time so it never takes more than about memory_budget bytes.
+    """
+    block = _block_rows(len(centroids), centroids.shape[1], memory_budget)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block):
+        scores = vectors[start : start + block] @ centroids.T
+        assignment[start : start + block] = np.argmax(scores, axis=1)
+    return assignment
+
+
+def centroid_sums(
+    vectors: np.ndarray,
+    assignment: np.ndarray,
+    n_lists: int,
+    memory_budget: int = KMEANS_MEMORY_BUDGET,
+) -> np.ndarray:
+    """
+    the sum of the rows assigned to each centroid. the rows of a block are sorted by centroid and
+    summed with one `np.add.reduceat`, instead of the unbuffered scatter of `np.add.at`.
+    """
+    sums = np.zeros((n_lists, vectors.shape[1]), dtype=np.float32)
+    block = _block_rows(n_lists, vectors.shape[1], memory_budget)
+    for start in range(0, len(vectors), block):
+        lists = assignment[start : start + block]
+        order = np.argsort(lists, kind="stable")
+        sorted_lists = lists[order]
+        starts = np.flatnonzero(np.r_[True, sorted_lists[1:] != sorted_lists[:-1]])
+        sums[sorted_lists[starts]] += np.add.reduceat(
+            vectors[start : start + block][order], starts, axis=0
+        )
+    return sums
+
+
+def kmeans(
+    sample: np.ndarray,
+    n_lists: int,
+    n_iter: int = 10,
+    seed: int = 0,
+    memory_budget: int = KMEANS_MEMORY_BUDGET,
+) -> np.ndarray:
+    """
+    k-means for maximum inner product search: rows go to the centroid with the largest dot product.
+    the scores and sums are computed in blocks of rows of about memory_budget bytes.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = nearest_centroids(sample, centroids, memory_budget)
+        sums = centroid_sums(sample, assignment, n_lists, memory_budget)
+        counts = np.bincount(assignment, minlength=n_lists)
+        # empty lists keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+def build_entity_index(
+    encodings: np.ndarray,
+    path: str,
+    dtype: str = "int8",
+    n_lists: int = None,
+    train_size: int = 2**18,
+    n_iter: int = 10,
+    seed: int = 0,
+    memory_budget: int = KMEANS_MEMORY_BUDGET,
+):
+    """
+    convert entity encodings to a memory-mappable index directory: quantized vectors, their
+    scales and an inverted file (ivf) of the vectors grouped by their nearest k-means centroid,
+    stored as csr offsets/order like the adjacency arrays of task 2.
+
+    Args:
+    - encodings: (n entities, dim) matrix, e.g. np.load(..., mmap_mode="r") or BLINK's all_entities_large.t7 as numpy
+    - path: output directory
+    - dtype: "int8", "float16" or "float32"
+    - n_lists: number of inverted lists, default is about 4 * sqrt(n entities)
+    - train_size: number of sampled vectors k-means is trained on
+    - memory_budget: bytes of centroid scores held at a time by k-means and by the assignment of
+        every vector to its list, on top of the training sample
+    """
+    os.makedirs(path, exist_ok=True)
+    n, dim = encodings.shape
+    n_lists = n_lists or max(1, int(4 * np.sqrt(n)))
+    rng = np.random.default_rng(seed)
+    sample = np.asarray(
+        encodings[
+            np.sort(rng.choice(n, min(n, max(train_size, n_lists)), replace=False))
+        ],
+        dtype=np.float32,
+    )
+    centroids = kmeans(sample, n_lists, n_iter, seed, memory_budget)
+
+    vectors = np.lib.format.open_memmap(
+        os.path.join(path, "vectors.npy"), mode="w+", dtype=dtype, shape=(n, dim)
+    )
+    scales = np.empty(n, dtype=np.float32)
+    assignment = np.empty(n, dtype=np.int32)
+    for start in range(0, n, CHUNK_ROWS):
+        chunk = np.asarray(encodings[start : start + CHUNK_ROWS], dtype=np.float32)
+        end = start + len(chunk)
+        vectors[start:end], scales[start:end] = quantize(chunk, dtype)
+        assignment[start:end] = nearest_centroids(chunk, centroids, memory_budget)
+    vectors.flush()
+    del vectors
+
+    order = np.argsort(assignment, kind="stable").astype(np.int64)
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=n_lists), out=offsets[1:])
+    np.save(os.path.join(path, "scales.npy"), scales)
+    np.save(os.path.join(path, "centroids.npy"), centroids.astype(np.float32))
+    np.save(os.path.join(path, "list_offsets.npy"), offsets)
+    np.save(os.path.join(path, "list_order.npy"), order)
+    with open(os.path.join(path, "meta.json"), mode="w", encoding="utf-8") as file:
+        json.dump({"n": n, "dim": dim, "dtype": dtype, "n_lists": n_lists}, file)
+
+
+class EntityIndex:
+    """
+    approximate maximum inner product search over an index written by `build_entity_index`.
+    every array is memory mapped read-only, so processes using the same index share its pages.
+    the interface matches the faiss indexers BLINK accepts as `faiss_indexer`.
+
+    Args:
+    - path: index directory
+    - n_probe: number of inverted lists scanned per query, more is slower and more accurate
+    """
+
+    def __init__(self, path: str, n_probe: int = 16) -> None:
+        self.path = path
+        self.n_probe = n_probe
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as file:
+            self.meta = json.load(file)
+        self.vectors = self._load("vectors")
+        self.scales = self._load("scales")
+        self.centroids = np.asarray(self._load("centroids"))
+        self.list_offsets = self._load("list_offsets")
+        self.list_order = self._load("list_order")
+
+    def _load(self, name: str) -> np.ndarray:
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def _scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return (self.vectors[rows].astype(np.float32) @ query) * self.scales[rows]
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, rows: np.ndarray, top_k: int):
+        # pad queries with fewer candidates than top_k like faiss does
+        top = np.full(top_k, -1, dtype=np.int64)
+        top_scores = np.full(top_k, -np.inf, dtype=np.float32)
+        k = min(top_k, len(scores))
+        if k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best], kind="stable")]
+            top[:k], top_scores[:k] = rows[best], scores[best]
+        return top_scores, top
+
+    def search_knn(
+        self, query_vectors: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns the scores and the row indexes of the top_k entities of each query.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argpartition(-(query_vectors @ self.centroids.T), n_probe - 1)[
+            :, :n_probe
+        ]
+        scores = np.empty((len(query_vectors), top_k), dtype=np.float32)
+        indexes = np.empty((len(query_vectors), top_k), dtype=np.int64)
+        for i, (query, lists) in enumerate(zip(query_vectors, probes)):
+            rows = np.sort(
+                np.concatenate(
+                    [
+                        self.list_order[self.list_offsets[l] : self.list_offsets[l + 1]]
+                        for l in lists
+                    ]
+                )
+            )
+            scores[i], indexes[i] = self._top_k(self._scores(rows, query), rows, top_k)
+        return scores, indexes
+
+    def search_exact(
+        self, query_vectors: np.ndarray, top_k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        brute-force `search_knn` over every quantized vector.
+        """
+        return exact_search(self.vectors, query_vectors, top_k, self.scales)
+
+
+def exact_search(
+    encodings: np.ndarray,
+    query_vectors: np.ndarray,
+    top_k: int,
+    scales: np.ndarray = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    maximum inner product search over every row of encodings, scanned in chunks so a memory
+    mapped matrix is never loaded at once. returns the scores and row indexes of the top_k rows.
+    """
+    query_vectors = np.asarray(query_vectors, dtype=np.float32)
+    best_scores = np.full((len(query_vectors), 0), -np.inf, dtype=np.float32)
+    best = np.empty((len(query_vectors), 0), dtype=np.int64)
+    for start in range(0, len(encodings), CHUNK_ROWS):
+        chunk = np.asarray(encodings[start : start + CHUNK_ROWS], dtype=np.float32)
+        rows = np.arange(start, start + len(chunk))
+        scores = query_vectors @ chunk.T
+        if scales is not None:
+            scores *= scales[rows]
+        best_scores = np.hstack([best_scores, scores])
+        best = np.hstack([best, np.broadcast_to(rows, scores.shape)])
+        keep = np.argsort(-best_scores, axis=1, kind="stable")[:, :top_k]
+        best_scores = np.take_along_axis(best_scores, keep, axis=1)
+        best = np.take_along_axis(best, keep, axis=1)
+    return best_scores, best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="convert BLINK entity encodings to a memory-mapped quantized ivf index"
+    )
+    parser.add_argument(
+        "--encodings", required=True, help="all_entities_large.t7 or a .npy matrix"
+    )
+    parser.add_argument("--out", required=True, help="index directory")
+    parser.add_argument(
+        "--dtype", choices=["int8", "float16", "float32"], default="int8"
+    )
+    parser.add_argument("--n_lists", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--memory_budget",
+        help="MB of centroid scores held at a time while training and assigning the lists",
+        type=int,
+        default=KMEANS_MEMORY_BUDGET // 2**20,
+    )
+    args = parser.parse_args()
+
+    if args.encodings.endswith(".npy"):
+        encodings = np.load(args.encodings, mmap_mode="r")
+    else:
+        import torch
+
+        encodings = torch.load(args.encodings).numpy()
+    build_entity_index(
+        encodings,
+        args.out,
+        args.dtype,
+        args.n_lists,
+        seed=args.seed,
+        memory_budget=args.memory_budget * 2**20,
+    )
@@ -0,0 +1,49 @@
+from typing import Dict, Mapping, Optional
+from .entity_catalogue import normalize_alias
+from .model_skeletons import LinkedMention
+
+
+class Gazetteer:
+    """
+    exact and alias index over the titles of an entity catalogue, e.g. BLINK's title2id.
+    the alias of a title is its casefolded form without surrounding punctuation, aliases shared by
+    different titles are dropped since they cannot be resolved without the models.
+
+    Args:
+    - title2id: entity title to entity id
+    - alias2title: alias to title, e.g. `EntityCatalogue.alias2title` whose memory-mapped aliases
+        are searched in place. built from the titles of title2id by default
+    """
+
+    LABEL = "GAZETTEER"
+
+    def __init__(self, title2id: Dict, alias2title: Mapping = None) -> None:
+        self.title2id = title2id
+        if alias2title is None:
+            alias2title = {}
+            ambiguous = set()
+            for title in title2id:
+                alias = self.normalize(title)
+                if alias2title.setdefault(alias, title) != title:
+                    ambiguous.add(alias)
+            for alias in ambiguous:
+                del alias2title[alias]
+        self.aliases = alias2title
+        self.lookups = 0
+        self.hits = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return normalize_alias(text)
+
+    def lookup(self, text: str) -> Optional[LinkedMention]:
+        self.lookups += 1
+        title = " ".join(text.split())
+        if title not in self.title2id:
+            title = self.aliases.get(self.normalize(text))
+            if title is None:
+                return None
+        self.hits += 1
+        return LinkedMention(
+            id=self.title2id[title], title=title, mention=text, label=self.LABEL
+        )
@@ -49,6 +49,12 @@ class NER:
     def recognize_entities_in_docs(self, text: str) -> List[MentionsOfDoc]:
         pass
 
+    def identity(self) -> str:
+        """
+        identifies the model and its settings, linking results are cached under it.
+        """
+        return type(self).__name__
+
 
 class NED:
     """
@@ -75,3 +81,15 @@ class NED:
 
     def disambiguate_mentions_in_docs(self, mentions_batch: List):
         pass
+
+    def mention_input_length(self, mention_input) -> int:
+        """
+        length in tokens of a formatted mention, used to size NED batches.
+        """
+        return 1
+
+    def identity(self) -> str:
+        """
+        identifies the model and its settings, linking results are cached under it.
+        """
+        return type(self).__name__
@@ -1,5 +1,58 @@
+import time
+from dataclasses import dataclass
+from typing import Optional, Union
+from .cache import EntityLinkCache
+from .gazetteer import Gazetteer
 from .model_skeletons import NER, NED
-from .supported_ner_ned import SpacyNER, ReFiNED, BlinkNED
+from .registry import load_ner, load_ned
+
+
+@dataclass
+class RecognizedDocs:
+    """
+    docs that went through NER and wait for NED, see `NEL.recognize`.
+    """
+
+    docs: list
+    modes: list[str]
+    # linked entities of each doc, None until they are disambiguated
+    results: list[Optional[list]]
+    # docs sent to NER, identical docs are copied from the first one
+    pending: list[int]
+    copy_from: dict[int, int]
+    docs_mentions: list
+    # unique NED inputs and, for every mention of the pending docs, the input it maps to
+    mentions_batch: list
+    positions: list[int]
+
+
+@dataclass
+class RecognizedQuestionsAndAnswers:
+    """
+    see `NEL.recognize_questions_and_answers`.
+    """
+
+    recognized: RecognizedDocs
+    n_questions: int
+    answers_matched: list[list]
+    # questions whose remaining answers were recognized, in order after the questions
+    linked_answers: list[int]
+
+
+@dataclass
+class LinkingStats:
+    """
+    what a `NEL` sent to its models and the seconds they took, summed over its calls.
+    NER and NED are timed separately, so with `pipeline.link_pipelined` their times overlap.
+    """
+
+    ner_calls: int = 0
+    ner_docs: int = 0
+    ner_mentions: int = 0
+    ner_seconds: float = 0.0
+    ned_calls: int = 0
+    ned_mentions: int = 0
+    ned_seconds: float = 0.0
 
 
 class NEL:
@@ -9,57 +62,310 @@ class NEL:
 
     def __init__(
         self,
-        ner_model: NER = SpacyNER(),
-        ned_model: NED = BlinkNED(),
+        ner_model: NER = None,
+        ned_model: NED = None,
         no_cuda=False,
+        cache: EntityLinkCache = None,
+        context_insensitive: bool = False,
+        gazetteer: Gazetteer = None,
+        ned_batch_tokens: int = None,
+        ned_batch_mentions: int = None,
     ) -> None:
-        self.ner = ner_model
-        self.ned = ned_model
+        # the default models are only loaded when no model is given
+        self.ner = ner_model if ner_model is not None else load_ner()
+        self.ned = ned_model if ned_model is not None else load_ned(no_cuda=no_cuda)
         self.no_cuda = no_cuda
+        self.cache = cache
+        self.context_insensitive = context_insensitive
+        self.gazetteer = gazetteer
+        self.ned_batch_tokens = ned_batch_tokens
+        self.ned_batch_mentions = ned_batch_mentions
+        self.stats = LinkingStats()
+
+    def identity(self) -> str:
+        return f"{self.ner.identity()}|{self.ned.identity()}"
 
     def __clean_mention(self, mention: str) -> str:
         clean_mention = mention.strip()
         clean_mention = " ".join(clean_mention.split())
         return clean_mention
 
-    def link_entities_in_docs(self, docs: list) -> list[dict]:
-        docs_mentions = self.ner.recognize_entities_in_docs(docs)
+    def link_entities_in_docs(
+        self, docs: list, context_insensitive: bool = None
+    ) -> list[dict]:
+        """
+        Args:
+        - docs: list of texts
+        - context_insensitive: disambiguate each surface form once per batch whatever its context,
+            meant for short docs such as answers. default is the setting given to the constructor
+        """
+        return self.disambiguate(self.recognize(docs, context_insensitive))
+
+    def link_entities_in_answers(
+        self, answers_batch: list[list[str]], context_insensitive: bool = None
+    ) -> list[list]:
+        """
+        link the answers of each question, see `recognize_questions_and_answers`.
+
+        Args:
+        - answers_batch: the list of answers of each question
+        - context_insensitive: see `link_entities_in_docs`
+        """
+        _, answers = self.link_questions_and_answers(
+            [], answers_batch, context_insensitive
+        )
+        return answers
+
+    def link_questions_and_answers(
+        self,
+        questions: list[str],
+        answers_batch: list[list[str]],
+        context_insensitive_answers: bool = None,
+    ) -> tuple[list, list]:
+        """
+        link questions and the answers of each question with a single NED call.
+        returns the linked entities of the questions and of the answers of each question.
+        """
+        return self.disambiguate_questions_and_answers(
+            self.recognize_questions_and_answers(
+                questions, answers_batch, context_insensitive_answers
+            )
+        )
+
+    def recognize(
+        self, docs: list, context_insensitive: Union[bool, list[bool]] = None
+    ) -> RecognizedDocs:
+        """
+        first stage of `link_entities_in_docs`: cache lookup and NER of the docs, the mentions are
+        formatted for NED but not disambiguated yet. `context_insensitive` can be given per doc.
+        """
+        if context_insensitive is None:
+            context_insensitive = self.context_insensitive
+        if isinstance(context_insensitive, bool):
+            context_insensitive = [context_insensitive] * len(docs)
+        modes = ["context_insensitive" if flag else "" for flag in context_insensitive]
+
+        results = [None] * len(docs)
+        if self.cache is not None:
+            for mode in set(modes):
+                indexes = [i for i, m in enumerate(modes) if m == mode]
+                for i, entities in zip(
+                    indexes, self.cache.get_many([docs[i] for i in indexes], mode)
+                ):
+                    results[i] = entities
+
+        # identical docs are linked once
+        first_seen = {}
+        copy_from = {}
+        for i, (doc, mode) in enumerate(zip(docs, modes)):
+            if results[i] is None:
+                copy_from[i] = first_seen.setdefault((doc, mode), i)
+        pending = list(first_seen.values())
+        docs_mentions = []
+        if pending:
+            start = time.perf_counter()
+            docs_mentions = self.ner.recognize_entities_in_docs(
+                [docs[i] for i in pending]
+            )
+            self.stats.ner_seconds += time.perf_counter() - start
+            self.stats.ner_calls += 1
+            self.stats.ner_docs += len(pending)
+            self.stats.ner_mentions += sum(len(m.entities) for m in docs_mentions)
 
-        splits = []
         mentions_batch = []
-        for doc_mentions in docs_mentions:
+        # identical ned inputs are disambiguated once and their result is copied to every position
+        unique_inputs = {}
+        positions = []
+        for i, doc_mentions in zip(pending, docs_mentions):
             context = doc_mentions.text
-            splits.append(len(doc_mentions.entities))
             for mention in doc_mentions.entities:
                 mention_text = mention.text
                 mention_text = self.__clean_mention(mention_text)
-                mentions_batch.append(
-                    self.ned.model_input_formatting(mention_text, context, mention)
-                )
+                if context_insensitive[i]:
+                    key = (mention_text,)
+                else:
+                    key = (mention_text, context, mention.start, mention.end)
+                if key not in unique_inputs:
+                    unique_inputs[key] = len(mentions_batch)
+                    mentions_batch.append(
+                        self.ned.model_input_formatting(mention_text, context, mention)
+                    )
+                positions.append(unique_inputs[key])
+
+        return RecognizedDocs(
+            docs=docs,
+            modes=modes,
+            results=results,
+            pending=pending,
+            copy_from=copy_from,
+            docs_mentions=docs_mentions,
+            mentions_batch=mentions_batch,
+            positions=positions,
+        )
+
+    def disambiguate_mentions(self, mentions_batch: list) -> list:
+        """
+        run NED on formatted mentions. with a token budget the mentions are sorted by length and
+        sent in batches whose padded size, mentions x longest mention, stays within the budget.
+        """
+        if not mentions_batch:
+            return []
+        if self.ned_batch_tokens is None and self.ned_batch_mentions is None:
+            return self._disambiguate_batch(mentions_batch)
+
+        lengths = [self.ned.mention_input_length(m) for m in mentions_batch]
+        order = sorted(range(len(mentions_batch)), key=lambda i: lengths[i])
+        max_tokens = self.ned_batch_tokens or float("inf")
+        max_mentions = self.ned_batch_mentions or len(mentions_batch)
+        buckets = [[]]
+        for i in order:
+            bucket = buckets[-1]
+            # sorted by length, so i is the longest mention of its bucket
+            if bucket and (
+                len(bucket) >= max_mentions
+                or (len(bucket) + 1) * lengths[i] > max_tokens
+            ):
+                bucket = []
+                buckets.append(bucket)
+            bucket.append(i)
+
+        results = [None] * len(mentions_batch)
+        for bucket in buckets:
+            bucket_results = self._disambiguate_batch(
+                [mentions_batch[i] for i in bucket]
+            )
+            for i, result in zip(bucket, bucket_results):
+                results[i] = result
+        return results
+
+    def _disambiguate_batch(self, mentions_batch: list) -> list:
+        start = time.perf_counter()
+        results = self.ned.disambiguate_mentions_in_docs(mentions_batch)
+        self.stats.ned_seconds += time.perf_counter() - start
+        self.stats.ned_calls += 1
+        self.stats.ned_mentions += len(mentions_batch)
+        return results
+
+    def disambiguate(self, recognized: RecognizedDocs) -> list[list]:
+        """
+        second stage of `link_entities_in_docs`: NED of the recognized mentions.
+        """
+        return self.disambiguate_many([recognized])[0]
 
-        if mentions_batch:
-            search_results = self.ned.disambiguate_mentions_in_docs(mentions_batch)
-        else:
-            search_results = []
+    def disambiguate_many(self, recognized_batches: list[RecognizedDocs]) -> list[list]:
+        """
+        `disambiguate` several recognized batches with their mentions sent to NED together.
+        """
+        unique_results = self.disambiguate_mentions(
+            [m for recognized in recognized_batches for m in recognized.mentions_batch]
+        )
+        outputs = []
+        offset = 0
+        for recognized in recognized_batches:
+            outputs.append(self._finish(recognized, unique_results, offset))
+            offset += len(recognized.mentions_batch)
+        return outputs
 
+    def _finish(
+        self, recognized: RecognizedDocs, unique_results: list, offset: int
+    ) -> list[list]:
+        search_results = [unique_results[offset + i] for i in recognized.positions]
+        results = list(recognized.results)
         start = 0
-        rearranged_results = []
-        for split in splits:
-            rearranged_results.append(search_results[start : start + split])
-            start += split
-
-        if mentions_batch:
-            for doc_index in range(len(rearranged_results)):
-                for entity_index in range(len(rearranged_results[doc_index])):
-                    e = self.ned.model_output_formatting(
-                        mention_ned_result=rearranged_results[doc_index][entity_index],
-                        mention_ner_result=docs_mentions[doc_index].entities[
-                            entity_index
-                        ],
-                    )
-                    rearranged_results[doc_index][entity_index] = e
+        for i, doc_mentions in zip(recognized.pending, recognized.docs_mentions):
+            results[i] = [
+                self.ned.model_output_formatting(
+                    mention_ned_result=mention_ned_result,
+                    mention_ner_result=mention_ner_result,
+                )
+                for mention_ned_result, mention_ner_result in zip(
+                    search_results[start : start + len(doc_mentions.entities)],
+                    doc_mentions.entities,
+                )
+            ]
+            start += len(doc_mentions.entities)
+
+        if self.cache is not None:
+            for mode in set(recognized.modes[i] for i in recognized.pending):
+                linked = [i for i in recognized.pending if recognized.modes[i] == mode]
+                self.cache.put_many(
+                    [recognized.docs[i] for i in linked],
+                    [results[i] for i in linked],
+                    mode,
+                )
+        for i, j in recognized.copy_from.items():
+            results[i] = results[j]
+        return results
+
+    def recognize_questions_and_answers(
+        self,
+        questions: list[str],
+        answers_batch: list[list[str]],
+        context_insensitive_answers: bool = None,
+    ) -> RecognizedQuestionsAndAnswers:
+        """
+        first stage of `link_questions_and_answers`. with a gazetteer, every answer that is an
+        entity title is resolved by lookup and only the remaining answers of a question are joined
+        with " , " and recognized with the questions.
+        """
+        if context_insensitive_answers is None:
+            context_insensitive_answers = self.context_insensitive
+        answers_matched = []
+        answer_docs = []
+        for answers in answers_batch:
+            matched = []
+            rest = []
+            for answer in answers:
+                entity = (
+                    self.gazetteer.lookup(answer)
+                    if self.gazetteer is not None
+                    else None
+                )
+                if entity is None:
+                    rest.append(answer)
+                else:
+                    matched.append(entity)
+            answers_matched.append(matched)
+            answer_docs.append(" , ".join(rest) if rest else None)
+
+        linked_answers = [i for i, doc in enumerate(answer_docs) if doc is not None]
+        docs = list(questions) + [answer_docs[i] for i in linked_answers]
+        flags = [False] * len(questions) + [context_insensitive_answers] * len(
+            linked_answers
+        )
+        return RecognizedQuestionsAndAnswers(
+            recognized=self.recognize(docs, flags),
+            n_questions=len(questions),
+            answers_matched=answers_matched,
+            linked_answers=linked_answers,
+        )
+
+    def disambiguate_questions_and_answers(
+        self, recognized: RecognizedQuestionsAndAnswers
+    ) -> tuple[list, list]:
+        """
+        second stage of `link_questions_and_answers`.
+        """
+        return self.disambiguate_questions_and_answers_many([recognized])[0]
 
-        return rearranged_results
+    def disambiguate_questions_and_answers_many(
+        self, recognized_batches: list[RecognizedQuestionsAndAnswers]
+    ) -> list[tuple[list, list]]:
+        """
+        `disambiguate_questions_and_answers` of several batches with a shared NED pass.
+        """
+        outputs = []
+        for recognized, results in zip(
+            recognized_batches,
+            self.disambiguate_many([r.recognized for r in recognized_batches]),
+        ):
+            answers = [list(matched) for matched in recognized.answers_matched]
+            for i, entities in zip(
+                recognized.linked_answers, results[recognized.n_questions :]
+            ):
+                answers[i] = answers[i] + entities
+            outputs.append((results[: recognized.n_questions], answers))
+        return outputs
 
 
 if __name__ == "__main__":
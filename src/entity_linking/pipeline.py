@@ -0,0 +1,87 @@
+import queue
+import threading
+from typing import Iterable, Iterator, Tuple
+from .nel import NEL
+
+_DONE = object()
+
+
+def link_sequential(
+    nel: NEL,
+    batches: Iterable[Tuple[list[str], list[list[str]]]],
+    context_insensitive_answers: bool = None,
+    ned_group: int = 1,
+) -> Iterator[Tuple[list, list]]:
+    """
+    `NEL.link_questions_and_answers` over a stream of (questions, answers of each question)
+    batches, the mentions of `ned_group` consecutive batches are disambiguated together.
+    yields the linked entities of the questions and answers of each batch in order.
+    """
+    group = []
+    for questions, answers_batch in batches:
+        group.append(
+            nel.recognize_questions_and_answers(
+                questions, answers_batch, context_insensitive_answers
+            )
+        )
+        if len(group) == ned_group:
+            yield from nel.disambiguate_questions_and_answers_many(group)
+            group = []
+    if group:
+        yield from nel.disambiguate_questions_and_answers_many(group)
+
+
+def link_pipelined(
+    nel: NEL,
+    batches: Iterable[Tuple[list[str], list[list[str]]]],
+    context_insensitive_answers: bool = None,
+    prefetch: int = 2,
+    ned_group: int = 1,
+) -> Iterator[Tuple[list, list]]:
+    """
+    `link_sequential` with NER of the upcoming batches running in a background thread while
+    NED runs on the current ones. at most `prefetch` recognized batches wait for NED.
+    """
+    ready = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for questions, answers_batch in batches:
+                recognized = nel.recognize_questions_and_answers(
+                    questions, answers_batch, context_insensitive_answers
+                )
+                if not put(recognized):
+                    return
+            put(_DONE)
+        except BaseException as error:
+            put(error)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        done = False
+        while not done:
+            group = []
+            while len(group) < ned_group:
+                recognized = ready.get()
+                if recognized is _DONE:
+                    done = True
+                    break
+                if isinstance(recognized, BaseException):
+                    raise recognized
+                group.append(recognized)
+            if group:
+                yield from nel.disambiguate_questions_and_answers_many(group)
+    finally:
+        stop.set()
+        producer.join()
@@ -0,0 +1,95 @@
+from refined.data_types.base_types import Span
+from refined.inference.processor import Refined
+from dataclasses import asdict
+from .model_skeletons import LinkedMention, NED
+
+
+class ReFiNED(NED):
+    def __init__(
+        self,
+        ned_model_path="wikipedia_model",
+        entity_set="wikipedia",
+        no_cuda=False,
+    ) -> None:
+
+        self.ned_model_path = ned_model_path
+        self.entity_set = entity_set
+        self.model = Refined.from_pretrained(
+            model_name=ned_model_path,
+            entity_set=entity_set,
+            device="cpu" if no_cuda else None,
+        )
+
+    def identity(self) -> str:
+        return f"ReFiNED:{self.ned_model_path}:{self.entity_set}"
+
+    @staticmethod
+    def model_input_formatting(
+        mention_surfaceform: str, context: str, other_info: dict = None
+    ):
+        return (
+            Span(
+                text=mention_surfaceform,
+                start=other_info.start,
+                ln=other_info.end - other_info.start,
+            ),
+            context,
+        )
+
+    def model_output_formatting(
+        self, mention_ned_result, mention_ner_result=None
+    ) -> dict:
+        mention_as_dict = asdict(mention_ned_result)
+
+        def get_entity_id(mention_as_dict):
+            if (
+                not mention_as_dict["predicted_entity"]
+                or not mention_as_dict["predicted_entity"]["wikidata_entity_id"]
+            ):
+                if mention_as_dict["candidate_entities"]:
+                    return (
+                        mention_as_dict["candidate_entities"][0][0],
+                        mention_as_dict["text"],
+                    )
+                else:
+                    return None, None
+            else:
+                return (
+                    mention_as_dict["predicted_entity"]["wikidata_entity_id"],
+                    mention_as_dict["predicted_entity"]["wikipedia_entity_title"],
+                )
+
+        wiki_id, wiki_title = get_entity_id(mention_as_dict)
+        e = LinkedMention(
+            id=wiki_id,
+            title=wiki_title,
+            mention=mention_as_dict["text"],
+            label=mention_ner_result.label,
+        )
+
+        return e
+
+    def mention_input_length(self, mention_input) -> int:
+        return len(mention_input[1].split())
+
+    def disambiguate_mentions_in_docs(self, mentions_batch: list):
+        """
+        mentions are grouped by their doc, so every doc is encoded once with all of its spans.
+        the predictions are returned in the order of mentions_batch.
+        """
+        # refined does in-place modifications, deep copy the Spans if you need
+        doc_ids, spanss, positions = {}, [], []
+        span_ids = []
+        for span, text in mentions_batch:
+            doc_id = doc_ids.setdefault(text, len(doc_ids))
+            if doc_id == len(spanss):
+                spanss.append([])
+                span_ids.append({})
+            # the same span of a doc is passed to refined only once
+            key = (span.start, span.ln)
+            if key not in span_ids[doc_id]:
+                span_ids[doc_id][key] = len(spanss[doc_id])
+                spanss[doc_id].append(span)
+            positions.append((doc_id, span_ids[doc_id][key]))
+        self.model.process_text_batch(texts=list(doc_ids), spanss=spanss)
+        return [spanss[doc_id][i] for doc_id, i in positions]
@@ -0,0 +1,35 @@
+import importlib
+from .model_skeletons import NER, NED
+
+# name: (module, class), modules are only imported when their model is loaded
+NER_MODELS = {
+    "spacy": ("spacy_ner", "SpacyNER"),
+    "stub": ("stub_models", "StubNER"),
+}
+NED_MODELS = {
+    "blink": ("blink_ned", "BlinkNED"),
+    "refined": ("refined_ned", "ReFiNED"),
+    "stub": ("stub_models", "StubNED"),
+}
+
+
+def model_class(module: str, class_name: str) -> type:
+    return getattr(importlib.import_module(f".{module}", __package__), class_name)
+
+
+def load_ner(name: str = "spacy", **kwargs) -> NER:
+    """
+    construct a registered NER model, kwargs are passed to its constructor.
+    """
+    if name not in NER_MODELS:
+        raise ValueError(f"unknown NER model: {name}, choose from {list(NER_MODELS)}")
+    return model_class(*NER_MODELS[name])(**kwargs)
+
+
+def load_ned(name: str = "blink", **kwargs) -> NED:
+    """
+    construct a registered NED model, kwargs are passed to its constructor.
+    """
+    if name not in NED_MODELS:
+        raise ValueError(f"unknown NED model: {name}, choose from {list(NED_MODELS)}")
+    return model_class(*NED_MODELS[name])(**kwargs)
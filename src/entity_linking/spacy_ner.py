@@ -0,0 +1,39 @@
+import spacy
+from .model_skeletons import MentionsOfDoc, Mention, NER
+
+
+class SpacyNER(NER):
+    def __init__(
+        self,
+        pipeline_name: str = "en_core_web_sm",
+        prefer_gpu: bool = False,
+        n_process: int = 1,
+    ) -> None:
+        if prefer_gpu:
+            spacy.prefer_gpu()
+        self.pipeline_name = pipeline_name
+        self.n_process = n_process
+        self.model = spacy.load(pipeline_name)
+
+    def identity(self) -> str:
+        return f"SpacyNER:{self.pipeline_name}:{spacy.__version__}"
+
+    def recognize_entities_in_docs(self, text: str) -> list[dict]:
+        output = self.model.pipe(text, n_process=self.n_process)
+        rearranged_output = []
+        for doc in output:
+            rearranged_output.append(
+                MentionsOfDoc(
+                    text=doc.text,
+                    entities=[
+                        Mention(
+                            text=ent.text,
+                            start=ent.start_char,
+                            end=ent.end_char,
+                            label=ent.label_,
+                        )
+                        for ent in doc.ents
+                    ],
+                )
+            )
+        return rearranged_output
@@ -0,0 +1,99 @@
+import re
+import time
+from .model_skeletons import LinkedMention, Mention, MentionsOfDoc, NER, NED
+
+# the entity names of the synthetic benchmark questions, see benchmark.py
+ENTITY_PATTERN = re.compile(r"\bE\d+\b")
+
+
+class StubNER(NER):
+    """
+    deterministic NER without a model, every token like `E123` is a mention.
+    used to benchmark and test the linking code without loading spaCy.
+
+    Args:
+    - latency_per_doc: seconds slept per doc, to stand in for the cost of a real model
+    - n_process: not used, accepted like `SpacyNER`
+    """
+
+    def __init__(self, latency_per_doc: float = 0.0, n_process: int = 1) -> None:
+        self.latency_per_doc = latency_per_doc
+
+    def identity(self) -> str:
+        return f"StubNER:{self.latency_per_doc}"
+
+    def recognize_entities_in_docs(self, docs: list[str]) -> list[MentionsOfDoc]:
+        if self.latency_per_doc:
+            time.sleep(self.latency_per_doc * len(docs))
+        return [
+            MentionsOfDoc(
+                text=doc,
+                entities=[
+                    Mention(
+                        text=match.group(),
+                        start=match.start(),
+                        end=match.end(),
+                        label="STUB",
+                    )
+                    for match in ENTITY_PATTERN.finditer(doc)
+                ],
+            )
+            for doc in docs
+        ]
+
+
+class StubNED(NED):
+    """
+    deterministic NED without a model, a mention is linked to the entity of the same name.
+
+    Args:
+    - no_cuda: not used
+    - latency_per_call: seconds slept per call, like the fixed cost of a batch on a GPU
+    - latency_per_mention: seconds slept per mention of a call
+    """
+
+    def __init__(
+        self,
+        no_cuda: bool = False,
+        latency_per_call: float = 0.0,
+        latency_per_mention: float = 0.0,
+    ) -> None:
+        self.latency_per_call = latency_per_call
+        self.latency_per_mention = latency_per_mention
+
+    def identity(self) -> str:
+        return f"StubNED:{self.latency_per_call}:{self.latency_per_mention}"
+
+    @staticmethod
+    def model_input_formatting(mention_surfaceform, context, other_info):
+        return {
+            "mention": mention_surfaceform,
+            "context_left": context[: other_info.start],
+            "context_right": context[other_info.end :],
+        }
+
+    def model_output_formatting(self, mention_ned_result, mention_ner_result):
+        return LinkedMention(
+            id=mention_ned_result,
+            title=mention_ned_result,
+            mention=mention_ner_result.text,
+            label=mention_ner_result.label,
+        )
+
+    def mention_input_length(self, mention_input) -> int:
+        return len(
+            " ".join(
+                [
+                    mention_input["context_left"],
+                    mention_input["mention"],
+                    mention_input["context_right"],
+                ]
+            ).split()
+        )
+
+    def disambiguate_mentions_in_docs(self, mentions_batch):
+        if self.latency_per_call or self.latency_per_mention:
+            time.sleep(
+                self.latency_per_call + self.latency_per_mention * len(mentions_batch)
+            )
+        return [mention["mention"] for mention in mentions_batch]
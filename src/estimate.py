@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+from adjacency_index import EncodedRecords, encode_records
+
+
+def _count_by(keys: np.ndarray, weights: np.ndarray, n: int) -> np.ndarray:
+    valid = keys >= 0
+    return np.bincount(keys[valid], weights=weights[valid], minlength=n)
+
+
+def _top(contributions: np.ndarray, ids: np.ndarray, top: int) -> List:
+    order = np.argsort(contributions, kind="stable")[::-1][:top]
+    order = order[contributions[order] > 0]
+    return list(
+        zip(ids[order].tolist(), contributions[order].round().astype(int).tolist())
+    )
+
+
+def estimate_shape_sizes(enc: EncodedRecords, top: int = 10) -> Dict[str, Dict]:
+    """
+    count the candidate rows of every shape from entity and question degrees, without joining.
+    the counts are upper bounds of the output sizes. for 2hop, 3hop and 4hop they are exact before
+    the cycle/identity filters and the deduplication of question sets. the adjacent-head shapes
+    keep one order of each pair of heads, which is only bounded by half of the ordered pairs of
+    different rows.
+    contributions are attributed to the bridge of the last join: the entity for 2hop and the
+    shared question for the longer shapes.
+    """
+    ones = np.ones(len(enc.question))
+    # A(e), Q(e): records with answer / question entity e
+    answer_degree = _count_by(enc.answer_entity, ones, enc.n_entities)
+    question_degree = _count_by(enc.question_entity, ones, enc.n_entities)
+    # 2hop candidates by their head question H(q) and tail question T(q)
+    heads = np.where(enc.answer_entity >= 0, enc.question, -1)
+    tails = np.where(enc.question_entity >= 0, enc.question, -1)
+    by_head = _count_by(heads, question_degree[enc.answer_entity], enc.n_questions)
+    by_tail = _count_by(tails, answer_degree[enc.question_entity], enc.n_questions)
+    # adjacent-head candidates by the question of their first head
+    adjacent_by_head1 = _count_by(
+        heads,
+        _count_by(enc.question_entity, by_tail[enc.question], enc.n_entities)[
+            enc.answer_entity
+        ],
+        enc.n_questions,
+    )
+    # 3hop candidates by their tail question
+    three_hop_by_tail = _count_by(
+        tails,
+        _count_by(enc.answer_entity, by_tail[enc.question], enc.n_entities)[
+            enc.question_entity
+        ],
+        enc.n_questions,
+    )
+
+    adjacent_by_tail = (by_tail**2 - by_tail) / 2
+    contributions = {
+        "2hop": (answer_degree * question_degree, enc.entity_ids),
+        "2hop_with_adjacent_head": (adjacent_by_tail, enc.question_ids),
+        "3hop": (by_tail * by_head, enc.question_ids),
+        "3hop_with_adjacent_head": (adjacent_by_tail * by_head, enc.question_ids),
+        "3hop_with_adjacent_head2": (by_tail * adjacent_by_head1, enc.question_ids),
+        "4hop": (three_hop_by_tail * by_head, enc.question_ids),
+    }
+    return {
+        shape: {
+            "candidates": int(round(per_bridge.sum())),
+            "top_bridges": _top(per_bridge, ids, top),
+        }
+        for shape, (per_bridge, ids) in contributions.items()
+    }
+
+
+def estimate_composable_questions(
+    records_of_entities: List[Dict], top: int = 10
+) -> Dict[str, Dict]:
+    return estimate_shape_sizes(encode_records(pd.DataFrame(records_of_entities)), top)
@@ -0,0 +1,487 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+from adjacency_index import (
+    RECORD_COLUMNS,
+    SHAPE_JOINS,
+    EncodedRecords,
+    find_shapes,
+    join,
+    question_columns,
+    shape_question_codes,
+    shape_to_frame,
+)
+from composable_questions import questions_info
+from question_sets import QATable
+
+# record columns, stored as append-only binary files of these types
+COLUMN_DTYPES = {
+    "question": np.int64,
+    "question_entity": np.int32,
+    "answer_entity": np.int32,
+    "passage": np.int32,
+}
+# the columns shapes are joined on, each one has an index
+INDEX_COLUMNS = ["question", "question_entity", "answer_entity"]
+# index segments of a column before they are merged into one
+MAX_SEGMENTS = 16
+
+
+def _ranges(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    counts = np.maximum(ends - starts, 0)
+    group_starts = np.cumsum(counts) - counts
+    positions = np.arange(int(counts.sum()), dtype=np.int64)
+    return np.repeat(starts, counts) + positions - np.repeat(group_starts, counts)
+
+
+def _recode(values: np.ndarray) -> Tuple[np.ndarray, int]:
+    # dense codes in the order of the values, missing values (-1) stay missing
+    uniques = np.unique(values[values >= 0])
+    return np.where(values >= 0, np.searchsorted(uniques, values), -1), len(uniques)
+
+
+class Dictionary:
+    """
+    append-only dictionary of entity or passage ids, each new id gets the next code and is
+    appended to a jsonl file, so codes never change between updates.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.values = []
+        if os.path.exists(file_path):
+            with open(file_path, mode="r", encoding="utf-8") as file:
+                # parsed as one array, much faster than a json.loads per line
+                self.values = json.loads("[" + ",".join(file.read().splitlines()) + "]")
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def encode(self, values: pd.Series) -> np.ndarray:
+        codes = np.empty(len(values), dtype=np.int32)
+        new = []
+        for i, value in enumerate(values):
+            if pd.isna(value):
+                codes[i] = -1
+                continue
+            value = value.item() if isinstance(value, np.generic) else value
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+                new.append(value)
+            codes[i] = code
+        with open(self.file_path, mode="a", encoding="utf-8") as file:
+            file.writelines(
+                json.dumps(value, ensure_ascii=False) + "\n" for value in new
+            )
+        return codes
+
+    def decode(self, codes: np.ndarray) -> List:
+        return [self.values[code] if code >= 0 else None for code in codes]
+
+
+class SortedIndex:
+    """
+    record indexes sorted by the value of a column, kept in a few sorted segments so that
+    adding records only writes a segment of their own. the segments are merged once there are
+    more than `MAX_SEGMENTS`.
+    """
+
+    def __init__(self, path: str, column: str, segments: List[int]) -> None:
+        self.path = path
+        self.column = column
+        self.segments = list(segments)
+        self._loaded = [self._load(segment) for segment in self.segments]
+        # merged segments, deleted once the state no longer points to them
+        self.obsolete = []
+
+    def _file(self, segment: int, name: str) -> str:
+        return os.path.join(self.path, f"index_{self.column}_{segment}_{name}.npy")
+
+    def _load(self, segment: int) -> Tuple[np.ndarray, np.ndarray]:
+        return (
+            np.load(self._file(segment, "keys"), mmap_mode="r"),
+            np.load(self._file(segment, "records"), mmap_mode="r"),
+        )
+
+    def _save(self, segment: int, keys: np.ndarray, records: np.ndarray):
+        order = np.argsort(keys, kind="stable")
+        np.save(self._file(segment, "keys"), keys[order])
+        np.save(self._file(segment, "records"), records[order])
+        self.segments.append(segment)
+        self._loaded.append(self._load(segment))
+
+    def add(self, keys: np.ndarray, records: np.ndarray, segment: int):
+        """
+        index records by their keys in a new segment, whose number must not be used yet.
+        """
+        if len(self.segments) < MAX_SEGMENTS:
+            self._save(segment, keys, records)
+            return
+        old = self.segments
+        keys = np.concatenate([np.asarray(k) for k, _ in self._loaded] + [keys])
+        records = np.concatenate([np.asarray(r) for _, r in self._loaded] + [records])
+        self.segments, self._loaded = [], []
+        self._save(segment, keys, records)
+        self.obsolete.extend(old)
+
+    def remove_obsolete(self):
+        for segment in self.obsolete:
+            os.remove(self._file(segment, "keys"))
+            os.remove(self._file(segment, "records"))
+        self.obsolete = []
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """
+        the sorted indexes of the records whose value is one of keys.
+        """
+        found = [np.empty(0, dtype=np.int64)]
+        for segment_keys, records in self._loaded:
+            starts = np.searchsorted(segment_keys, keys, side="left")
+            ends = np.searchsorted(segment_keys, keys, side="right")
+            found.append(np.asarray(records[_ranges(starts, ends)], dtype=np.int64))
+        return np.sort(np.concatenate(found))
+
+
+class CompositionState:
+    """
+    a pool of records of entities persisted in a directory: the encoded records, the dictionaries
+    of their entity and passage ids, and an index of the records by question, question entity and
+    answer entity. `add` only joins the new records with the records the indexes return for their
+    keys, so it costs time in proportion to the new records and their neighbourhood in the pool.
+    questions must be integer indexes, the records of a question are added at once.
+
+    Args:
+    - path: state directory, created if it does not exist
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.meta = {
+            "n_records": 0,
+            "questions_bytes": 0,
+            "n_questions": 0,
+            "segments": {column: [] for column in INDEX_COLUMNS},
+            "next_segment": 0,
+        }
+        if os.path.exists(self._file("meta.json")):
+            with open(self._file("meta.json"), encoding="utf-8") as file:
+                self.meta = json.load(file)
+        # whatever an interrupted update wrote after the last saved meta is dropped
+        for column, dtype in COLUMN_DTYPES.items():
+            self._truncate(
+                self._file(column + ".bin"),
+                self.meta["n_records"] * np.dtype(dtype).itemsize,
+            )
+        self._truncate(self.questions_path, self.meta["questions_bytes"])
+        self.entities = Dictionary(self._file("entities.jsonl"))
+        self.passages = Dictionary(self._file("passages.jsonl"))
+        self.indexes = {
+            column: SortedIndex(path, column, self.meta["segments"][column])
+            for column in INDEX_COLUMNS
+        }
+        self._map_columns()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @property
+    def questions_path(self) -> str:
+        return self._file("questions.jsonl")
+
+    @staticmethod
+    def _truncate(file_path: str, size: int):
+        if os.path.exists(file_path):
+            os.truncate(file_path, size)
+        else:
+            open(file_path, mode="wb").close()
+
+    def _map_columns(self):
+        self.columns = {}
+        for column, dtype in COLUMN_DTYPES.items():
+            if self.meta["n_records"]:
+                self.columns[column] = np.memmap(
+                    self._file(column + ".bin"),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(self.meta["n_records"],),
+                )
+            else:
+                self.columns[column] = np.empty(0, dtype=dtype)
+
+    def _save_meta(self):
+        with open(self._file("meta.json.tmp"), mode="w", encoding="utf-8") as file:
+            json.dump(self.meta, file)
+        os.replace(self._file("meta.json.tmp"), self._file("meta.json"))
+
+    @property
+    def n_records(self) -> int:
+        return self.meta["n_records"]
+
+    @property
+    def n_questions(self) -> int:
+        return self.meta["n_questions"]
+
+    def add_questions(self, qa_data: List[Dict]) -> int:
+        """
+        append qa records to the question table of the state, they are saved with the next
+        `add`. returns the index of the first one.
+        """
+        first = self.meta["n_questions"]
+        with open(self.questions_path, mode="ab") as file:
+            for line in qa_data:
+                file.write(json.dumps(line, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.meta["questions_bytes"] = file.tell()
+        self.meta["n_questions"] += len(qa_data)
+        return first
+
+    def add(self, records_of_entities: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        add records to the pool and return the rows of record indexes, one column per node as in
+        `find_shapes`, of the sets of every shape that contain at least one of them.
+        """
+        df = pd.DataFrame(records_of_entities, columns=RECORD_COLUMNS)
+        question = df["question"].to_numpy(dtype=np.int64)
+        n_old = self.n_records
+        present = self.indexes["question"].lookup(np.unique(question))
+        if len(present):
+            raise ValueError(
+                f"records of questions already in the state: {np.unique(self.columns['question'][present])[:10].tolist()}"
+            )
+        new = {
+            "question": question,
+            "question_entity": self.entities.encode(df["question_entity"]),
+            "answer_entity": self.entities.encode(df["answer_entity"]),
+            "passage": self.passages.encode(df["passage"]),
+        }
+        for column, values in new.items():
+            with open(self._file(column + ".bin"), mode="ab") as file:
+                file.write(values.astype(COLUMN_DTYPES[column]).tobytes())
+        records = np.arange(n_old, n_old + len(df), dtype=np.int64)
+        for column in INDEX_COLUMNS:
+            self.indexes[column].add(new[column], records, self.meta["next_segment"])
+            self.meta["segments"][column] = self.indexes[column].segments
+        self.meta["next_segment"] += 1
+        self.meta["n_records"] += len(df)
+        self._map_columns()
+
+        shapes = DeltaJoin(self, n_old).shapes()
+        self._save_meta()
+        for index in self.indexes.values():
+            index.remove_obsolete()
+        return shapes
+
+    def question_ids(self, shapes: Dict[str, np.ndarray]) -> Dict[str, pd.DataFrame]:
+        """
+        the question sets of the rows returned by `add`, as question indexes into the question
+        table like `composable_questions(ids_only=True)` returns them. only the question column
+        of the records is read.
+        """
+        return {
+            shape: pd.DataFrame(
+                shape_question_codes(self.columns["question"], shape, rows),
+                columns=[name for name, _ in question_columns(shape)],
+            )
+            for shape, rows in shapes.items()
+        }
+
+    def to_frames(self, shapes: Dict[str, np.ndarray]) -> Dict[str, pd.DataFrame]:
+        """
+        gather the records of the rows returned by `add` into frames with the same columns as
+        the pandas engine.
+        """
+        used = np.unique(
+            np.concatenate([rows.ravel() for rows in shapes.values()] + [[]])
+        ).astype(np.int64)
+        df = pd.DataFrame(
+            {
+                "question": self.columns["question"][used],
+                "question_entity": self.entities.decode(
+                    self.columns["question_entity"][used]
+                ),
+                "answer_entity": self.entities.decode(
+                    self.columns["answer_entity"][used]
+                ),
+                "passage": self.passages.decode(self.columns["passage"][used]),
+            }
+        )
+        return {
+            shape: shape_to_frame(df, shape, np.searchsorted(used, rows))
+            for shape, rows in shapes.items()
+        }
+
+
+class DeltaJoin:
+    """
+    the rows of every shape that contain at least one new record, i.e. one of index n_old or more.
+    a shape joins two smaller ones, its new rows are the new left rows joined with all right
+    rows plus the old left rows joined with the new right rows. the other side of each join is
+    only enumerated for the keys of the new rows, starting from the indexes of the state.
+    """
+
+    def __init__(self, state: CompositionState, n_old: int) -> None:
+        self.state = state
+        self.n_old = n_old
+        self._delta = {"records": np.arange(n_old, state.n_records)[:, None]}
+
+    def width(self, shape: str) -> int:
+        if shape == "records":
+            return 1
+        spec = SHAPE_JOINS[shape]
+        return self.width(spec.left) + self.width(spec.right)
+
+    def keys(self, rows: np.ndarray, key: Tuple[str, int]) -> np.ndarray:
+        column, node = key
+        keys = np.unique(self.state.columns[column][rows[:, node]])
+        return keys[keys >= 0]
+
+    def fetch(
+        self, shape: str, node: int, column: str, keys: np.ndarray, limit: int
+    ) -> np.ndarray:
+        """
+        rows of shape over the records before `limit` whose node has one of keys in column.
+        """
+        if shape == "records":
+            records = self.state.indexes[column].lookup(keys)
+            return records[records < limit][:, None]
+        spec = SHAPE_JOINS[shape]
+        left_width = self.width(spec.left)
+        if node < left_width:
+            left = self.fetch(spec.left, node, column, keys, limit)
+            right = self.fetch_right(
+                spec, spec.right_key[1], self.keys(left, spec.left_key), limit
+            )
+        else:
+            right = self.fetch_right(spec, node - left_width, keys, limit, column)
+            left = self.fetch(
+                spec.left,
+                spec.left_key[1],
+                spec.left_key[0],
+                self.keys(right, spec.right_key),
+                limit,
+            )
+        return self.join(left, right, spec)
+
+    def fetch_right(
+        self, spec, node: int, keys: np.ndarray, limit: int, column: str = None
+    ) -> np.ndarray:
+        # the right rows of a join, with their permuted copies when the join has them
+        column = column or spec.right_key[0]
+        right = self.fetch(spec.right, node, column, keys, limit)
+        if spec.right_permutation is None:
+            return right
+        permuted = self.fetch(
+            spec.right, spec.right_permutation[node], column, keys, limit
+        )
+        return np.concatenate([right, permuted[:, spec.right_permutation]])
+
+    def delta(self, shape: str) -> np.ndarray:
+        if shape in self._delta:
+            return self._delta[shape]
+        spec = SHAPE_JOINS[shape]
+        new_left = self.delta(spec.left)
+        right = self.fetch_right(
+            spec,
+            spec.right_key[1],
+            self.keys(new_left, spec.left_key),
+            self.state.n_records,
+        )
+        new_right = self.delta(spec.right)
+        if spec.right_permutation is not None:
+            new_right = np.concatenate(
+                [new_right, new_right[:, spec.right_permutation]]
+            )
+        old_left = self.fetch(
+            spec.left,
+            spec.left_key[1],
+            spec.left_key[0],
+            self.keys(new_right, spec.right_key),
+            self.n_old,
+        )
+        self._delta[shape] = np.concatenate(
+            [self.join(new_left, right, spec), self.join(old_left, new_right, spec)]
+        )
+        return self._delta[shape]
+
+    def join(self, left: np.ndarray, right: np.ndarray, spec) -> np.ndarray:
+        """
+        `adjacency_index.join` over the records of left and right only, re-encoded so the
+        adjacency arrays are sized by them and not by the pool.
+        """
+        if not len(left) or not len(right):
+            return np.empty((0, left.shape[1] + right.shape[1]), dtype=np.int64)
+        records = np.unique(np.concatenate([left.ravel(), right.ravel()]))
+        rows = join(
+            self.encode(records),
+            np.searchsorted(records, left),
+            np.searchsorted(records, right),
+            spec,
+        )
+        return records[rows]
+
+    def encode(self, records: np.ndarray) -> EncodedRecords:
+        columns = self.state.columns
+        # question codes keep the order of the question ids, canonical pairs depend on it
+        question, n_questions = _recode(np.asarray(columns["question"][records]))
+        entities, n_entities = _recode(
+            np.concatenate(
+                [
+                    columns["question_entity"][records],
+                    columns["answer_entity"][records],
+                ]
+            )
+        )
+        return EncodedRecords(
+            question=question,
+            question_entity=entities[: len(records)],
+            answer_entity=entities[len(records) :],
+            passage=np.asarray(columns["passage"][records]),
+            n_questions=n_questions,
+            n_entities=n_entities,
+            question_ids=None,
+            entity_ids=None,
+        )
+
+    def shapes(self) -> Dict[str, np.ndarray]:
+        if self.n_old == 0:
+            # every row is new, the shapes are enumerated in one pass
+            records = np.arange(self.state.n_records)
+            return find_shapes(self.encode(records))
+        return {shape: self.delta(shape) for shape in SHAPE_JOINS}
+
+
+def composable_questions_incremental(
+    state_path: str,
+    records_of_entities: List[Dict],
+    qa_data: List[Dict],
+    ids_only: bool = False,
+) -> Dict:
+    """
+    add new single-hop questions to a persisted pool and return only the new composable sets,
+    those with at least one of the new questions, in the format of `composable_questions`.
+
+    Args:
+    - state_path: directory of the `CompositionState`, created on the first call
+    - records_of_entities: records of the new questions, see `composable_questions`
+    - qa_data: the new questions, the records point to them by index
+    - ids_only: return question indexes into `<state_path>/questions.jsonl`, which holds the
+        questions of every update in order, instead of copies of the questions
+    """
+    state = CompositionState(state_path)
+    first = state.add_questions(qa_data)
+    records = [
+        {**record, "question": record["question"] + first}
+        for record in records_of_entities
+    ]
+    ids = state.question_ids(state.add(records))
+    if ids_only:
+        return ids
+    qa_table = QATable(state.questions_path)
+    sets = {shape: questions_info(frame, qa_table) for shape, frame in ids.items()}
+    qa_table.close()
+    return sets
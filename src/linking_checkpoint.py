@@ -0,0 +1,87 @@
+import json
+import os
+from typing import Dict, List
+
+
+class LinkingCheckpoint:
+    """
+    append-only jsonl file of the entity links of task 1, one line per batch tagged with the
+    offset of its first question. lines are buffered and written every `flush_every` batches,
+    a line cut short by a crash is dropped when the file is read back.
+
+    Args:
+    - file_path: checkpoint file
+    - header: settings of the run saved in the first line, resuming a run with other settings fails
+    - resume: keep the batches already in the file, otherwise the file is started over
+    - flush_every: number of batches buffered between two writes
+    """
+
+    def __init__(
+        self,
+        file_path: str,
+        header: Dict,
+        resume: bool = False,
+        flush_every: int = 100,
+    ) -> None:
+        self.file_path = file_path
+        self.flush_every = flush_every
+        # batch offset -> records of the batch
+        self.done: Dict[int, List[Dict]] = {}
+        self._pending = []
+        has_header = False
+        if resume and os.path.exists(file_path):
+            has_header = self._load(header)
+        self._file = open(file_path, mode="a" if has_header else "w", encoding="utf-8")
+        if not has_header:
+            self._write({"header": header})
+            self._sync()
+
+    def _load(self, header: Dict) -> bool:
+        valid, has_header = 0, False
+        with open(self.file_path, mode="rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+                if "header" in entry:
+                    if entry["header"] != header:
+                        raise ValueError(
+                            f"{self.file_path} was written with other settings: {entry['header']}"
+                        )
+                    has_header = True
+                else:
+                    self.done[entry["batch"]] = entry["records"]
+        # drop a partially written last line before appending
+        os.truncate(self.file_path, valid)
+        return has_header
+
+    def _write(self, entry: Dict):
+        json.dump(entry, self._file, ensure_ascii=False)
+        self._file.write("\n")
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, batch: int, records: List[Dict]):
+        """
+        checkpoint the records of the batch starting at question `batch`.
+        """
+        self.done[batch] = records
+        self._pending.append(batch)
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        for batch in self._pending:
+            self._write({"batch": batch, "records": self.done[batch]})
+        self._pending = []
+        self._sync()
+
+    def close(self):
+        self.flush()
+        self._file.close()
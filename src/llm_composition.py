@@ -0,0 +1,552 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Set
+from columnar_output import read_table
+from main import from_jsonl, to_jsonl
+from question_sets import QATable, QuestionSets
+
+TEMPLATE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "data",
+    "2hop_questions_prompt.txt",
+)
+# quotes the examples of the prompt put around the composed question
+QUOTES = "“”\"' \n"
+
+
+def fill_template(template: str, fields: Dict[str, str]) -> str:
+    """
+    replace every `{name}` of the template by its field, other braces are left alone.
+    """
+    for name, value in fields.items():
+        template = template.replace("{" + name + "}", value)
+    return template
+
+
+def entities_by_question(records: Iterable[Dict]) -> Dict[str, Dict[int, Set]]:
+    """
+    the question entities and the answer entities of every question in the records of task 1.
+    """
+    entities = {"question_entity": {}, "answer_entity": {}}
+    for record in records:
+        for column, by_question in entities.items():
+            by_question.setdefault(record["question"], set()).add(record[column])
+    return entities
+
+
+class TwoHopPrompts:
+    """
+    the prompts of the 2hop sets saved by `main.py --ids_only`. the bridge entity of a set is the
+    entity of the join column, an answer entity of the head question that is a question entity
+    of the tail question. when several entities bridge the same pair, the one whose title
+    appears in the tail question is preferred.
+
+    Args:
+    - sets: 2hop sets, see `question_sets.QuestionSets`
+    - records: the records of task 1 the sets were found in
+    - template: prompt with the fields {question_1}, {question_2}, {ans_1}, {ans_2} and {bridge_entity}
+    - titles: entity id -> title, e.g. `EntityCatalogue.id2title`. default is the id itself
+    """
+
+    def __init__(
+        self,
+        sets: QuestionSets,
+        records: Iterable[Dict],
+        template: str,
+        titles=None,
+    ) -> None:
+        self.sets = sets
+        self.entities = entities_by_question(records)
+        self.template = template
+        self.titles = titles
+        self.without_bridge = 0
+
+    def title(self, entity) -> str:
+        if self.titles is not None:
+            try:
+                return self.titles[entity]
+            except (KeyError, IndexError, TypeError):
+                pass
+        return str(entity)
+
+    def bridge(self, head: int, tail: int, question_2: str) -> Optional[str]:
+        bridges = self.entities["answer_entity"].get(head, set()) & self.entities[
+            "question_entity"
+        ].get(tail, set())
+        titles = sorted(self.title(entity) for entity in bridges if entity is not None)
+        for title in titles:
+            if title.lower() in question_2.lower():
+                return title
+        return titles[0] if titles else None
+
+    def __iter__(self) -> Iterator[Dict]:
+        qa_table = self.sets.qa_table
+        for chunk in self.sets.iter_ids():
+            for head, tail in zip(chunk["question_head"], chunk["question_tail"]):
+                qa_1, qa_2 = qa_table[head], qa_table[tail]
+                bridge = self.bridge(head, tail, qa_2["question"])
+                if bridge is None:
+                    self.without_bridge += 1
+                    continue
+                yield {
+                    "question_head": int(head),
+                    "question_tail": int(tail),
+                    "bridge_entity": bridge,
+                    "answers": qa_2["answers"],
+                    "prompt": fill_template(
+                        self.template,
+                        {
+                            "question_1": qa_1["question"],
+                            "question_2": qa_2["question"],
+                            "ans_1": ", ".join(qa_1["answers"]),
+                            "ans_2": ", ".join(qa_2["answers"]),
+                            "bridge_entity": bridge,
+                        },
+                    ),
+                }
+
+
+class ResponseCache:
+    """
+    persistent cache of LLM completions keyed by the model, its settings and the prompt.
+    only used from the event loop, writes are committed every `commit_every` puts and on close.
+
+    Args:
+    - path: sqlite file, created if it does not exist
+    """
+
+    def __init__(self, path: str, commit_every: int = 100) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, completion TEXT)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT completion FROM completions WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: str, completion: str):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO completions (key, completion) VALUES (?, ?)",
+            (key, completion),
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class RateLimiter:
+    """
+    spaces the requests at least 1 / requests_per_second apart, None does not limit.
+    """
+
+    def __init__(self, requests_per_second: float = None) -> None:
+        self.interval = 1 / requests_per_second if requests_per_second else 0.0
+        self.next_time = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_time)
+        self.next_time = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class LLMError(Exception):
+    def __init__(self, message: str, retry: bool, retry_after: float = None) -> None:
+        super().__init__(message)
+        self.retry = retry
+        self.retry_after = retry_after
+
+
+class ChatClient:
+    """
+    asyncio client of an OpenAI-compatible `/chat/completions` endpoint. the blocking HTTP calls
+    run on a pool of `concurrency` threads, at most `concurrency` requests are in flight and
+    they are started at most `requests_per_second` per second. connection errors, 429 and 5xx
+    are retried `max_retries` times with exponential backoff and jitter, or after the
+    Retry-After of the response.
+
+    Args:
+    - endpoint: base url, e.g. http://localhost:8000/v1
+    - model: model name sent with every request
+    - api_key: sent as a bearer token when given
+    - temperature, max_tokens: sampling settings, part of the cache key
+    - concurrency: requests in flight
+    - requests_per_second: rate limit, None does not limit
+    - max_retries: retries of a failed request
+    - backoff: seconds before the first retry, doubled at each one up to max_backoff
+    - timeout: seconds to wait for a response
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        model: str,
+        api_key: str = None,
+        temperature: float = 0.0,
+        max_tokens: int = 256,
+        concurrency: int = 8,
+        requests_per_second: float = None,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 120.0,
+    ) -> None:
+        self.url = endpoint.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.api_key = api_key
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.requests = 0
+        self.retries = 0
+
+    def key(self, prompt: str) -> str:
+        settings = json.dumps([self.model, self.temperature, self.max_tokens])
+        return hashlib.sha1((settings + "\0" + prompt).encode("utf-8")).hexdigest()
+
+    def _post(self, prompt: str) -> str:
+        body = json.dumps(
+            {
+                "model": self.model,
+                "messages": [{"role": "user", "content": prompt}],
+                "temperature": self.temperature,
+                "max_tokens": self.max_tokens,
+            }
+        ).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(self.url, body, headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                result = json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            retry_after = error.headers.get("Retry-After")
+            raise LLMError(
+                f"{error.code}: {error.read()[:200].decode('utf-8', 'replace')}",
+                retry=error.code == 429 or error.code >= 500,
+                retry_after=float(retry_after) if retry_after else None,
+            )
+        except (urllib.error.URLError, OSError) as error:
+            raise LLMError(str(error), retry=True)
+        try:
+            return result["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            raise LLMError(f"unexpected response: {str(result)[:200]}", retry=False)
+
+    async def complete(self, prompt: str) -> str:
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.wait()
+            async with self.semaphore:
+                self.requests += 1
+                try:
+                    return await loop.run_in_executor(self.executor, self._post, prompt)
+                except LLMError as error:
+                    if not error.retry or attempt == self.max_retries:
+                        raise
+                    delay = error.retry_after
+            if delay is None:
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                delay *= random.uniform(0.5, 1.0)
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def compose_questions_with_llm(
+    prompts: Iterable[Dict],
+    client: ChatClient,
+    cache: ResponseCache,
+    out_file,
+    window: int = 1000,
+) -> Counter:
+    """
+    complete every prompt and write one json line per set to out_file as soon as it is done, so
+    the lines are in the order of completion. identical prompts are sent once, also when they
+    are in flight, and completions found in the cache are not sent again. at most `window`
+    prompts are pending at a time. returns the counts of requested, deduplicated, cached and
+    failed prompts.
+    """
+    counts = Counter()
+    in_flight: Dict[str, asyncio.Task] = {}
+
+    async def compose(item: Dict):
+        prompt = item.pop("prompt")
+        key = client.key(prompt)
+        completion = cache.get(key)
+        if completion is not None:
+            counts["cached"] += 1
+        else:
+            task = in_flight.get(key)
+            if task is None:
+                task = asyncio.ensure_future(client.complete(prompt))
+                in_flight[key] = task
+                counts["requested"] += 1
+            else:
+                counts["deduplicated"] += 1
+            try:
+                completion = await task
+            except LLMError as error:
+                in_flight.pop(key, None)
+                counts["failed"] += 1
+                out_file.write(json.dumps({**item, "error": str(error)}) + "\n")
+                return
+            if in_flight.pop(key, None) is not None:
+                cache.put(key, completion)
+        item.update(question=completion.strip(QUOTES), completion=completion)
+        out_file.write(json.dumps(item, ensure_ascii=False) + "\n")
+
+    pending = set()
+    for item in prompts:
+        pending.add(asyncio.ensure_future(compose(item)))
+        if len(pending) >= window:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                task.result()
+    if pending:
+        for task in (await asyncio.wait(pending))[0]:
+            task.result()
+    return counts
+
+
+def self_check() -> bool:
+    """
+    compose the 2hop sets of synthetic questions against a mock endpoint that fails the first
+    attempt of every prompt, twice: the second run must be answered from the cache.
+    """
+    from benchmark import synthetic_questions
+    from composable_questions import composable_questions
+    from mock_llm_server import MockLLMServer, mock_completion
+    from question_sets import write_question_ids
+
+    work_dir = tempfile.mkdtemp()
+    qa_data, records = synthetic_questions(300, 200)
+    sets = composable_questions(
+        records, qa_data, debug=False, engine="numpy", ids_only=True
+    )["2hop"]
+    questions_path = os.path.join(work_dir, "questions.jsonl")
+    sets_path = os.path.join(work_dir, "sets.csv")
+    to_jsonl(qa_data, questions_path)
+    # every set twice, the copies must be deduplicated
+    write_question_ids(sets.loc[sets.index.repeat(2)], sets_path)
+    with open(TEMPLATE_PATH, encoding="utf-8") as file:
+        template = file.read()
+
+    mock = MockLLMServer(fail_first=1).start()
+    ok = True
+    try:
+        for run in range(2):
+            before = mock.requests
+            qa_table = QATable(questions_path)
+            prompts = TwoHopPrompts(
+                QuestionSets(sets_path, qa_table), records, template
+            )
+            out_path = os.path.join(work_dir, f"composed_{run}.jsonl")
+            counts = compose_jsonl(
+                prompts,
+                ChatClient(mock.url, "mock", concurrency=8, backoff=0.01),
+                os.path.join(work_dir, "cache.sqlite"),
+                out_path,
+            )
+            qa_table.close()
+            lines = from_jsonl(out_path)
+            print(f"run {run}: {dict(counts)}, {mock.requests - before} requests")
+            expected_requests = 2 * len(sets) if run == 0 else 0
+            ok = ok and mock.requests - before == expected_requests
+            ok = ok and len(lines) == 2 * len(sets) and not counts["failed"]
+            ok = ok and all(
+                line["completion"]
+                == mock_completion(
+                    fill_template(
+                        template,
+                        {
+                            "question_1": qa_data[line["question_head"]]["question"],
+                            "question_2": qa_data[line["question_tail"]]["question"],
+                            "bridge_entity": line["bridge_entity"],
+                        },
+                    )
+                )
+                for line in lines
+            )
+    finally:
+        mock.stop()
+        shutil.rmtree(work_dir)
+    print("self check " + ("passed" if ok else "FAILED"))
+    return ok
+
+
+def compose_jsonl(
+    prompts: Iterable[Dict], client: ChatClient, cache_path: str, out_path: str
+) -> Counter:
+    cache = ResponseCache(cache_path)
+    try:
+        with open(out_path, mode="w", encoding="utf-8") as out_file:
+            counts = asyncio.run(
+                compose_questions_with_llm(prompts, client, cache, out_file)
+            )
+    finally:
+        cache.close()
+        client.close()
+    counts["retries"] = client.retries
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compose 2-hop questions from the 2hop sets of main.py --ids_only with an OpenAI-compatible LLM endpoint"
+    )
+    parser.add_argument(
+        "--prefix",
+        help="output prefix of main.py, e.g. data/composable_questions/single_hop_questions, the sets, questions and entity links are read from <prefix>_*",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--output_format",
+        help="--output_format of the main.py run",
+        choices=["jsonl", "parquet", "arrow"],
+        default="jsonl",
+    )
+    parser.add_argument(
+        "--out",
+        help="jsonl of the composed questions, default is <prefix>_2hop_llm_questions.jsonl",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--endpoint",
+        help="base url of the OpenAI-compatible API",
+        type=str,
+        default="http://localhost:8000/v1",
+    )
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument(
+        "--api_key_env",
+        help="environment variable holding the API key",
+        type=str,
+        default="OPENAI_API_KEY",
+    )
+    parser.add_argument(
+        "--template", help="prompt template", type=str, default=TEMPLATE_PATH
+    )
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max_tokens", type=int, default=256)
+    parser.add_argument("--concurrency", help="requests in flight", type=int, default=8)
+    parser.add_argument(
+        "--requests_per_second",
+        help="rate limit of the requests, default is no limit",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--max_retries",
+        help="retries of a request after a connection error, 429 or 5xx",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--cache",
+        help="sqlite file of the completions, reruns only send the prompts missing from it. default is <prefix>_llm_cache.sqlite",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--entity_catalogue",
+        help="directory built by entity_linking/entity_catalogue.py to print the bridge entities of BLINK ids as titles, default is the entity id",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--self_check",
+        help="run against a local mock endpoint on synthetic questions and exit",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.self_check:
+        raise SystemExit(0 if self_check() else 1)
+    if args.prefix is None or args.model is None:
+        parser.error("--prefix and --model are required")
+
+    extension = "csv" if args.output_format == "jsonl" else args.output_format
+    links_path = f"{args.prefix}_entity_links.{args.output_format}"
+    if args.output_format == "jsonl":
+        records = from_jsonl(links_path)
+    else:
+        records = read_table(links_path, args.output_format)
+    titles = None
+    if args.entity_catalogue:
+        from entity_linking.entity_catalogue import EntityCatalogue
+
+        titles = EntityCatalogue(args.entity_catalogue).id2title
+    with open(args.template, encoding="utf-8") as file:
+        template = file.read()
+    qa_table = QATable(f"{args.prefix}_questions.jsonl")
+    prompts = TwoHopPrompts(
+        QuestionSets(
+            f"{args.prefix}_2hop_composable_question_ids.{extension}", qa_table
+        ),
+        records,
+        template,
+        titles,
+    )
+    client = ChatClient(
+        args.endpoint,
+        args.model,
+        api_key=os.environ.get(args.api_key_env),
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        concurrency=args.concurrency,
+        requests_per_second=args.requests_per_second,
+        max_retries=args.max_retries,
+    )
+    out_path = args.out or f"{args.prefix}_2hop_llm_questions.jsonl"
+    start_time = time.perf_counter()
+    counts = compose_jsonl(
+        prompts, client, args.cache or f"{args.prefix}_llm_cache.sqlite", out_path
+    )
+    qa_table.close()
+    print(
+        f"{sum(counts[k] for k in ['requested', 'deduplicated', 'cached'])} sets composed in "
+        f"{time.perf_counter() - start_time:.1f}s: {counts['requested']} prompts sent "
+        f"({counts['retries']} retries, {counts['failed']} failed), {counts['deduplicated']} "
+        f"duplicates, {counts['cached']} from the cache, {prompts.without_bridge} sets without "
+        f"a bridge entity. saved to {out_path}"
+    )
@@ -1,8 +1,26 @@
 import argparse
 import json
+import os
+import pandas as pd
+import resource
+import time
 import tqdm
-from entity_linking.nel import NEL
+from dataclasses import fields
+from entity_linking.cache import EntityLinkCache
+from entity_linking.gazetteer import Gazetteer
+from entity_linking.nel import NEL, LinkingStats
+from entity_linking.pipeline import link_pipelined, link_sequential
+from entity_linking.registry import NED_MODELS, NER_MODELS, load_ned, load_ner
+from adjacency_index import RECORD_COLUMNS, Sampling
+from columnar_output import read_table, write_table
 from composable_questions import composable_questions
+from estimate import estimate_composable_questions
+from incremental_composition import composable_questions_incremental
+from linking_checkpoint import LinkingCheckpoint
+from metrics import Metrics
+from partitioned_composition import composable_questions_partitioned
+from question_sets import write_question_ids
+from worker_pool import map_forked
 from typing import Dict, List
 
 
@@ -21,59 +39,603 @@ def to_jsonl(data: List[Dict], file_path: str):
             file.write("\n")
 
 
-def single_file_worker(in_file_path, args, entity_linker):
+def report_sampling(sampling: Sampling, file_path: str, top: int = 10):
+    for shape, skipped in sampling.skipped.items():
+        hubs = sorted(skipped.items(), key=lambda hub: hub[1], reverse=True)[:top]
+        print(
+            f"{shape}: {sum(skipped.values())} candidates skipped at {len(skipped)} hubs"
+        )
+        for bridge, n_skipped in hubs:
+            print(f"    {bridge}: {n_skipped}")
+    for shape, dropped in sampling.dropped.items():
+        if dropped:
+            print(f"{shape}: {dropped} rows dropped by the per-shape cap")
+    with open(file_path, mode="w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "skipped": {
+                    shape: {str(bridge): n for bridge, n in skipped.items()}
+                    for shape, skipped in sampling.skipped.items()
+                },
+                "dropped": sampling.dropped,
+            },
+            file,
+            ensure_ascii=False,
+        )
+
+
+def report_rejected(rejected: Dict[str, Dict[str, int]]):
+    for shape, filters in rejected.items():
+        print(f"{shape}: {sum(filters.values())} candidates rejected")
+        for name, n_rejected in filters.items():
+            print(f"    {name}: {n_rejected}")
+
+
+def report_estimate(estimates: Dict, data: List[Dict], file_path: str):
+    for shape, estimate in estimates.items():
+        print(f"{shape}: at most {estimate['candidates']} sets")
+        for bridge, n_candidates in estimate["top_bridges"]:
+            # the bridge of 2hop is an entity, longer shapes are bridged by a question
+            bridge = bridge if shape == "2hop" else data[bridge]["question"]
+            print(f"    {bridge}: {n_candidates}")
+    with open(file_path, mode="w", encoding="utf-8") as file:
+        json.dump(estimates, file, ensure_ascii=False)
+
+
+def entity_link_records(
+    question: int, passage, question_entities: list, answer_entities: list
+) -> List[Dict]:
     """
-    a worker that perform two tasks:
-    1- NEL of questions and answers (this step include both entities recognition and disambiguation)
-    2- finding sets of composable questions that are connected by an entity
+    the records of task 1 of a question, one per pair of question and answer entities.
     """
+    return [
+        {
+            "question": question,
+            "question_entity": q_entity.id,
+            "answer_entity": ans_entity.id,
+            "passage": passage,
+        }
+        for q_entity in question_entities
+        for ans_entity in answer_entities
+    ]
 
+
+def link_entities(
+    data: List[Dict],
+    in_file_path: str,
+    checkpoint_path: str,
+    args,
+    entity_linker,
+    first: int = 0,
+) -> List[Dict]:
+    """
+    task 1: link the entities of the questions and answers of data and return one record per
+    pair of question and answer entities. with `args.checkpoint_every` the records of every
+    batch are appended to checkpoint_path and `args.resume` skips the batches already in it.
+    data can be a shard of the file starting at question index `first`.
+    """
     gpu_batch_size = args.gpu_batch_size
-    out_path = args.out_path
-    output_file_prefix = ".".join(in_file_path.split("/")[-1].split(".")[:-1])
-    data = from_jsonl(in_file_path)
-
-    # 1.recognize entities in questions and answers
-    print("#task 1: recognize and link entities in questions and answers")
-    records = []
-    for i in tqdm.tqdm(range(0, len(data), gpu_batch_size)):
-        questions_metadata = entity_linker.link_entities_in_docs(
-            [q["question"] for q in data[i : i + gpu_batch_size]]
-        )
-        answers_metadata = entity_linker.link_entities_in_docs(
-            [
-                " , ".join([ans for ans in q["answers"]])
-                for q in data[i : i + gpu_batch_size]
-            ]
-        )  # multi answers
+    checkpoint = None
+    if args.checkpoint_every:
+        checkpoint = LinkingCheckpoint(
+            checkpoint_path,
+            {
+                "in_file": in_file_path,
+                "first": first,
+                "questions": len(data),
+                "gpu_batch_size": gpu_batch_size,
+                "linker": entity_linker.identity(),
+                "context_insensitive_answers": args.context_insensitive_answers,
+                "answer_gazetteer": args.answer_gazetteer,
+            },
+            resume=args.resume,
+            flush_every=args.checkpoint_every,
+        )
+    # batch offset -> records of the batch
+    linked = dict(checkpoint.done) if checkpoint is not None else {}
+    starts = range(0, len(data), gpu_batch_size)
+    todo = [i for i in starts if i not in linked]
+    if linked:
+        print(f"resuming: {len(linked)} of {len(starts)} batches already linked")
+    batches = (
+        (
+            [q["question"] for q in data[i : i + gpu_batch_size]],
+            [q["answers"] for q in data[i : i + gpu_batch_size]],  # multi answers
+        )
+        for i in todo
+    )
+    if args.pipeline:
+        linked_batches = link_pipelined(
+            entity_linker,
+            batches,
+            args.context_insensitive_answers,
+            args.prefetch,
+            args.ned_group,
+        )
+    else:
+        linked_batches = link_sequential(
+            entity_linker, batches, args.context_insensitive_answers, args.ned_group
+        )
+    start_time = time.perf_counter()
+    n_linked = 0
+    for i, (questions_metadata, answers_metadata) in tqdm.tqdm(
+        zip(todo, linked_batches), total=len(todo)
+    ):
+        batch_records = []
         for j, question_metadata, answer_metadata in zip(
             range(i, i + gpu_batch_size), questions_metadata, answers_metadata
         ):
-            records.extend(
-                [
-                    {
-                        "question": j,
-                        "question_entity": q_entity.id,
-                        "answer_entity": ans_entity.id,
-                        "passage": data[j]["passage_id"],
-                    }
-                    for q_entity in question_metadata
-                    for ans_entity in answer_metadata
-                ]
+            batch_records.extend(
+                entity_link_records(
+                    first + j, data[j]["passage_id"], question_metadata, answer_metadata
+                )
+            )
+        linked[i] = batch_records
+        n_linked += len(questions_metadata)
+        if checkpoint is not None:
+            checkpoint.add(i, batch_records)
+    if checkpoint is not None:
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - start_time
+    # a question and its answers are linked as two docs
+    print(
+        f"linked {2 * n_linked} docs in {elapsed:.1f}s "
+        f"({2 * n_linked / max(elapsed, 1e-9):.1f} docs/sec)"
+    )
+    return [record for i in starts for record in linked[i]]
+
+
+# counters of the optional components of NEL, summed over the workers of `link_files_forked`
+LINKER_COUNTERS = {
+    "stats": [field.name for field in fields(LinkingStats)],
+    "gazetteer": ["hits", "lookups"],
+    "cache": ["memory_hits", "disk_hits", "misses"],
+}
+
+
+def linker_counters(entity_linker) -> Dict[tuple, int]:
+    counters = {}
+    for name, attributes in LINKER_COUNTERS.items():
+        component = getattr(entity_linker, name)
+        if component is not None:
+            for attribute in attributes:
+                counters[(name, attribute)] = getattr(component, attribute)
+    return counters
+
+
+def add_linking_metrics(metrics: Metrics, counters: Dict[tuple, int]):
+    """
+    add what the models did during task 1, the difference of `linker_counters` around it, to the
+    `task1/ner` and `task1/ned` stages and the cache and gazetteer counters to `task1`.
+    """
+    stats = {
+        attribute: n for (name, attribute), n in counters.items() if name == "stats"
+    }
+    ner = metrics.add(
+        "task1/ner",
+        stats["ner_seconds"],
+        stats["ner_calls"],
+        docs=stats["ner_docs"],
+        mentions=stats["ner_mentions"],
+    )
+    ner["ms_per_doc"] = 1000 * ner["elapsed_s"] / max(ner["docs"], 1)
+    ned = metrics.add(
+        "task1/ned",
+        stats["ned_seconds"],
+        stats["ned_calls"],
+        mentions=stats["ned_mentions"],
+    )
+    ned["mentions_per_batch"] = ned["mentions"] / max(ned["calls"], 1)
+    ned["mentions_per_sec"] = ned["mentions"] / max(ned["elapsed_s"], 1e-9)
+    metrics.add(
+        "task1",
+        calls=0,
+        **{
+            f"{name}_{attribute}": n
+            for (name, attribute), n in counters.items()
+            if name != "stats"
+        },
+    )
+
+
+def link_files_forked(
+    datas: Dict[str, List[Dict]],
+    args,
+    entity_linker,
+    metrics: Dict[str, Metrics] = None,
+) -> Dict[str, List[Dict]]:
+    """
+    task 1 for every file on `args.workers` processes forked after the models are loaded, so
+    their weights are shared copy-on-write. files of more than `args.shard_size` questions are
+    split into shards linked by different workers. returns the records of each file.
+    the time of every shard and what the models did are added to the `metrics` of its file.
+    """
+    tasks = []
+    for in_file_path, data in datas.items():
+        shard_size = args.shard_size or max(len(data), 1)
+        for start in range(0, len(data), shard_size):
+            tasks.append((in_file_path, start, min(start + shard_size, len(data))))
+
+    def link_shard(in_file_path: str, start: int, end: int):
+        start_time = time.perf_counter()
+        before = linker_counters(entity_linker)
+        data = datas[in_file_path]
+        shard = "" if end - start == len(data) else f"_{start}"
+        records = link_entities(
+            data[start:end],
+            in_file_path,
+            checkpoint_path(in_file_path, args, shard),
+            args,
+            entity_linker,
+            first=start,
+        )
+        after = linker_counters(entity_linker)
+        elapsed = time.perf_counter() - start_time
+        return records, {key: after[key] - before[key] for key in after}, elapsed
+
+    def open_cache():
+        # sqlite connections cannot be shared with forked processes
+        cache = entity_linker.cache
+        if cache is not None:
+            entity_linker.cache = EntityLinkCache(
+                cache.path, cache.model_identity, cache.lru_size
+            )
+
+    cache = entity_linker.cache
+    if cache is not None:
+        cache.close()
+    linked = {in_file_path: [] for in_file_path in datas}
+    for (in_file_path, start, end), (records, counters, elapsed) in zip(
+        tasks, map_forked(link_shard, tasks, args.workers, open_cache)
+    ):
+        linked[in_file_path].extend(records)
+        for (name, attribute), n in counters.items():
+            component = getattr(entity_linker, name)
+            setattr(component, attribute, getattr(component, attribute) + n)
+        if metrics is not None:
+            metrics[in_file_path].add(
+                "task1", elapsed, questions=end - start, records=len(records)
+            )
+            add_linking_metrics(metrics[in_file_path], counters)
+    return linked
+
+
+def file_prefix(in_file_path: str) -> str:
+    return ".".join(in_file_path.split("/")[-1].split(".")[:-1])
+
+
+def checkpoint_path(in_file_path: str, args, shard: str = "") -> str:
+    return f"{args.out_path}/{file_prefix(in_file_path)}{shard}_entity_links.checkpoint.jsonl"
+
+
+def remove_checkpoints(in_file_path: str, n_questions: int, args):
+    """
+    remove the checkpoints of task 1 of a file once its entity links are saved, the one of
+    `link_entities` and those of the shards of `link_files_forked`.
+    """
+    starts = range(0, n_questions, args.shard_size) if args.shard_size else []
+    for shard in [""] + [f"_{start}" for start in starts]:
+        path = checkpoint_path(in_file_path, args, shard)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def new_metrics(args, output_file_prefix: str) -> Metrics:
+    return Metrics(args.profile, f"{args.out_path}/{output_file_prefix}_profile_")
+
+
+def single_file_worker(
+    in_file_path,
+    args,
+    entity_linker,
+    data: List[Dict] = None,
+    records=None,
+    metrics: Metrics = None,
+):
+    """
+    a worker that perform two tasks:
+    1- NEL of questions and answers (this step include both entities recognition and disambiguation)
+    2- finding sets of composable questions that are connected by an entity
+
+    the questions of the file and the records of task 1 are loaded or computed unless given,
+    task 2 is left to the caller with `args.merge_files`. returns the questions and records.
+    the timers and counters of every stage are saved to `<file>_metrics.json`.
+    """
+
+    out_path = args.out_path
+    output_file_prefix = file_prefix(in_file_path)
+    if metrics is None:
+        metrics = new_metrics(args, output_file_prefix)
+    if data is None:
+        with metrics.stage("load_questions") as counters:
+            data = from_jsonl(in_file_path)
+            counters["questions"] = len(data)
+
+    records_path = f"{out_path}/{output_file_prefix}_entity_links.{args.output_format}"
+    if args.skip_linking:
+        print(f"#task 1: skipped, loading the entity links of {records_path}")
+        with metrics.stage("task1/load_entity_links") as counters:
+            if args.output_format == "jsonl":
+                records = from_jsonl(records_path)
+            else:
+                records = read_table(records_path, args.output_format)
+            counters["records"] = len(records)
+    else:
+        # 1.recognize entities in questions and answers
+        print("#task 1: recognize and link entities in questions and answers")
+        if records is None:
+            before = linker_counters(entity_linker)
+            with metrics.stage("task1") as counters:
+                records = link_entities(
+                    data,
+                    in_file_path,
+                    checkpoint_path(in_file_path, args),
+                    args,
+                    entity_linker,
+                )
+                counters.update(questions=len(data), records=len(records))
+            after = linker_counters(entity_linker)
+            add_linking_metrics(
+                metrics, {key: after[key] - before[key] for key in after}
             )
+        with metrics.stage("task1/save_entity_links"):
+            if args.output_format == "jsonl":
+                to_jsonl(records, records_path)
+            else:
+                write_table(
+                    pd.DataFrame(records, columns=RECORD_COLUMNS),
+                    records_path,
+                    args.output_format,
+                )
+        if args.checkpoint_every:
+            remove_checkpoints(in_file_path, len(data), args)
+
+    if args.merge_files is None:
+        compose_questions(data, records, output_file_prefix, args, metrics)
+    metrics.save(f"{out_path}/{output_file_prefix}_metrics.json")
+    return data, records
+
+
+def compose_questions(
+    data: List[Dict],
+    records: List[Dict],
+    output_file_prefix: str,
+    args,
+    metrics: Metrics = None,
+):
+    """
+    task 2, or its estimate, on the records of task 1. outputs are prefixed by output_file_prefix.
+    the stages of task 2 are added to `metrics`, saved by the caller.
+    """
+    if metrics is None:
+        metrics = new_metrics(args, output_file_prefix)
+    with metrics.stage("task2") as counters:
+        counters.update(questions=len(data), records=len(records))
+        find_and_save_composable_questions(
+            data, records, output_file_prefix, args, metrics
+        )
+
+
+def find_and_save_composable_questions(
+    data: List[Dict],
+    records: List[Dict],
+    output_file_prefix: str,
+    args,
+    metrics: Metrics,
+):
+    out_path = args.out_path
+    if args.estimate:
+        print("estimating the number of composable questions")
+        with metrics.stage("task2/estimate"):
+            estimates = estimate_composable_questions(records)
+        report_estimate(
+            estimates, data, f"{out_path}/{output_file_prefix}_estimate.json"
+        )
+        return
 
     # 2.find composable questions
     print("#task 2: find composable questions")
-    composable_questions_sets = composable_questions(
-        records_of_entities=records, qa_data=data, debug=False
-    )
+    output_name = "composable_question_ids" if args.ids_only else "composable_questions"
+    extension = "csv" if args.ids_only else "jsonl"
+    if args.output_format != "jsonl":
+        extension = args.output_format
+    output_suffix = f"{output_name}.{extension}"
+    if args.ids_only and not args.composition_state:
+        # the sets point to the lines of this table
+        with metrics.stage("task2/save_questions"):
+            to_jsonl(data, f"{out_path}/{output_file_prefix}_questions.jsonl")
+    # the pandas engine filters after its merges and does not count rejections
+    rejected = None if args.engine == "pandas" and not args.memory_budget else {}
+    if args.memory_budget:
+        composable_questions_partitioned(
+            records_of_entities=records,
+            qa_data=data,
+            output_path_template=f"{out_path}/{output_file_prefix}_{{shape}}_{output_suffix}",
+            memory_budget=args.memory_budget * 2**20,
+            work_dir=args.spill_dir,
+            rejected=rejected,
+            ids_only=args.ids_only,
+            output_format=args.output_format,
+            metrics=metrics,
+        )
+        report_rejected(rejected)
+        return
+
+    sampling = None
+    if args.max_fanout is not None or args.max_rows_per_shape is not None:
+        sampling = Sampling(
+            max_fanout=args.max_fanout,
+            max_rows=args.max_rows_per_shape,
+            seed=args.sampling_seed,
+        )
+    if args.composition_state:
+        # only the sets with at least one question of this file, the ids point to the
+        # questions.jsonl of the state
+        rejected = None
+        with metrics.stage("task2/incremental"):
+            composable_questions_sets = composable_questions_incremental(
+                args.composition_state, records, data, args.ids_only
+            )
+    else:
+        composable_questions_sets = composable_questions(
+            records_of_entities=records,
+            qa_data=data,
+            debug=False,
+            engine=args.engine,
+            n_processes=args.cpu_batch_size if args.parallel else 1,
+            sampling=sampling,
+            rejected=rejected,
+            ids_only=args.ids_only,
+            metrics=metrics,
+        )
+    if rejected is not None:
+        report_rejected(rejected)
+    if sampling is not None:
+        report_sampling(
+            sampling, f"{out_path}/{output_file_prefix}_sampling_report.json"
+        )
 
     print("saving output files...")
     for sets in composable_questions_sets.keys():
-        to_jsonl(
-            composable_questions_sets[sets],
-            f"{out_path}/{output_file_prefix}_{sets}_composable_questions.jsonl",
+        file_path = f"{out_path}/{output_file_prefix}_{sets}_{output_suffix}"
+        with metrics.stage("task2/save_outputs") as counters:
+            if args.output_format != "jsonl":
+                write_table(
+                    composable_questions_sets[sets], file_path, args.output_format
+                )
+            elif args.ids_only:
+                write_question_ids(composable_questions_sets[sets], file_path)
+            else:
+                to_jsonl(composable_questions_sets[sets], file_path)
+            counters["rows"] = len(composable_questions_sets[sets])
+
+
+def add_linking_arguments(parser: argparse.ArgumentParser):
+    """
+    options of the NER/NED models and of `NEL`, shared by main.py and server.py.
+    """
+    parser.add_argument(
+        "--ner",
+        help="NER model, only the chosen models are imported and loaded",
+        choices=list(NER_MODELS),
+        default="spacy",
+    )
+    parser.add_argument(
+        "--ned",
+        help="NED model",
+        choices=list(NED_MODELS),
+        default="blink",
+    )
+    parser.add_argument(
+        "--linking_cache",
+        help="sqlite file caching the linked entities of every question and answer across runs, keyed by text and models. default is no cache",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--linking_cache_size",
+        help="number of linked docs the cache keeps in memory",
+        type=int,
+        default=100000,
+    )
+    parser.add_argument(
+        "--context_insensitive_answers",
+        help="disambiguate each answer mention once per batch regardless of the rest of the answer string",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--answer_gazetteer",
+        help="resolve answers that are entity titles of the BLINK catalogue by lookup, only the other answers go through NER/NED",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ner_processes",
+        help="number of processes spaCy NER uses on each batch",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--ned_batch_tokens",
+        help="sort the mentions of a NED pass by context length and send them in batches of at most this many padded tokens. default is a single batch",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--ned_batch_mentions",
+        help="at most this many mentions per NED batch",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--blink_entity_index",
+        help="directory built by entity_linking/entity_index.py, BLINK retrieves candidates from its memory-mapped quantized vectors with approximate search",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--blink_n_probe",
+        help="inverted lists scanned per mention with --blink_entity_index",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--blink_entity_catalogue",
+        help="directory built by entity_linking/entity_catalogue.py, BLINK's titles, texts and ids are looked up in its memory-mapped tables shared by all processes",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--blink_fast",
+        help="skip BLINK's cross-encoder",
+        action="store_true",
+    )
+
+
+def load_entity_linker(
+    args, parser: argparse.ArgumentParser, no_cuda: bool = False
+) -> NEL:
+    """
+    load the models and build the `NEL` of the options of `add_linking_arguments`.
+    no_cuda loads them on the CPU, as the processes forked after they are loaded need.
+    """
+    ned_options = {}
+    if args.blink_entity_index or args.blink_fast or args.blink_entity_catalogue:
+        if args.ned != "blink":
+            parser.error(
+                "--blink_entity_index, --blink_entity_catalogue and --blink_fast need --ned blink"
+            )
+        ned_options = dict(
+            entity_index=args.blink_entity_index,
+            n_probe=args.blink_n_probe,
+            fast=args.blink_fast,
+            entity_catalogue=args.blink_entity_catalogue,
+        )
+    start_time = time.perf_counter()
+    entity_linker = NEL(
+        ner_model=load_ner(args.ner, n_process=args.ner_processes),
+        ned_model=load_ned(args.ned, no_cuda=no_cuda, **ned_options),
+        no_cuda=no_cuda,
+        ned_batch_tokens=args.ned_batch_tokens,
+        ned_batch_mentions=args.ned_batch_mentions,
+    )
+    print(
+        f"loaded {args.ner} NER and {args.ned} NED in {time.perf_counter() - start_time:.1f}s, "
+        f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10:.0f} MB"
+    )
+    if args.answer_gazetteer:
+        if not hasattr(entity_linker.ned, "title2id"):
+            parser.error(
+                "--answer_gazetteer needs an NED model with a title2id catalogue"
+            )
+        entity_linker.gazetteer = Gazetteer(
+            entity_linker.ned.title2id, getattr(entity_linker.ned, "alias2title", None)
+        )
+    if args.linking_cache:
+        entity_linker.cache = EntityLinkCache(
+            args.linking_cache, entity_linker.identity(), args.linking_cache_size
         )
+    return entity_linker
 
 
 if __name__ == "__main__":
@@ -106,11 +668,197 @@ if __name__ == "__main__":
         type=int,
         default=8,
     )
+    add_linking_arguments(parser)
+    parser.add_argument(
+        "--workers",
+        help="link the files, or their shards, on this many processes forked after the models are loaded and sharing their weights. the models are then loaded on the CPU",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--shard_size",
+        help="with --workers, split the files into shards of this many questions, default is a shard per file",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--merge_files",
+        help="find composable questions across all input files in one graph, outputs are prefixed by this name instead of each file's name",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        help="append the entity links of task 1 to <file>_entity_links.checkpoint.jsonl every this many batches, default is no checkpoint. the checkpoint is removed once the entity links are saved",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--resume",
+        help="skip the batches already in the checkpoint of task 1 and reload their entity links",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--skip_linking",
+        help="skip task 1 and run task 2 on the entity links saved by an earlier run in <file>_entity_links.<output_format>, no model is loaded",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--engine",
+        help="how composable questions are found: chained pandas merges or integer-encoded adjacency arrays",
+        choices=["pandas", "numpy"],
+        default="pandas",
+    )
+    parser.add_argument(
+        "--parallel",
+        help="spread the joins of the numpy engine over --cpu_batch_size processes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--estimate",
+        help="instead of task 2, count the candidate sets per shape from entity degrees and print the bridges that drive them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max_fanout",
+        help="numpy engine: keep at most this many sampled candidates per bridge entity/question of each join",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--max_rows_per_shape",
+        help="numpy engine: keep at most this many sets per shape, sampled with a seeded reservoir",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--sampling_seed",
+        help="seed of --max_fanout and --max_rows_per_shape sampling",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--composition_state",
+        help="directory of a persisted pool of questions, created on the first run. the questions of every file are added to it and only the new composable sets, with at least one of them, are saved",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--memory_budget",
+        help="memory budget in MB for finding composable questions out of core, shards are spilled to disk and outputs are streamed. default is in memory",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--spill_dir",
+        help="where shards are spilled when --memory_budget is set, default is the system temporary directory",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--ids_only",
+        help="save each set as question indexes into <file>_questions.jsonl instead of copying the questions, read them back with question_sets.QuestionSets",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--output_format",
+        help="format of the output files and of the saved entity links, parquet and arrow need pyarrow and dictionary-encode the entity columns",
+        choices=["jsonl", "parquet", "arrow"],
+        default="jsonl",
+    )
+
+    parser.add_argument(
+        "--pipeline",
+        help="run NER on upcoming batches in a background thread while NED runs on the current one",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="number of recognized batches waiting for NED in --pipeline mode",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--ned_group",
+        help="number of --gpu_batch_size batches whose mentions are disambiguated together",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--profile",
+        help=", delimited names of stages of <file>_metrics.json to run under cProfile, e.g. task1,task2/2hop, their stats are saved to <file>_profile_<stage>.prof",
+        type=lambda s: [str(item) for item in s.split(",") if item],
+        default=[],
+    )
 
     args = parser.parse_args()
+    sampling_caps = args.max_fanout is not None or args.max_rows_per_shape is not None
+    if args.engine == "pandas" and (args.parallel or sampling_caps):
+        parser.error(
+            "--parallel, --max_fanout and --max_rows_per_shape need --engine numpy"
+        )
+    if args.memory_budget and sampling_caps:
+        parser.error("sampling caps are not supported with --memory_budget")
+    if args.composition_state and (
+        args.memory_budget or args.estimate or args.parallel or sampling_caps
+    ):
+        parser.error(
+            "--composition_state does not support --memory_budget, --estimate, --parallel and sampling caps"
+        )
     files = args.in_files
-    entity_linker = NEL(no_cuda=False)
+    if args.resume and not args.checkpoint_every:
+        parser.error("--resume needs --checkpoint_every")
+    entity_linker = None
+    if not args.skip_linking:
+        # CUDA cannot be used by the processes `link_files_forked` forks after the models are loaded
+        entity_linker = load_entity_linker(args, parser, no_cuda=args.workers > 1)
 
+    datas, linked = {}, {}
+    metrics = {file: new_metrics(args, file_prefix(file)) for file in files}
+    if args.workers > 1 and not args.skip_linking:
+        datas = {file: from_jsonl(file) for file in files}
+        print(f"linking {len(files)} files on {args.workers} workers")
+        linked = link_files_forked(datas, args, entity_linker, metrics)
+    merged_data, merged_records = [], []
     for file in files:
         print(f"*****  working on file: {file}  *****")
-        single_file_worker(file, args, entity_linker)
+        data, records = single_file_worker(
+            file,
+            args,
+            entity_linker,
+            datas.pop(file, None),
+            linked.pop(file, None),
+            metrics.pop(file),
+        )
+        if args.merge_files is not None:
+            # questions are numbered across the files in the order of --in_files
+            merged_records.extend(
+                {**record, "question": record["question"] + len(merged_data)}
+                for record in records
+            )
+            merged_data.extend(data)
+    if args.merge_files is not None:
+        print(f"*****  composing the questions of all files: {args.merge_files}  *****")
+        merged_metrics = new_metrics(args, args.merge_files)
+        compose_questions(
+            merged_data, merged_records, args.merge_files, args, merged_metrics
+        )
+        merged_metrics.save(f"{args.out_path}/{args.merge_files}_metrics.json")
+
+    if entity_linker is not None and entity_linker.gazetteer is not None:
+        gazetteer = entity_linker.gazetteer
+        print(
+            f"gazetteer: {gazetteer.hits} of {gazetteer.lookups} answers resolved by lookup "
+            f"({gazetteer.hits / max(gazetteer.lookups, 1):.1%})"
+        )
+    if entity_linker is not None and entity_linker.cache is not None:
+        stats = entity_linker.cache.stats()
+        print(
+            f"linking cache: {stats['memory_hits']} memory hits, {stats['disk_hits']} disk hits, "
+            f"{stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)"
+        )
+        entity_linker.cache.close()
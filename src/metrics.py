@@ -0,0 +1,104 @@
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterable, Iterator, Optional
+
+
+def current_rss_mb() -> Optional[float]:
+    """
+    resident memory of this process, None where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+    except OSError:
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+class Metrics:
+    """
+    timers and counters of the stages of a run, saved as one json file. stages are named like
+    paths, e.g. `task2/2hop/same_passage(head, tail)`, and each one holds its number of calls, elapsed
+    seconds and counters summed over the calls. a stage run with `stage` also records the RSS and
+    the peak RSS of the process when it last ended, and the unix times of its first start and last
+    end, to find it in a `py-spy record --pid <pid>` of the run.
+
+    Args:
+    - profile: names of the stages run under cProfile, their stats are dumped by `save` to
+        `<profile_prefix><stage>.prof` with the / of the name replaced by .
+    - profile_prefix: path prefix of the profiles
+    """
+
+    def __init__(self, profile: Iterable[str] = (), profile_prefix: str = "") -> None:
+        self.stages: Dict[str, Dict] = {}
+        self.profile = set(profile)
+        self.profile_prefix = profile_prefix
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        # only one profiler can be enabled at a time, nested profiled stages are not profiled
+        self._profiling = False
+
+    def add(
+        self, name: str, elapsed_s: float = 0.0, calls: int = 1, **counters
+    ) -> Dict:
+        """
+        add a call, or several, measured elsewhere to a stage and return its entry.
+        """
+        entry = self.stages.setdefault(name, {"calls": 0, "elapsed_s": 0.0})
+        entry["calls"] += calls
+        entry["elapsed_s"] += elapsed_s
+        for key, n in counters.items():
+            entry[key] = entry.get(key, 0) + n
+        return entry
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict]:
+        """
+        time a call of a stage. yields a dict of counters, e.g. rows, added to the stage at exit.
+        """
+        profile = None
+        if name in self.profile and not self._profiling:
+            profile = self._profiles.setdefault(name, cProfile.Profile())
+            self._profiling = True
+            profile.enable()
+        counters = {}
+        started = time.time()
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self._profiling = False
+            entry = self.add(name, elapsed, **counters)
+            entry.setdefault("first_start", started)
+            entry.update(
+                last_end=time.time(), rss_mb=current_rss_mb(), peak_rss_mb=peak_rss_mb()
+            )
+
+    def save(self, file_path: str):
+        profiles = {}
+        for name, profile in self._profiles.items():
+            profiles[name] = f"{self.profile_prefix}{name.replace('/', '.')}.prof"
+            profile.dump_stats(profiles[name])
+        with open(file_path, mode="w", encoding="utf-8") as file:
+            json.dump(
+                {"pid": os.getpid(), "stages": self.stages, "profiles": profiles},
+                file,
+                indent=1,
+            )
+
+
+def measure(metrics: Optional[Metrics], name: str):
+    """
+    `metrics.stage(name)`, or only a dict of counters that is dropped when there are no metrics.
+    """
+    return metrics.stage(name) if metrics is not None else nullcontext({})
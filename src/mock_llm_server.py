@@ -0,0 +1,157 @@
+import argparse
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+
+# the fields of the last example of data/2hop_questions_prompt.txt, the one to answer
+PROMPT_FIELD = re.compile(r"^(question_1|question_2|bridge entity):\s*(.*)$", re.M)
+
+
+def mock_completion(prompt: str) -> str:
+    """
+    a deterministic stand-in for the composed question: question_2 with the bridge entity replaced
+    by question_1, quoted like the examples of the prompt.
+    """
+    fields = {}
+    for name, value in PROMPT_FIELD.findall(prompt):
+        fields[name] = value.strip()
+    if len(fields) < 3:
+        return prompt.strip().splitlines()[-1] if prompt.strip() else ""
+    question_1 = fields["question_1"].rstrip("?").strip()
+    composed = fields["question_2"].replace(
+        fields["bridge entity"], f"the answer of ({question_1})"
+    )
+    return f"“{composed}”"
+
+
+class MockLLMServer:
+    """
+    local OpenAI-compatible `POST /v1/chat/completions` endpoint to run `llm_composition.py`
+    offline. it answers with `mock_completion` of the last user message and can fail the first
+    attempts of every prompt, with 429 and 500 in turn, to exercise retries.
+
+    Args:
+    - address: (host, port) to listen on, port 0 picks a free one
+    - latency: seconds slept per request
+    - fail_first: number of attempts of each prompt answered with an error
+    """
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        latency: float = 0.0,
+        fail_first: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.fail_first = fail_first
+        self.requests = 0
+        self.failures = 0
+        self.attempts = Counter()
+        self.lock = threading.Lock()
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args):
+                pass
+
+            def _send(self, status: int, payload: dict, headers: dict = None):
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.rstrip("/") != "/v1/chat/completions":
+                    self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+                    return
+                request = json.loads(body)
+                prompt = request["messages"][-1]["content"]
+                if mock.latency:
+                    time.sleep(mock.latency)
+                with mock.lock:
+                    mock.requests += 1
+                    mock.attempts[prompt] += 1
+                    attempt = mock.attempts[prompt]
+                    fail = attempt <= mock.fail_first
+                    if fail:
+                        mock.failures += 1
+                if fail:
+                    if attempt % 2:
+                        self._send(
+                            429,
+                            {"error": {"message": "rate limited"}},
+                            {"Retry-After": "0.01"},
+                        )
+                    else:
+                        self._send(500, {"error": {"message": "server error"}})
+                    return
+                self._send(
+                    200,
+                    {
+                        "object": "chat.completion",
+                        "model": request.get("model"),
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {
+                                    "role": "assistant",
+                                    "content": mock_completion(prompt),
+                                },
+                                "finish_reason": "stop",
+                            }
+                        ],
+                    },
+                )
+
+        self.server = ThreadingHTTPServer(address, Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockLLMServer":
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="mock OpenAI-compatible chat completions endpoint for llm_composition.py"
+    )
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", help="seconds per request", type=float, default=0)
+    parser.add_argument(
+        "--fail_first",
+        help="answer the first attempts of every prompt with 429/500",
+        type=int,
+        default=0,
+    )
+    args = parser.parse_args()
+    mock = MockLLMServer((args.host, args.port), args.latency, args.fail_first)
+    print(f"serving {mock.url}/chat/completions")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
@@ -0,0 +1,331 @@
+import json
+import math
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterator, List
+from columnar_output import TableWriter
+from metrics import Metrics, measure
+from adjacency_index import (
+    SHAPE_JOINS,
+    EncodedRecords,
+    JoinSpec,
+    encode_records,
+    expand,
+    filter_pairs,
+    build_csr,
+    node_keys,
+    question_columns,
+)
+
+# a shard needs its inputs, their keys and the csr over the right side at the same time
+SHARD_OVERHEAD = 4
+
+
+class SpilledRelation:
+    """
+    rows of a shape spilled to disk as .npy chunks, optionally split into hash partitions.
+    """
+
+    def __init__(self, path: str, width: int, n_partitions: int = 1) -> None:
+        self.path = path
+        self.width = width
+        self.n_partitions = n_partitions
+        self.nbytes = 0
+        self.n_chunks = [0] * n_partitions
+        for partition in range(n_partitions):
+            os.makedirs(os.path.join(path, str(partition)), exist_ok=True)
+
+    def append(self, rows: np.ndarray, partition: int = 0):
+        if not len(rows):
+            return
+        chunk = self.n_chunks[partition]
+        np.save(os.path.join(self.path, str(partition), f"{chunk}.npy"), rows)
+        self.n_chunks[partition] += 1
+        self.nbytes += rows.nbytes
+
+    def chunks(self, partition: int = None) -> Iterator[np.ndarray]:
+        partitions = range(self.n_partitions) if partition is None else [partition]
+        for p in partitions:
+            for chunk in range(self.n_chunks[p]):
+                yield np.load(os.path.join(self.path, str(p), f"{chunk}.npy"))
+
+    def load(self, partition: int) -> np.ndarray:
+        chunks = list(self.chunks(partition))
+        if not chunks:
+            return np.empty((0, self.width), dtype=np.int64)
+        return np.concatenate(chunks)
+
+
+def hash_partition(keys: np.ndarray, n_partitions: int) -> np.ndarray:
+    # multiplicative hashing spreads dense integer codes of frequent entities across partitions
+    return (
+        (keys.astype(np.uint64) * np.uint64(2654435761)) % np.uint64(2**32)
+    ) % np.uint64(n_partitions)
+
+
+def n_partitions_for(nbytes: int, memory_budget: int) -> int:
+    return max(1, math.ceil(nbytes * SHARD_OVERHEAD / memory_budget))
+
+
+def partition_relation(
+    enc: EncodedRecords,
+    relation: SpilledRelation,
+    key,
+    n_partitions: int,
+    path: str,
+) -> SpilledRelation:
+    partitioned = SpilledRelation(path, relation.width, n_partitions)
+    for rows in relation.chunks():
+        keys = node_keys(enc, rows, key)
+        # rows with a missing key never join
+        rows, keys = rows[keys >= 0], keys[keys >= 0]
+        partitions = hash_partition(keys, n_partitions)
+        for partition in np.unique(partitions):
+            partitioned.append(rows[partitions == partition], int(partition))
+    return partitioned
+
+
+def permute_relation(
+    relation: SpilledRelation, permutation: List[int], path: str
+) -> SpilledRelation:
+    """
+    the rows of relation followed by the same rows with their nodes permuted.
+    """
+    permuted = SpilledRelation(path, relation.width)
+    for rows in relation.chunks():
+        permuted.append(rows)
+        permuted.append(rows[:, permutation])
+    return permuted
+
+
+def join_shard(
+    enc: EncodedRecords,
+    left: np.ndarray,
+    right: np.ndarray,
+    spec: JoinSpec,
+    max_rows: int,
+    rejected: Dict[str, int] = None,
+) -> Iterator[np.ndarray]:
+    """
+    join one shard, expanding at most `max_rows` candidate rows at a time.
+    the canonical pair order of a spec is left to its filters here.
+    """
+    if not len(left) or not len(right):
+        return
+    # keys of a shard are sparse, re-encode them densely before building the csr
+    uniques, right_codes = np.unique(
+        node_keys(enc, right, spec.right_key), return_inverse=True
+    )
+    csr = build_csr(right_codes.ravel(), len(uniques))
+
+    left_keys = node_keys(enc, left, spec.left_key)
+    positions = np.minimum(np.searchsorted(uniques, left_keys), len(uniques) - 1)
+    found = uniques[positions] == left_keys
+    left_codes = np.where(found, positions, -1)
+
+    counts = np.where(found, csr.degree()[positions], 0)
+    bounds = np.searchsorted(
+        np.cumsum(counts),
+        np.arange(max_rows, int(counts.sum()), max_rows),
+        side="right",
+    )
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(left)]):
+        if start == end:
+            continue
+        left_idx, right_idx = expand(left_codes[start:end], csr)
+        left_idx, right_idx = filter_pairs(
+            enc, spec, left[start:end], right, left_idx, right_idx, rejected
+        )
+        yield np.hstack([left[start:end][left_idx], right[right_idx]])
+
+
+def stream_questions_info(
+    enc_questions: np.ndarray,
+    relation: SpilledRelation,
+    shape: str,
+    qa_data: List[Dict],
+    file_path: str,
+    memory_budget: int,
+    work_dir: str,
+    ids_only: bool = False,
+    output_format: str = "jsonl",
+):
+    """
+    write the unique question sets of a shape one partition at a time, as jsonl (csv rows of
+    question indexes when ids_only is set) or as a parquet/arrow table.
+    identical sets share their first question so deduplication stays within a partition.
+    """
+    columns = question_columns(shape)
+    n_partitions = n_partitions_for(relation.nbytes, memory_budget)
+    by_first_question = SpilledRelation(
+        os.path.join(work_dir, shape + "_output"), len(columns), n_partitions
+    )
+    for rows in relation.chunks():
+        questions = np.stack(
+            [enc_questions[rows[:, node]] for _, node in columns], axis=1
+        )
+        partitions = hash_partition(questions[:, 0], n_partitions)
+        for partition in np.unique(partitions):
+            by_first_question.append(questions[partitions == partition], int(partition))
+
+    names = [name for name, _ in columns]
+
+    def unique_sets() -> Iterator[np.ndarray]:
+        for partition in range(n_partitions):
+            questions = by_first_question.load(partition)
+            _, first_seen = np.unique(questions, axis=0, return_index=True)
+            yield questions[np.sort(first_seen)]
+
+    if output_format != "jsonl":
+        writer = TableWriter(file_path, output_format)
+        for questions in unique_sets():
+            if ids_only:
+                writer.write(pd.DataFrame(questions, columns=names))
+            else:
+                writer.write(
+                    [
+                        {name: qa_data[x] for name, x in zip(names, row)}
+                        for row in questions
+                    ]
+                )
+        writer.close(pd.DataFrame(columns=names, dtype=np.int64) if ids_only else None)
+        return
+
+    with open(file_path, mode="w", encoding="utf-8") as file:
+        if ids_only:
+            file.write(",".join(names) + "\n")
+        for questions in unique_sets():
+            if ids_only:
+                np.savetxt(file, questions, fmt="%d", delimiter=",")
+                continue
+            for row in questions:
+                json.dump(
+                    {name: qa_data[x] for name, x in zip(names, row)},
+                    file,
+                    ensure_ascii=False,
+                )
+                file.write("\n")
+
+
+def composable_questions_partitioned(
+    records_of_entities: List[Dict],
+    qa_data: List[Dict],
+    output_path_template: str,
+    memory_budget: int,
+    work_dir: str = None,
+    rejected: Dict[str, Dict[str, int]] = None,
+    ids_only: bool = False,
+    output_format: str = "jsonl",
+    metrics: Metrics = None,
+) -> Dict[str, str]:
+    """
+    bounded-memory version of `composable_questions`.
+    the encoded records are memory mapped from disk, every join hash-partitions both sides by the
+    bridge (the entity for 2hop, the shared question for longer shapes) into on-disk shards and
+    joins one shard at a time. results are streamed to one jsonl file per shape.
+    the sets are the same as `composable_questions`, only their order in the files differs.
+
+    Args:
+    - records_of_entities: see `composable_questions`
+    - qa_data: see `composable_questions`
+    - output_path_template: output file path containing "{shape}", e.g. "out/file_{shape}_composable_questions.jsonl"
+    - memory_budget: rough upper bound in bytes for the working set of a shard, decides how many partitions are used
+    - work_dir: where shards are spilled, default is the system temporary directory
+    - rejected: optional dict filled with {shape: {filter: rejected candidate rows}}
+    - ids_only: write csv files of question indexes into qa_data instead of jsonl copies of the questions
+    - output_format: "jsonl", "parquet" or "arrow", see `columnar_output.py`
+    - metrics: optional `metrics.Metrics` that gets the rows and time of every shape and of writing it
+    """
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        df = pd.DataFrame(records_of_entities)
+        enc = encode_records(df)
+        questions = df["question"].to_numpy().astype(np.int64)
+        del df
+        for name in ["question", "question_entity", "answer_entity", "passage"]:
+            np.save(os.path.join(tmp_dir, name + ".npy"), getattr(enc, name))
+            setattr(
+                enc, name, np.load(os.path.join(tmp_dir, name + ".npy"), mmap_mode="r")
+            )
+        np.save(os.path.join(tmp_dir, "questions.npy"), questions)
+        questions = np.load(os.path.join(tmp_dir, "questions.npy"), mmap_mode="r")
+
+        relations = {"records": SpilledRelation(os.path.join(tmp_dir, "records"), 1)}
+        chunk_rows = max(1, memory_budget // 8)
+        for start in range(0, len(questions), chunk_rows):
+            end = min(start + chunk_rows, len(questions))
+            relations["records"].append(np.arange(start, end, dtype=np.int64)[:, None])
+
+        output_paths = {}
+        for shape, spec in SHAPE_JOINS.items():
+            with measure(metrics, f"task2/{shape}") as counters:
+                left, right = relations[spec.left], relations[spec.right]
+                if spec.right_permutation is not None:
+                    right = permute_relation(
+                        right,
+                        spec.right_permutation,
+                        os.path.join(tmp_dir, shape + "_permuted"),
+                    )
+                n_partitions = n_partitions_for(
+                    left.nbytes + right.nbytes, memory_budget
+                )
+                left_parts = partition_relation(
+                    enc,
+                    left,
+                    spec.left_key,
+                    n_partitions,
+                    os.path.join(tmp_dir, shape + "_left"),
+                )
+                if (spec.left, spec.left_key) == (spec.right, spec.right_key):
+                    right_parts = left_parts
+                else:
+                    right_parts = partition_relation(
+                        enc,
+                        right,
+                        spec.right_key,
+                        n_partitions,
+                        os.path.join(tmp_dir, shape + "_right"),
+                    )
+                width = left.width + right.width
+                # candidate rows are gathered from both sides and filtered, about two copies of 8 bytes per node
+                max_rows = max(1, memory_budget // (16 * width))
+
+                relations[shape] = SpilledRelation(os.path.join(tmp_dir, shape), width)
+                shape_rejected = {name: 0 for name, _ in spec.filters}
+                for partition in range(n_partitions):
+                    for rows in join_shard(
+                        enc,
+                        left_parts.load(partition),
+                        right_parts.load(partition),
+                        spec,
+                        max_rows,
+                        shape_rejected,
+                    ):
+                        relations[shape].append(rows)
+                if rejected is not None:
+                    rejected[shape] = shape_rejected
+                shutil.rmtree(left_parts.path)
+                shutil.rmtree(right_parts.path, ignore_errors=True)
+                counters.update(
+                    left_rows=left.nbytes // (8 * left.width),
+                    right_rows=right.nbytes // (8 * right.width),
+                    output_rows=relations[shape].nbytes // (8 * width),
+                    partitions=n_partitions,
+                )
+
+            output_paths[shape] = output_path_template.format(shape=shape)
+            with measure(metrics, f"task2/{shape}/write_output"):
+                stream_questions_info(
+                    questions,
+                    relations[shape],
+                    shape,
+                    qa_data,
+                    output_paths[shape],
+                    memory_budget,
+                    tmp_dir,
+                    ids_only,
+                    output_format,
+                )
+    return output_paths
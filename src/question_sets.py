@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterator, List
+
+
+def write_question_ids(ids: pd.DataFrame, file_path: str):
+    """
+    save composable question sets as rows of question indexes, one column per question of the set.
+    """
+    ids.to_csv(file_path, index=False)
+
+
+class QATable:
+    """
+    the qa records of a jsonl file, each line is only read and parsed when it is asked for.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        offsets = [0]
+        with open(file_path, mode="rb") as file:
+            for line in file:
+                offsets.append(offsets[-1] + len(line))
+        self.offsets = np.array(offsets[:-1], dtype=np.int64)
+        self._file = open(file_path, mode="rb")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, question: int) -> Dict:
+        self._file.seek(self.offsets[question])
+        return json.loads(self._file.readline())
+
+    def close(self):
+        self._file.close()
+
+
+class QuestionSets:
+    """
+    composable question sets saved as question indexes, joined with the qa table while they
+    are iterated so only the sets being consumed are materialized.
+
+    Args:
+    - ids_path: csv, parquet or arrow file of question indexes
+    - qa_table: the qa records the indexes point to, a `QATable` or a list of dictionaries
+    - chunk_size: number of sets read from ids_path at a time
+    """
+
+    def __init__(self, ids_path: str, qa_table, chunk_size: int = 10000) -> None:
+        self.ids_path = ids_path
+        self.qa_table = qa_table
+        self.chunk_size = chunk_size
+
+    @property
+    def columns(self) -> List[str]:
+        return list(next(self.iter_ids()).columns)
+
+    def iter_ids(self) -> Iterator[pd.DataFrame]:
+        if self.ids_path.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            for batch in pq.ParquetFile(self.ids_path).iter_batches(self.chunk_size):
+                yield batch.to_pandas()
+        elif self.ids_path.endswith(".arrow"):
+            import pyarrow as pa
+
+            with pa.memory_map(self.ids_path) as source:
+                for batch in pa.ipc.open_stream(source):
+                    yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(self.ids_path, chunksize=self.chunk_size)
+
+    def __iter__(self) -> Iterator[Dict]:
+        for chunk in self.iter_ids():
+            for row in chunk.itertuples(index=False):
+                yield {
+                    col: self.qa_table[question]
+                    for col, question in zip(chunk.columns, row)
+                }
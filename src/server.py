@@ -0,0 +1,513 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+from composable_questions import composable_questions
+from entity_linking.nel import NEL
+from incremental_composition import CompositionState
+from main import (
+    add_linking_arguments,
+    entity_link_records,
+    from_jsonl,
+    linker_counters,
+    load_entity_linker,
+)
+
+_STOP = object()
+
+
+@dataclass
+class LinkJob:
+    questions: List[str]
+    answers_batch: List[List[str]]
+    future: Future
+
+
+class LinkingBatcher:
+    """
+    links the questions and answers of concurrent requests on a single thread. the requests that
+    arrive within `max_wait` seconds of the first waiting one, up to `max_questions` questions,
+    are recognized one by one and their mentions are disambiguated in one NED pass, see
+    `NEL.disambiguate_questions_and_answers_many`.
+
+    Args:
+    - entity_linker: the resident `NEL`, only used from the thread of the batcher
+    - context_insensitive_answers: see `NEL.link_questions_and_answers`
+    - max_wait: seconds a request waits for others to share its NED pass
+    - max_questions: questions above which a pass does not wait for more requests
+    """
+
+    def __init__(
+        self,
+        entity_linker: NEL,
+        context_insensitive_answers: bool = None,
+        max_wait: float = 0.005,
+        max_questions: int = 256,
+    ) -> None:
+        self.entity_linker = entity_linker
+        self.context_insensitive_answers = context_insensitive_answers
+        self.max_wait = max_wait
+        self.max_questions = max_questions
+        self.requests = 0
+        self.passes = 0
+        self.largest_pass = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def link(
+        self, questions: List[str], answers_batch: List[List[str]]
+    ) -> Tuple[list, list]:
+        """
+        the linked entities of the questions and of the answers of each question, blocks until
+        the pass of the request is done.
+        """
+        job = LinkJob(questions, answers_batch, Future())
+        self.queue.put(job)
+        return job.future.result()
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _collect(self) -> Tuple[List[LinkJob], bool]:
+        job = self.queue.get()
+        if job is _STOP:
+            return [], True
+        jobs, n_questions = [job], len(job.questions)
+        deadline = time.monotonic() + self.max_wait
+        while n_questions < self.max_questions:
+            try:
+                job = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if job is _STOP:
+                return jobs, True
+            jobs.append(job)
+            n_questions += len(job.questions)
+        return jobs, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            jobs, stop = self._collect()
+            if jobs:
+                self._link(jobs)
+
+    def _link(self, jobs: List[LinkJob]):
+        recognized = []
+        for job in jobs:
+            try:
+                recognized.append(
+                    self.entity_linker.recognize_questions_and_answers(
+                        job.questions,
+                        job.answers_batch,
+                        self.context_insensitive_answers,
+                    )
+                )
+            except Exception as error:
+                job.future.set_exception(error)
+        jobs = [job for job in jobs if not job.future.done()]
+        if not jobs:
+            return
+        try:
+            results = self.entity_linker.disambiguate_questions_and_answers_many(
+                recognized
+            )
+        except Exception as error:
+            for job in jobs:
+                job.future.set_exception(error)
+            return
+        for job, result in zip(jobs, results):
+            job.future.set_result(result)
+        self.requests += len(jobs)
+        self.passes += 1
+        self.largest_pass = max(self.largest_pass, len(jobs))
+
+
+class LinkingService:
+    """
+    what the server keeps resident: the linker behind its batcher and a pool of questions,
+    persisted in a `CompositionState`, that the questions of a request can be composed with.
+    """
+
+    def __init__(self, batcher: LinkingBatcher, state_path: str) -> None:
+        self.batcher = batcher
+        self.state = CompositionState(state_path)
+        # the pool is updated by one request at a time
+        self.lock = threading.Lock()
+
+    def link(self, qa_data: List[Dict], compose: bool = False) -> Dict:
+        """
+        link the questions and answers of qa records, see the README for the response. with
+        compose the questions are added to the pool and the new composable sets are returned.
+        """
+        if not isinstance(qa_data, list) or not all(
+            isinstance(qa, dict) and "question" in qa and "answers" in qa
+            for qa in qa_data
+        ):
+            raise ValueError('"records" must be a list of {"question", "answers", ...}')
+        if compose and not all("passage_id" in qa for qa in qa_data):
+            raise ValueError('composing needs the "passage_id" of every record')
+        questions_entities, answers_entities = self.batcher.link(
+            [qa["question"] for qa in qa_data], [qa["answers"] for qa in qa_data]
+        )
+        response = {
+            "links": [
+                {
+                    "question_entities": [asdict(e) for e in question_entities],
+                    "answer_entities": [asdict(e) for e in answer_entities],
+                }
+                for question_entities, answer_entities in zip(
+                    questions_entities, answers_entities
+                )
+            ]
+        }
+        with self.lock if compose else nullcontext():
+            first = self.state.add_questions(qa_data) if compose else 0
+            records = [
+                record
+                for i, (qa, question_entities, answer_entities) in enumerate(
+                    zip(qa_data, questions_entities, answers_entities)
+                )
+                for record in entity_link_records(
+                    first + i, qa.get("passage_id"), question_entities, answer_entities
+                )
+            ]
+            response["records"] = records
+            if compose:
+                sets = self.state.question_ids(self.state.add(records))
+                response["first_question"] = first
+                response["sets"] = {}
+                for shape, ids in sets.items():
+                    response["sets"][shape] = {
+                        "columns": list(ids.columns),
+                        "rows": ids.values.tolist(),
+                    }
+        return response
+
+    def stats(self) -> Dict:
+        entity_linker = self.batcher.entity_linker
+        return {
+            "linker": entity_linker.identity(),
+            "pool_questions": self.state.n_questions,
+            "requests": self.batcher.requests,
+            "ned_passes": self.batcher.passes,
+            "largest_pass": self.batcher.largest_pass,
+            **{
+                attribute if name == "stats" else f"{name}_{attribute}": n
+                for (name, attribute), n in linker_counters(entity_linker).items()
+            },
+        }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /health and /stats, POST /link with {"records": [qa records], "compose": false}.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args):
+        if self.server.log_requests:
+            super().log_message(format, *args)
+
+    def address_string(self) -> str:
+        # clients of a unix socket have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _send(self, status: int, payload: Dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send(200, service.stats())
+        else:
+            self._send(404, {"error": f"unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/link":
+            self._send(404, {"error": f"unknown path: {self.path}"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            payload = json.loads(body)
+            response = self.server.service.link(
+                payload["records"], bool(payload.get("compose", False))
+            )
+        except (ValueError, KeyError, TypeError) as error:
+            self._send(400, {"error": f"{type(error).__name__}: {error}"})
+            return
+        except Exception as error:
+            self._send(500, {"error": f"{type(error).__name__}: {error}"})
+            return
+        self._send(200, response)
+
+
+class ThreadingUnixHTTPServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    daemon_threads = True
+    # connecting to a unix socket whose backlog is full fails at once instead of retrying
+    request_queue_size = 128
+
+
+def is_unix_address(address: str) -> bool:
+    host, _, port = address.rpartition(":")
+    return not (host and port.isdigit())
+
+
+def make_server(
+    address: str, service: LinkingService, log_requests: bool = True
+) -> socketserver.BaseServer:
+    """
+    a threaded HTTP server on `host:port` or, for any other address, on a unix socket at that
+    path. each request is handled on its own thread and waits for its NED pass.
+    """
+    if is_unix_address(address):
+        if os.path.exists(address):
+            os.remove(address)
+        server = ThreadingUnixHTTPServer(address, RequestHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        server = ThreadingHTTPServer((host, int(port)), RequestHandler)
+    server.service = service
+    server.log_requests = log_requests
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ServiceClient:
+    """
+    client of the server, keeps its connection open between requests.
+
+    Args:
+    - address: `host:port` or the path of the unix socket of the server
+    - timeout: seconds to wait for a response
+    """
+
+    def __init__(self, address: str, timeout: float = 600) -> None:
+        if is_unix_address(address):
+            self.connection = UnixHTTPConnection(address, timeout)
+        else:
+            host, _, port = address.rpartition(":")
+            self.connection = http.client.HTTPConnection(host, int(port), timeout)
+
+    def request(self, method: str, path: str, payload: Dict = None) -> Dict:
+        body = None if payload is None else json.dumps(payload, ensure_ascii=False)
+        headers = {} if body is None else {"Content-Type": "application/json"}
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"{response.status}: {result.get('error')}")
+        return result
+
+    def link(self, qa_data: List[Dict], compose: bool = False) -> Dict:
+        return self.request("POST", "/link", {"records": qa_data, "compose": compose})
+
+    def close(self):
+        self.connection.close()
+
+
+def self_check(
+    n_questions: int = 400, request_size: int = 20, n_clients: int = 8
+) -> bool:
+    """
+    serve the stub models on a temporary unix socket, send synthetic questions from concurrent
+    clients and check the links against linking each request directly, the sets against
+    composing the whole pool at once, and that requests shared NED passes. runs offline.
+    """
+    from benchmark import synthetic_questions
+
+    qa_data, _ = synthetic_questions(n_questions, n_questions)
+    requests = [
+        qa_data[start : start + request_size]
+        for start in range(0, len(qa_data), request_size)
+    ]
+    work_dir = tempfile.mkdtemp()
+    # the server is started from the options of the command line, as `python server.py` does
+    parser = argument_parser()
+    args = parser.parse_args(
+        ["--ner", "stub", "--ned", "stub", "--max_wait_ms", "20"]
+        + ["--address", os.path.join(work_dir, "server.sock")]
+    )
+    server, batcher = start_server(
+        args, parser, os.path.join(work_dir, "state"), log_requests=False
+    )
+    # sleep per NED call like a GPU batch, so the check sees whether requests share passes
+    batcher.entity_linker.ned.latency_per_call = 0.005
+    service = server.service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    local = threading.local()
+
+    def send(request: List[Dict]) -> Dict:
+        if not hasattr(local, "client"):
+            local.client = ServiceClient(server.server_address)
+        return local.client.link(request, compose=True)
+
+    try:
+        with ThreadPoolExecutor(n_clients) as pool:
+            responses = list(pool.map(send, requests))
+        stats = ServiceClient(server.server_address).request("GET", "/stats")
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+    ok = True
+    direct = load_entity_linker(args, parser)
+    for i, (request, response) in enumerate(zip(requests, responses)):
+        questions, answers = direct.link_questions_and_answers(
+            [qa["question"] for qa in request], [qa["answers"] for qa in request]
+        )
+        expected = [
+            {
+                "question_entities": [asdict(e) for e in question_entities],
+                "answer_entities": [asdict(e) for e in answer_entities],
+            }
+            for question_entities, answer_entities in zip(questions, answers)
+        ]
+        if response["links"] != expected:
+            print(f"links of request {i} differ from linking it directly")
+            ok = False
+
+    # the pool numbers the questions in the order the requests were served
+    pool = from_jsonl(service.state.questions_path)
+    records = [record for response in responses for record in response["records"]]
+    expected_sets = composable_questions(
+        records, pool, debug=False, engine="numpy", ids_only=True
+    )
+    for shape, frame in expected_sets.items():
+        columns = list(frame.columns)
+        expected_rows = set(map(tuple, frame[columns].values.tolist()))
+        served_rows = set()
+        for response in responses:
+            sets = response["sets"][shape]
+            order = [sets["columns"].index(column) for column in columns]
+            served_rows.update(tuple(row[i] for i in order) for row in sets["rows"])
+        print(f"{shape}: {len(served_rows)} sets served, {len(expected_rows)} expected")
+        ok = ok and served_rows == expected_rows
+    print(
+        f"{stats['requests']} requests linked in {stats['ned_passes']} NED passes, "
+        f"at most {stats['largest_pass']} per pass"
+    )
+    ok = ok and stats["ned_passes"] < stats["requests"]
+    shutil.rmtree(work_dir)
+    print("self check " + ("passed" if ok else "FAILED"))
+    return ok
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="keep the NER/NED models loaded and link, and optionally compose, batches of qa records sent over HTTP"
+    )
+    parser.add_argument(
+        "--address",
+        help="host:port to listen on, or the path of a unix socket",
+        type=str,
+        default="127.0.0.1:8765",
+    )
+    parser.add_argument(
+        "--composition_state",
+        help="directory of the pool of questions that composed requests are added to, kept between runs. default is a temporary pool removed at exit",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        help="milliseconds a request waits for concurrent ones to share its NED pass",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--max_batch_questions",
+        help="a NED pass stops waiting for requests once it has this many questions",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--self_check",
+        help="check the server end to end with the stub models on a temporary unix socket and exit",
+        action="store_true",
+    )
+    add_linking_arguments(parser)
+    return parser
+
+
+def start_server(
+    args, parser: argparse.ArgumentParser, state_path: str, log_requests: bool = True
+) -> Tuple[socketserver.BaseServer, LinkingBatcher]:
+    """
+    load the models of the options of `argument_parser` and build the server of `args.address`
+    with its pool of questions in state_path. the caller runs `serve_forever`.
+    """
+    entity_linker = load_entity_linker(args, parser)
+    batcher = LinkingBatcher(
+        entity_linker,
+        args.context_insensitive_answers,
+        args.max_wait_ms / 1000,
+        args.max_batch_questions,
+    )
+    server = make_server(
+        args.address, LinkingService(batcher, state_path), log_requests
+    )
+    return server, batcher
+
+
+if __name__ == "__main__":
+    parser = argument_parser()
+    args = parser.parse_args()
+    if args.self_check:
+        raise SystemExit(0 if self_check() else 1)
+
+    state_path = args.composition_state or tempfile.mkdtemp()
+    server, batcher = start_server(args, parser, state_path)
+    entity_linker = batcher.entity_linker
+    print(f"serving on {args.address}")
+    # stop on kill as on ctrl-c, so the socket and the temporary pool are removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if entity_linker.cache is not None:
+            entity_linker.cache.close()
+        if is_unix_address(args.address):
+            os.remove(args.address)
+        if args.composition_state is None:
+            shutil.rmtree(state_path)
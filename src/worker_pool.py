@@ -0,0 +1,56 @@
+import gc
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+# state inherited by forked workers, so loaded models are shared copy-on-write instead of pickled
+_shared = {}
+
+
+def _init_worker(n_threads: int):
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        # workers would otherwise each start a thread per core
+        torch.set_num_threads(n_threads)
+    if _shared["initializer"] is not None:
+        _shared["initializer"]()
+
+
+def _run(task: tuple):
+    return _shared["fn"](*task)
+
+
+def map_forked(
+    fn: Callable,
+    tasks: Iterable[tuple],
+    n_workers: int,
+    initializer: Callable = None,
+) -> Iterator:
+    """
+    `fn(*task)` for each task on a pool of processes forked from this one, the results are
+    yielded in the order of tasks. fn and everything it references, e.g. the NER/NED models, are
+    inherited by the workers instead of being pickled or loaded again. the objects that exist
+    before the fork are frozen out of the garbage collector so collections do not write to, and
+    copy, their pages. torch models must be on the CPU, CUDA cannot be used after a fork.
+
+    Args:
+    - fn: function run in the workers
+    - tasks: picklable arguments of each call
+    - n_workers: number of processes
+    - initializer: run once in each worker, e.g. to reopen files and connections
+    """
+    _shared.update(fn=fn, initializer=initializer)
+    gc.freeze()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(max(1, (os.cpu_count() or 1) // n_workers),),
+        ) as pool:
+            yield from pool.map(_run, tasks)
+    finally:
+        gc.unfreeze()
+        _shared.clear()